@@ -10,7 +10,14 @@ import schedule as sched_module
 from app.routes import init_routes
 from app.utils.db import setup_database
 from app.utils.gpu_monitoring import initialize_gpu_config, initialize_gpu_tracking,reset_user_access,reset_gpu_access,check_allocation_utilization,check_and_revoke_idle_allocation
-from app.utils.gpu_monitoring  import restore_monitoring_jobs,check_expired_reservations,notify_users_of_unallocation
+from app.utils.gpu_monitoring  import restore_monitoring_jobs,check_expired_reservations,check_idle_allocations,run_expiry_loop
+from app.utils.waitlist import dispatch_waitlist, migrate_notify_list
+from app.utils.bookings import activate_due_bookings, rebuild_booking_index
+from app.utils.telemetry import run_telemetry_collector
+from app.utils.rollups import rollup_gpu_utilization
+from app.utils.topology import initialize_gpu_topology
+from app.utils.quotas import rebuild_quota_usage
+from app.utils.expiry import rebuild_expiry_index
 from app.config import REDIS_CLIENT, REDIS_BINARY, REDIS_KEYS
 from app.utils.logger import logger
 import json
@@ -19,7 +26,6 @@ from decouple import config, Csv
 def threaded_function():
     import time
     try:
-        check_expired_reservations()
         while True:
             try:
                 process_scheduler_job_queue()
@@ -51,22 +57,24 @@ def process_scheduler_job_queue():
                 job_unit = job.get('job_unit')
                 job_interval = job.get('job_interval')
                 job_function = job.get('job_function')
-                job_input = job.get('job_input')
+                # A message schedules the same job for one input or a batch of them
+                job_inputs = job.get('job_inputs') or [job.get('job_input')]
                 
-                # Make sure job_input has _id before accessing it
-                if job_input and '_id' in job_input:
-                    id = job_input.get('_id')
-                    
-                    if job_unit == 'hours':
-                        job = sched_module.every(job_interval).hours.do(globals()[job_function], job_input).tag(f"{id}:{job_function}")
-                    elif job_unit == 'minutes':
-                        job = sched_module.every(job_interval).minutes.do(globals()[job_function], job_input).tag(f"{id}:{job_function}")
-                    elif job_unit == 'seconds':
-                        job = sched_module.every(job_interval).seconds.do(globals()[job_function], job_input).tag(f"{id}:{job_function}")
-                    
-                    logger.info(f"Added interval job: {job_function} every {job_interval} {job_unit}")
-                else:
-                    logger.error(f"Job input missing _id field: {job_input}")
+                for job_input in job_inputs:
+                    # Make sure job_input has _id before accessing it
+                    if job_input and '_id' in job_input:
+                        id = job_input.get('_id')
+                        
+                        if job_unit == 'hours':
+                            job = sched_module.every(job_interval).hours.do(globals()[job_function], job_input).tag(f"{id}:{job_function}")
+                        elif job_unit == 'minutes':
+                            job = sched_module.every(job_interval).minutes.do(globals()[job_function], job_input).tag(f"{id}:{job_function}")
+                        elif job_unit == 'seconds':
+                            job = sched_module.every(job_interval).seconds.do(globals()[job_function], job_input).tag(f"{id}:{job_function}")
+                        
+                        logger.info(f"Added interval job: {job_function} every {job_interval} {job_unit}")
+                    else:
+                        logger.error(f"Job input missing _id field: {job_input}")
             except Exception as e:
                 logger.error(f"Error processing scheduler job: {str(e)}")
 
@@ -133,6 +141,13 @@ def on_initial():
             if not initialize_gpu_config():
                 logger.error("Error initializing GPU configuration")
                 return False
+            # Placement works without it, picking GPUs by ID
+            initialize_gpu_topology()
+            
+            # Start the GPU telemetry collector, the only place that queries the GPUs for status
+            collector_thread = threading.Thread(target=run_telemetry_collector)
+            collector_thread.daemon = True
+            collector_thread.start()
             
             # Initialize GPU tracking
             if not initialize_gpu_tracking():
@@ -149,9 +164,22 @@ def on_initial():
                 logger.error("Error resetting user access")
                 return False
             restore_monitoring_jobs()
+            rebuild_booking_index()
+            rebuild_quota_usage()
+            rebuild_expiry_index()
+            migrate_notify_list()
             
             # Set up scheduled tasks
-            sched_module.every(config('CHECK_FOR_IDLE_GPU_HOURS',default=6,cast=int)).hours.do(check_expired_reservations)
+            sched_module.every(1).minutes.do(rollup_gpu_utilization)
+            sched_module.every(config('IDLE_CHECK_MINUTES',default=5,cast=int)).minutes.do(check_idle_allocations)
+            # Batches of releases dispatch the waitlist through gpus_freed(), this catches GPUs freed any other way
+            sched_module.every(1).minutes.do(dispatch_waitlist)
+            sched_module.every(1).minutes.do(activate_due_bookings)
+            
+            # Expired allocations are released by their own thread, sleeping until the next one is due
+            expiry_thread = threading.Thread(target=run_expiry_loop)
+            expiry_thread.daemon = True
+            expiry_thread.start()
             
             # Start the scheduler thread
             scheduler_thread = threading.Thread(target=threaded_function)
@@ -166,7 +194,7 @@ def on_initial():
             # Set initialization flag in Redis
             REDIS_CLIENT.set(REDIS_KEYS['system_initialized'], '1')
             logger.info("System initialization completed successfully")
-            notify_users_of_unallocation()
+            dispatch_waitlist()
             return True
             
         finally:
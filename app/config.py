@@ -25,20 +25,46 @@ def enqueue_job(job_name,*args,**kwargs):
     logger.info(f"Enqueuing job {job_name} with args {args} and kwargs {kwargs}")
     redis_conn = REDIS_BINARY
     q = Queue(connection=redis_conn)
-    q.enqueue(job_name,*args,**kwargs)
+    return q.enqueue(job_name,*args,**kwargs)
 
 # Redis keys
 REDIS_KEYS = {
     'scheduler_job_queue': 'gpulocker:scheduler_job_queue',
     'scheduler_cancel_job_queue': 'gpulocker:scheduler_cancel_job_queue',
     'gpu_lock': 'gpulocker:gpu_lock',
-    'available_gpus': 'gpulocker:available_gpus',
+    'gpu_lease': 'gpulocker:gpu_lease',  # Format with the GPU id
+    'gpu_fence': 'gpulocker:gpu_fence',  # Format with the GPU id, last fencing token handed out
+    'lock_metrics': 'gpulocker:lock_metrics',  # Wait/hold statistics per lock name
+    'release_jobs': 'gpulocker:release_jobs',  # Queued or running release job per allocation id
+    'waitlist_lock': 'gpulocker:waitlist_lock',
+    'gpu_bookings': 'gpulocker:gpu_bookings',  # Format with the GPU id, bookings scored by start time
+    'booking_lock': 'gpulocker:booking_lock',
+    'quota_usage': 'gpulocker:quota_usage',  # Format with the username or @group, held GPUs and GPU-hours used
+    'quota_lock': 'gpulocker:quota_lock',  # Format with the username or @group, held from a quota check to the allocation
+    'available_gpus': 'gpulocker:available_gpus',  # Format with the GPU type, one set of free GPU IDs per type
+    'mig_config': 'gpulocker:mig_config',  # MIG instances of every GPU type, queried at startup
+    'available_mig': 'gpulocker:available_mig',  # Format with the GPU type, set of free "gpu_id:instance_id"
+    'shared_gpu': 'gpulocker:shared_gpu',  # Format with the GPU id, tenants and memory reserved on a time-sliced GPU
+    'memory_budget_warning': 'gpulocker:memory_budget_warning',  # Format with the allocation id, set for an hour after a budget warning
+    'idle_warning': 'gpulocker:idle_warning',  # Format with the allocation id, set for an idle window after an idle-but-in-use warning
+    'idempotency': 'gpulocker:idempotency',  # Format with username and request key, outcome of an allocation, release or extension
+    'expiry_index': 'gpulocker:expiry_index',  # Active allocation ids scored by the time they can be reclaimed
+    'expiry_wakeup': 'gpulocker:expiry_wakeup',  # Pushed when an allocation is indexed ahead of the earliest one
     'disk_cache': 'gpulocker:disk_cache',
     'allocation_jobs': 'gpulocker:allocation_jobs',
     'scheduler_lock': 'gpulocker:scheduler_lock',
     'worker_heartbeat': 'gpulocker:worker_heartbeat:{}',  # Format with worker id
     'init_lock': 'gpulocker:init_lock',
     'system_initialized': 'gpulocker:system_initialized',
-    'gpu_status': 'gpulocker:gpu_status',
-    'gpu_config': 'gpulocker:gpu_config'
+    'gpu_status': 'gpulocker:gpu_status',  # Hash holding the latest telemetry snapshot
+    'gpu_status_history': 'gpulocker:gpu_status_history',  # Ring buffer of recent snapshots
+    'gpu_window_stats': 'gpulocker:gpu_window_stats',  # Sliding-window statistics per GPU
+    'gpu_user_memory': 'gpulocker:gpu_user_memory',  # GPU memory used by each user's processes
+    'gpu_health': 'gpulocker:gpu_health',  # Health state per GPU
+    'gpu_energy': 'gpulocker:gpu_energy',  # Monotonic energy counter in Wh per GPU
+    'rollup_watermark': 'gpulocker:rollup_watermark',  # Format with the rollup tier
+    'idle_state': 'gpulocker:idle_state',  # Format with the allocation id
+    'utilization_run': 'gpulocker:utilization_run',  # Format with the allocation id
+    'gpu_config': 'gpulocker:gpu_config',
+    'gpu_topology': 'gpulocker:gpu_topology'  # Link cost between every pair of GPUs
 }
\ No newline at end of file
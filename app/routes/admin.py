@@ -1,13 +1,14 @@
-from flask import Blueprint, session, redirect, url_for, flash
-import subprocess
-import os
+from flask import Blueprint, session, redirect, url_for, flash, request, jsonify
 from decouple import config,Csv
 from app.utils.logger import logger
 from app.routes.auth import login_required
 from app.utils.notification import *
 from app.utils.db import *
-from app.utils.gpu_monitoring import set_gpu_permission,get_gpu_config,initialize_gpu_tracking
-from app.utils.gpu_monitoring import cancel_allocation_monitoring
+from app.utils.gpu_monitoring import build_idle_report
+from app.utils.idle_detector import IdlePolicy
+from app.utils.health import clear_gpu_health
+from app.utils.redis_utils import get_lock_metrics
+from app.utils.release_jobs import submit_system_reset
 admin_bp = Blueprint('admin', __name__)
 @admin_bp.route('/reset', methods=['GET', 'POST'])
 @login_required
@@ -23,68 +24,83 @@ def reset_all():
     try:
         logger.info(f"Admin user {username} requested full system reset")
         
-        # Connect to database
-        client, db = get_db_connection()
-        
-        # Step 1: Get all active allocations
-        active_allocations = list(db.gpu_allocations.find({'released_at': None}))
-        logger.info(f"Found {len(active_allocations)} active allocations to reset")
-        
-        # Cancel all monitoring jobs
-        for allocation in active_allocations:
-            cancel_allocation_monitoring(str(allocation['_id']))
-        
-        # Step 2: Revoke all GPU access and mark allocations as released
-        for allocation in active_allocations:
-            alloc_username = allocation['username']
-            gpu_id = allocation['gpu_id']
-            gpu_type = allocation['gpu_type']
-            allocation_id = allocation['_id']
-            
-            # Remove user's access to the GPU
-            set_gpu_permission(alloc_username, gpu_id, grant=False)
-            
-            # Mark allocation as released in database with a comment
-            comment = f"Released during system reset by admin {username}"
-            update_allocation_status(db, allocation_id, released=True, comment=comment)
-            
-            logger.debug(f"Revoked access to GPU {gpu_id} for user {alloc_username}")
-        
-        # Step 3: Reset all GPU permissions using reset_gpus.sh script
-        # Collect all GPU IDs to pass to the script
-        all_gpu_ids = []
-        gpu_dict=get_gpu_config()
-        for gpu_type in gpu_dict.keys():
-            for gpu_id in gpu_dict[gpu_type]:
-                all_gpu_ids.append(str(gpu_id))
-        
-        # Call the reset_gpus.sh script with all GPU IDs as arguments and suppress output
-        if all_gpu_ids:
-            try:
-                # Construct the command with all GPU IDs as arguments and suppress output
-                script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'reset_gpus.sh')
-                cmd = ['sudo', script_path] + all_gpu_ids
-                subprocess.run(cmd, check=True, 
-                                stdout=subprocess.DEVNULL,
-                                stderr=subprocess.DEVNULL
-                                 )
-                logger.info(f'Reset permissions for GPUs {all_gpu_ids} using reset_gpus.sh')
-            except subprocess.CalledProcessError as e:
-                logger.error(f'Failed to reset permissions using reset_gpus.sh: {str(e)}')
-        
-        # Step 4: Reinitialize GPU tracking
-        initialize_gpu_tracking()
-        
-        flash('Successfully reset all GPU permissions and allocations', 'success')
-        logger.info(f"Admin user {username} successfully reset all GPU permissions and allocations")
+        # Revoke every allocation in parallel on the RQ workers, then reset the
+        # ACLs and the pool; the dashboard polls the final job
+        job_id = submit_system_reset(username)
+        session['pending_jobs'] = session.get('pending_jobs', []) + [job_id]
+        flash('System reset started', 'info')
         
     except Exception as e:
         logger.error(f"Error during system reset: {str(e)}")
         flash('Failed to reset system', 'error')
-    finally:
-        if 'client' in locals():
-            client.close()
     
     return redirect(url_for('dashboard.dashboard'))
 
 
+
+@admin_bp.route('/admin/idle_report')
+@login_required
+def idle_report():
+    """Dry run of the idle detector: which allocations would be revoked under a policy
+    
+    Query parameters override the configured policy: window_hours,
+    min_utilization (%), min_memory_gb and percentile.
+    """
+    username = session['username']
+    authorized_users = config('PRIVILEGED_USERS', cast=Csv())
+    if username not in authorized_users:
+        logger.warning(f"Unauthorized idle report request by user {username}")
+        return jsonify({"message": "You are not authorized to perform this action", "status": "error"}), 403
+    
+    min_memory_gb = request.args.get('min_memory_gb', type=float)
+    policy = IdlePolicy.from_config(
+        window_hours=request.args.get('window_hours', type=float),
+        min_utilization=request.args.get('min_utilization', type=float),
+        min_memory=min_memory_gb * 1024 if min_memory_gb is not None else None,
+        percentile=request.args.get('percentile', type=float)
+    )
+    try:
+        report = build_idle_report(policy)
+    except Exception as e:
+        logger.error(f"Error building idle report: {str(e)}")
+        return jsonify({"message": "Failed to build idle report", "status": "error"}), 500
+    return jsonify({
+        'policy': policy.to_dict(),
+        'would_revoke': sum(1 for entry in report if entry['would_revoke']),
+        'allocations': report
+    })
+
+@admin_bp.route('/admin/lock_metrics')
+@login_required
+def lock_metrics():
+    """Wait and hold times of the global lock and the per-GPU leases"""
+    username = session['username']
+    authorized_users = config('PRIVILEGED_USERS', cast=Csv())
+    if username not in authorized_users:
+        logger.warning(f"Unauthorized lock metrics request by user {username}")
+        return jsonify({"message": "You are not authorized to perform this action", "status": "error"}), 403
+    try:
+        return jsonify(get_lock_metrics())
+    except Exception as e:
+        logger.error(f"Error reading lock metrics: {str(e)}")
+        return jsonify({"message": "Failed to read lock metrics", "status": "error"}), 500
+
+@admin_bp.route('/admin/clear_gpu_health', methods=['POST'])
+@login_required
+def clear_gpu_health_route():
+    """Return a GPU excluded as unhealthy to allocation"""
+    username = session['username']
+    authorized_users = config('PRIVILEGED_USERS', cast=Csv())
+    if username not in authorized_users:
+        logger.warning(f"Unauthorized GPU health clear attempt by user {username}")
+        flash('You are not authorized to perform this action', 'error')
+        return redirect(url_for('dashboard.dashboard'))
+    
+    gpu_id = request.form.get('gpu_id', type=int)
+    if gpu_id is None:
+        flash('Invalid GPU ID', 'error')
+    elif clear_gpu_health(gpu_id, username):
+        flash(f'GPU {gpu_id} is available for allocation again', 'success')
+    else:
+        flash(f'GPU {gpu_id} is not marked unhealthy', 'info')
+    return redirect(url_for('dashboard.dashboard'))
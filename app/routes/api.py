@@ -1,7 +1,114 @@
-from flask import Blueprint, session, redirect, url_for, flash
+from flask import Blueprint, session, redirect, url_for, flash, request, jsonify
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
 from app.utils.gpu_monitoring import get_gpu_status
+from app.utils.db import MongoDBConnection
+from app.utils.rollups import get_utilization_series
+from app.utils.health import get_gpu_health,get_gpu_health_history
+from app.utils.energy import get_energy_leaderboard
+from app.utils.release_jobs import get_job_status
+from app.utils.bookings import find_free_slot
+from decouple import config, Csv
+from app.routes.auth import login_required
 api_bp = Blueprint('api', __name__)
+
+# History endpoints serve at most this many hours, longer ranges would read every rollup bucket
+MAX_HISTORY_HOURS = 24 * 90
+
+def _history_hours():
+    return min(max(request.args.get('hours', 24, type=int), 1), MAX_HISTORY_HOURS)
+
 @api_bp.route('/api/gpu_status')
 def api_gpu_status():
     """API endpoint to get GPU status in JSON format"""
-    return get_gpu_status()
\ No newline at end of file
+    return get_gpu_status()
+
+@api_bp.route('/api/gpu_utilization_history')
+@login_required
+def api_gpu_utilization_history():
+    """API endpoint to get the utilization history of a GPU or an allocation"""
+    username = session['username']
+    hours = _history_hours()
+    gpu_id = request.args.get('gpu_id', type=int)
+    allocation_id = request.args.get('allocation_id')
+    if gpu_id is None and not allocation_id:
+        return jsonify({"message": "gpu_id or allocation_id is required", "status": "error"}), 400
+    
+    end = datetime.now()
+    start = end - timedelta(hours=hours)
+    with MongoDBConnection() as (client, db):
+        # The history of an allocation is its owner's, GPU-wide history is public
+        if allocation_id:
+            try:
+                allocation = db.gpu_allocations.find_one({'_id': ObjectId(allocation_id)}, {'username': 1})
+            except InvalidId:
+                allocation = None
+            if allocation is None:
+                return jsonify({"message": "Allocation not found", "status": "error"}), 404
+            if allocation['username'] != username and username not in config('PRIVILEGED_USERS', cast=Csv()):
+                return jsonify({"message": "You are not authorized to view this allocation", "status": "error"}), 403
+        series = get_utilization_series(db, start, end, allocation_id=allocation_id, gpu_id=gpu_id)
+    return jsonify(series)
+
+@api_bp.route('/api/gpu_health')
+def api_gpu_health():
+    """API endpoint to get the health state of every GPU"""
+    return jsonify(get_gpu_health())
+
+@api_bp.route('/api/gpu_health_history')
+@login_required
+def api_gpu_health_history():
+    """API endpoint to get the health readings of a GPU"""
+    hours = _history_hours()
+    gpu_id = request.args.get('gpu_id', type=int)
+    if gpu_id is None:
+        return jsonify({"message": "gpu_id is required", "status": "error"}), 400
+    
+    end = datetime.now()
+    start = end - timedelta(hours=hours)
+    with MongoDBConnection() as (client, db):
+        series = get_gpu_health_history(db, gpu_id, start, end)
+    return jsonify(series)
+
+@api_bp.route('/api/energy_leaderboard')
+@login_required
+def api_energy_leaderboard():
+    """API endpoint to rank users by the energy their allocations drew"""
+    days = request.args.get('days', 30, type=int)
+    end = datetime.now()
+    start = end - timedelta(days=days)
+    with MongoDBConnection() as (client, db):
+        leaderboard = get_energy_leaderboard(db, start, end)
+    return jsonify(leaderboard)
+
+@api_bp.route('/api/booking_slot')
+@login_required
+def api_booking_slot():
+    """API endpoint to find the earliest window in which GPUs of a type can be booked"""
+    gpu_type = request.args.get('gpu_type')
+    count = request.args.get('count', 1, type=int)
+    days = request.args.get('days', 1, type=int)
+    if not gpu_type:
+        return jsonify({"message": "gpu_type is required", "status": "error"}), 400
+    with MongoDBConnection() as (client, db):
+        start = find_free_slot(db, gpu_type, count, days)
+    if start is None:
+        return jsonify({"message": f"There aren't {count} {gpu_type} GPUs", "status": "error"}), 404
+    return jsonify({"gpu_type": gpu_type, "count": count, "start": start.isoformat(), "end": (start + timedelta(days=days)).isoformat()})
+
+@api_bp.route('/api/job_status')
+@login_required
+def api_job_status():
+    """API endpoint to poll a background job, e.g. a GPU release"""
+    username = session['username']
+    job_id = request.args.get('job_id')
+    status = get_job_status(job_id) if job_id else None
+    if status is None or status['status'] in ('finished', 'failed', 'stopped', 'canceled'):
+        # Done or expired, the dashboard stops polling it
+        session['pending_jobs'] = [pending for pending in session.get('pending_jobs', []) if pending != job_id]
+    if status is None:
+        return jsonify({"message": "Job not found", "status": "error"}), 404
+    if status['requested_by'] != username and username not in config('PRIVILEGED_USERS', cast=Csv()):
+        return jsonify({"message": "You are not authorized to view this job", "status": "error"}), 403
+    return jsonify(status)
@@ -4,17 +4,32 @@ from decouple import config,Csv
 from app.utils.logger import logger
 import jdatetime
 import pymongo
-from app.utils.gpu_monitoring import get_gpu_status,unallocate_gpu,get_gpu_config,set_available_gpus,set_gpu_permission,allocate_gpu
+from app.utils.gpu_monitoring import get_gpu_status,get_gpu_config,allocate_gpus
 from app.utils.db import *
-from app.utils.redis_utils import DistributedLock
+from app.utils.redis_utils import claim_gpus,return_gpus,GPULease
+from app.utils.release_jobs import submit_release
+from app.utils.waitlist import join_waitlist,leave_waitlist,get_waitlist,dispatch_waitlist,reserved_for_waitlist
+from app.utils.quotas import check_quota,get_quota_status,quota_lock
+from app.utils.bookings import create_booking,cancel_booking,get_bookings,booked_gpus
+from app.utils.sharing import allocate_shared_gpu,get_sharing_modes,format_unit
+from app.utils.idempotency import idempotent,new_idempotency_key
+from app.utils.expiry import index_expiration
+from contextlib import ExitStack
 from app.config import REDIS_CLIENT,REDIS_KEYS,DISK_CACHE_TIMEOUT
 from app.utils.disk import get_disk_cache,get_user_disk_usage,set_disk_cache,update_user_disk_cache
 from app.routes.auth import login_required
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from app.utils.gpu_monitoring import get_available_gpus
+from app.utils.telemetry import read_user_gpu_memory
+from app.utils.health import get_unhealthy_gpus,get_gpu_health
 from app.utils.notification import get_unread_notifications_count
 dashboard_bp = Blueprint('dashboard', __name__,static_url_path="dashboard")
+
+@dashboard_bp.app_context_processor
+def inject_idempotency_key():
+    # Forms that change allocations carry a key so resubmitting them doesn't repeat the change
+    return {'new_idempotency_key': new_idempotency_key}
 @dashboard_bp.route('/')
 def index():
     """Root route that redirects to the login page"""
@@ -32,9 +47,13 @@ def schedule():
             # Format dates for display
             formatted_allocations = format_allocations_for_display(allocations)
             
+            # Bookings that haven't started yet
+            bookings = format_bookings_for_display(get_bookings(db))
+            
     except Exception as e:
         logger.error(f"Error fetching schedule: {str(e)}")
         formatted_allocations = []
+        bookings = []
     
     # Get initial GPU status for first page load
     gpu_status = get_gpu_status()
@@ -48,6 +67,7 @@ def schedule():
     
     return render_template('schedule.html', 
                           allocations=formatted_allocations,
+                          bookings=bookings,
                           gpu_status=gpu_status,
                           refresh_rate_ms=refresh_rate_ms,
                           unread_notifications_count=unread_count)
@@ -156,8 +176,10 @@ def dashboard():
             else:
                 all_users = []
             
-            # Get available GPUs from Redis
-            available_gpus = get_available_gpus()
+            # Get available GPUs from Redis, without the ones excluded as unhealthy
+            unhealthy_gpus = get_unhealthy_gpus()
+            available_gpus = {gpu_type: [gpu_id for gpu_id in gpu_ids if gpu_id not in unhealthy_gpus]
+                              for gpu_type, gpu_ids in get_available_gpus().items()}
             
             # Get user's disk usage from Redis cache
             disk_usage_data = get_disk_cache(username)
@@ -179,19 +201,21 @@ def dashboard():
             # Get unread notifications count
             unread_count = get_unread_notifications_count(username)
             
-            # Get GPU status from Redis or calculate
-            gpu_status_key = REDIS_KEYS['gpu_status']
-            gpu_status = REDIS_CLIENT.get(gpu_status_key)
-            if gpu_status:
-                gpu_status = json.loads(gpu_status)
-            else:
-                gpu_status = get_gpu_status()
-                # Cache GPU status for a short time (e.g., 5 seconds)
-                REDIS_CLIENT.setex(gpu_status_key, 5, json.dumps(gpu_status))
+            # Get GPU status from the telemetry snapshot in Redis
+            gpu_status = get_gpu_status()
+            
+            # GPU memory held by the user's processes, as attributed by the telemetry collector
+            user_gpu_memory = read_user_gpu_memory(username)
+            allocated_gpu_ids = [allocation['gpu_id'] for allocation in active_allocations]
             
-            # Check if user is registered for notifications
-            user_notif_entry = db.gpu_notif_list.find_one({'username': username})
-            is_registered_for_notifications = user_notif_entry is not None
+            # Waiting requests, with their place among the requests of the same type
+            waitlist = get_waitlist(db)
+            positions = {}
+            for waiting in waitlist:
+                positions[waiting['gpu_type']] = positions.get(waiting['gpu_type'], 0) + 1
+                waiting['position'] = positions[waiting['gpu_type']]
+            user_waitlist = [waiting for waiting in waitlist if waiting['username'] == username]
+            user_bookings = format_bookings_for_display(get_bookings(db, username=username))
             return render_template('dashboard.html',
                                 username=username,
                                 gpu_dict=available_gpus,
@@ -205,8 +229,17 @@ def dashboard():
                                 disk_usage=disk_usage_data,
                                 unread_notifications_count=unread_count,
                                 gpu_status=gpu_status,
+                                user_gpu_memory=user_gpu_memory,
+                                gpu_health=get_gpu_health() if is_admin else {},
+                                allocated_gpu_ids=allocated_gpu_ids,
                                 now=datetime.now(),
-                                is_registered_for_notifications=is_registered_for_notifications,
+                                pending_jobs=session.get('pending_jobs', []),
+                                gpu_config=get_gpu_config(),
+                                user_waitlist=user_waitlist,
+                                user_bookings=user_bookings,
+                                quota=get_quota_status(username),
+                                sharing_modes=get_sharing_modes(),
+                                waitlist=waitlist if is_admin else [],
                                 all_users=all_users)
             
     except Exception as e:
@@ -216,6 +249,7 @@ def dashboard():
 
 @dashboard_bp.route('/release_gpu', methods=['POST'])
 @login_required
+@idempotent
 def release_gpu():
     username = session['username']
     allocation_id = request.form.get('allocation_id')
@@ -249,15 +283,14 @@ def release_gpu():
         if is_admin and username != user_username:
             comment = f"Released by admin :{username}"
         
-        # Use the common unallocate function with the comment
-        if unallocate_gpu(user_username, gpu_id, gpu_type, allocation_id, db, comment=comment):
-            if is_admin and username != user_username:
-                flash(f'Successfully released GPU {gpu_id} from user {user_username}', 'success')
-                logger.info(f"Admin {username} released GPU {gpu_id} from user {user_username}")
-            else:
-                flash(f'Successfully released GPU {gpu_id}', 'success')
+        # Release on the RQ worker, the dashboard polls the job status
+        job_id = submit_release(allocation_id, comment, requested_by=username)
+        session['pending_jobs'] = [pending for pending in session.get('pending_jobs', []) if pending != job_id] + [job_id]
+        if is_admin and username != user_username:
+            flash(f'Releasing GPU {gpu_id} from user {user_username}', 'info')
+            logger.info(f"Admin {username} requested release of GPU {gpu_id} from user {user_username}")
         else:
-            flash('Failed to release GPU', 'error')
+            flash(f'Releasing GPU {gpu_id}', 'info')
                 
     except Exception as e:
         logger.error(f"Error in release_gpu route: {str(e)}")
@@ -270,6 +303,7 @@ def release_gpu():
 
 @dashboard_bp.route('/extend_gpu', methods=['POST'])
 @login_required
+@idempotent
 def extend_gpu():
     username = session['username']
     allocation_id = request.form.get('allocation_id')
@@ -307,13 +341,17 @@ def extend_gpu():
                 return redirect(url_for('dashboard.dashboard'))
             
             # Calculate new expiration time
-            from datetime import timedelta
             current_expiration = allocation['expiration_time']
             new_expiration = current_expiration + timedelta(days=extension_days)
             if datetime.now() < current_expiration:
                 flash('GPU is not expired yet', 'error')
                 logger.warning(f"User {username} tried to extend GPU {allocation['gpu_id']} but it is not expired yet")
                 return redirect(url_for('dashboard.dashboard'))
+            # The extension can't run into a booking of the GPU
+            if booked_gpus([allocation['gpu_id']], datetime.now(), new_expiration):
+                flash('GPU is booked by another user during the extension', 'error')
+                logger.warning(f"User {username} tried to extend GPU {allocation['gpu_id']} into a booking")
+                return redirect(url_for('dashboard.dashboard'))
             # Update the allocation
             result = db.gpu_allocations.update_one(
                 {'_id': ObjectId(allocation_id)},
@@ -321,6 +359,7 @@ def extend_gpu():
             )
             
             if result.modified_count > 0:
+                index_expiration(allocation_id, new_expiration)
                 gpu_id = allocation['gpu_id']
                 gpu_type = allocation['gpu_type']
                 user_username = allocation['username']
@@ -342,6 +381,7 @@ def extend_gpu():
 
 @dashboard_bp.route('/lock_gpu', methods=['POST'])
 @login_required
+@idempotent
 def lock_gpu():
     requested_gpu_dict = {}
     requested_days = {}
@@ -358,6 +398,8 @@ def lock_gpu():
     if not is_admin:
         target_user = username
     
+    # Quota locks are held from the quota check until the GPUs are allocated
+    quota_locks = ExitStack()
     try:
         # Get GPU configuration from Redis
         gpu_config = get_gpu_config()
@@ -392,104 +434,86 @@ def lock_gpu():
         
         logger.info(f"User {username} requested GPUs: {requested_gpu_dict} for days: {requested_days}")
         
-        # Use distributed lock for the entire allocation process
-        with DistributedLock(REDIS_KEYS['gpu_lock']):
-            # Get current available GPUs from Redis
-            available_gpus = get_available_gpus()
-            if not available_gpus:
-                flash("No GPUs available at the moment", "error")
+        # Validate against GPU configuration
+        for gpu_type, count in requested_gpu_dict.items():
+            if count > 0 and gpu_type not in gpu_config:
+                flash(f"Invalid GPU type: {gpu_type}", "error")
                 return redirect(url_for('dashboard.dashboard'))
-            
-            # Validate against GPU configuration
-            for gpu_type, count in requested_gpu_dict.items():
-                if count > 0:
-                    # Check if GPU type exists
-                    if gpu_type not in gpu_config:
-                        flash(f"Invalid GPU type: {gpu_type}", "error")
-                        return redirect(url_for('dashboard.dashboard'))
-                    
-                    # Check if enough GPUs are available
-                    if gpu_type not in available_gpus or len(available_gpus[gpu_type]) < count:
-                        flash(f"Not enough {gpu_type} GPUs available", "error")
+        
+        # Quotas only bind regular users, admins can always allocate
+        if not is_admin:
+            quota_locks.enter_context(quota_lock(target_user))
+            allowed, message = check_quota(target_user, sum(requested_gpu_dict.values()),
+                                           sum(count * requested_days[gpu_type] * 24 for gpu_type, count in requested_gpu_dict.items()))
+            if not allowed:
+                flash(message, "error")
+                return redirect(url_for('dashboard.dashboard'))
+        
+        # GPUs with a booking starting before the allocation would end are left to the booking
+        now = datetime.now()
+        booked = set()
+        for gpu_type, count in requested_gpu_dict.items():
+            if count > 0:
+                booked |= booked_gpus(gpu_config[gpu_type], now, now + timedelta(days=requested_days[gpu_type]))
+        unhealthy_gpus = get_unhealthy_gpus()
+        
+        # Free GPUs owed to waiting users with a higher fair-share priority can't be taken
+        if not is_admin:
+            available_gpus = get_available_gpus()
+            with MongoDBConnection() as (client, db):
+                for gpu_type, count in requested_gpu_dict.items():
+                    if count <= 0:
+                        continue
+                    free = len([gpu_id for gpu_id in available_gpus.get(gpu_type, []) if gpu_id not in unhealthy_gpus and gpu_id not in booked])
+                    reserved = reserved_for_waitlist(db, gpu_type, target_user)
+                    if free - count < reserved:
+                        flash(f"Not enough {gpu_type} GPUs available, {reserved} are owed to waiting users with a higher priority. Join the waitlist to get them in turn", "error")
                         return redirect(url_for('dashboard.dashboard'))
-            
-            # Track successful allocations for rollback
-            successful_allocations = []
-            allocated_gpus = {}
-            
+        
+        # Claim every requested GPU in one atomic step. Unhealthy GPUs stay in
+        # the pool but are skipped until an admin clears them
+        allocated_gpus, short_type = claim_gpus(requested_gpu_dict, exclude=unhealthy_gpus | booked)
+        if allocated_gpus is None:
+            if booked & set(gpu_config[short_type]):
+                flash(f"Not enough {short_type} GPUs available, some are booked within the next {requested_days[short_type]} days", "error")
+            else:
+                flash(f"Not enough {short_type} GPUs available", "error")
+            return redirect(url_for('dashboard.dashboard'))
+        
+        gpus = [(gpu_type, gpu_id, requested_days[gpu_type])
+                for gpu_type, gpu_ids in allocated_gpus.items() for gpu_id in gpu_ids]
+        
+        # Leases on the claimed GPUs are held until the allocation succeeded or was rolled back
+        with ExitStack() as stack:
             try:
-                with MongoDBConnection() as (client, db):
-                    # Perform allocations
-                    for gpu_type, count in requested_gpu_dict.items():
-                        if count > 0:
-                            allocated_gpus[gpu_type] = []
-                            
-                            for _ in range(count):
-                                if not available_gpus[gpu_type]:
-                                    raise Exception(f"No more {gpu_type} GPUs available")
-                                
-                                gpu_id = available_gpus[gpu_type].pop(0)
-                                
-                                # Verify GPU ID is valid according to configuration
-                                if gpu_id not in gpu_config[gpu_type]:
-                                    raise Exception(f"Invalid GPU ID {gpu_id} for type {gpu_type}")
-                                
-                                # Allocate GPU to user
-                                success, result = allocate_gpu(
-                                    target_user,
-                                    gpu_type,
-                                    gpu_id,
-                                    requested_days[gpu_type]
-                                )
-                                
-                                if success:
-                                    successful_allocations.append({
-                                        'gpu_type': gpu_type,
-                                        'gpu_id': gpu_id,
-                                        'allocation_id': result
-                                    })
-                                    allocated_gpus[gpu_type].append(gpu_id)
-                                else:
-                                    # Put GPU back in available pool
-                                    available_gpus[gpu_type].append(gpu_id)
-                                    raise Exception(f"Failed to allocate GPU {gpu_id}: {result}")
-                    
-                    # Update available GPUs in Redis
-                    set_available_gpus(available_gpus)
-                    
-                    if allocated_gpus:
-                        if is_admin and target_user != username:
-                            logger.info(f"Admin {username} allocated GPU {gpu_id} to user {target_user}")
-                            flash(f"Successfully allocated GPUs: {allocated_gpus} to user {target_user} with expiration times: {requested_days} days", "success")
-                        else:
-                            flash(f"Successfully allocated GPUs: {allocated_gpus} with expiration times: {requested_days} days", "success")
+                # Verify GPU IDs are valid according to configuration
+                for gpu_type, gpu_id, _ in gpus:
+                    if gpu_id not in gpu_config[gpu_type]:
+                        raise Exception(f"Invalid GPU ID {gpu_id} for type {gpu_type}")
+                
+                leases = {gpu_id: stack.enter_context(GPULease(gpu_id)) for _, gpu_id, _ in gpus}
+                
+                # Allocate all GPUs to user as one unit, it undoes its own steps on failure
+                success, result = allocate_gpus(target_user, gpus, leases=leases)
+                if not success:
+                    raise Exception(result)
+                
+                if allocated_gpus:
+                    if is_admin and target_user != username:
+                        logger.info(f"Admin {username} allocated GPUs {allocated_gpus} to user {target_user}")
+                        flash(f"Successfully allocated GPUs: {allocated_gpus} to user {target_user} with expiration times: {requested_days} days", "success")
                     else:
-                        flash("No GPUs were allocated", "info")
-                    
-                    return redirect(url_for('dashboard.dashboard'))
-                    
+                        flash(f"Successfully allocated GPUs: {allocated_gpus} with expiration times: {requested_days} days", "success")
+                else:
+                    flash("No GPUs were allocated", "info")
+                
+                return redirect(url_for('dashboard.dashboard'))
+                
             except Exception as e:
-                # Rollback all successful allocations
                 logger.error(f"Error during GPU allocation: {str(e)}")
                 
-                with MongoDBConnection() as (client, db):
-                    for alloc in successful_allocations:
-                        try:
-                            # Remove GPU access
-                            set_gpu_permission(target_user, alloc['gpu_id'], grant=False)
-                            
-                            # Remove database entry
-                            db.gpu_allocations.delete_one({'_id': alloc['allocation_id']})
-                            
-                            # Return GPU to available pool
-                            available_gpus[alloc['gpu_type']].append(alloc['gpu_id'])
-                            
-                            logger.debug(f"Rolled back allocation for GPU {alloc['gpu_id']}")
-                        except Exception as rollback_error:
-                            logger.error(f"Error during rollback: {str(rollback_error)}")
-                    
-                    # Update available GPUs in Redis after rollback
-                    set_available_gpus(available_gpus)
+                # Return every claimed GPU to the available pool
+                return_gpus([(gpu_type, gpu_id) for gpu_type, gpu_id, _ in gpus])
                 
                 flash(f"Failed to allocate GPUs: {str(e)}", "error")
                 return redirect(url_for('dashboard.dashboard'))
@@ -498,27 +522,144 @@ def lock_gpu():
         logger.error(f"Unexpected error in lock_gpu: {str(e)}")
         flash("An unexpected error occurred", "error")
         return redirect(url_for('dashboard.dashboard'))
+    finally:
+        quota_locks.close()
 
-@dashboard_bp.route('/notify_user', methods=['POST'])
+@dashboard_bp.route('/lock_shared_gpu', methods=['POST'])
 @login_required
-def notify_user():
-    from flask import jsonify
+@idempotent
+def lock_shared_gpu():
+    """Allocate a MIG instance or a time slice of a GPU instead of a whole GPU"""
     username = session['username']
+    is_admin = username in config('PRIVILEGED_USERS', cast=Csv())
+    gpu_type = request.form.get('gpu_type', '')
+    days = request.form.get('days', '0')
+    try:
+        memory_gb = float(request.form.get('memory_gb', '0'))
+    except ValueError:
+        memory_gb = 0
+    if not days.isdigit():
+        flash("Invalid input values", "error")
+        return redirect(url_for('dashboard.dashboard'))
     
+    quota_locks = ExitStack()
     try:
+        # A share counts as a GPU towards the quota
+        if not is_admin:
+            quota_locks.enter_context(quota_lock(username))
+            allowed, message = check_quota(username, 1, int(days) * 24)
+            if not allowed:
+                flash(message, "error")
+                return redirect(url_for('dashboard.dashboard'))
         with MongoDBConnection() as (client, db):
-            existing_entry = db.gpu_notif_list.find_one({'username': username})
-                
-            if not existing_entry:
-                db.gpu_notif_list.insert_one({'username': username})
-                logger.info(f"User '{username}' successfully registered for GPU availability notifications.")
-                return jsonify({"message": "You will be notified when GPUs are available.", "status": "success"})
+            # Free GPUs owed to waiting users with a higher priority aren't turned into shared ones
+            take_free = True
+            if not is_admin:
+                unhealthy_gpus = get_unhealthy_gpus()
+                free = len([gpu_id for gpu_id in get_available_gpus().get(gpu_type, []) if gpu_id not in unhealthy_gpus])
+                take_free = free > reserved_for_waitlist(db, gpu_type, username)
+            success, result = allocate_shared_gpu(db, username, gpu_type, memory_gb, int(days), take_free=take_free)
+        if not success:
+            flash(result, "error")
+        else:
+            gpu_id, unit = result
+            flash(f"Successfully allocated GPU {format_unit(dict(unit, gpu_id=gpu_id))} for {days} days", "success")
+    except Exception as e:
+        logger.error(f"Error allocating a shared GPU to user {username}: {str(e)}")
+        flash("Failed to allocate a shared GPU", "error")
+    finally:
+        quota_locks.close()
+    return redirect(url_for('dashboard.dashboard'))
+
+@dashboard_bp.route('/join_waitlist', methods=['POST'])
+@login_required
+def join_waitlist_route():
+    """Wait for GPUs, they are allocated automatically once enough are free"""
+    username = session['username']
+    gpu_type = request.form.get('gpu_type', '')
+    count = request.form.get('count', '0')
+    days = request.form.get('days', '0')
+    if not count.isdigit() or not days.isdigit():
+        flash("Invalid input values", "error")
+        return redirect(url_for('dashboard.dashboard'))
+    
+    try:
+        with MongoDBConnection() as (client, db):
+            success, result = join_waitlist(db, username, gpu_type, int(count), int(days))
+        if not success:
+            flash(result, "error")
+            return redirect(url_for('dashboard.dashboard'))
+        # GPUs may already be free
+        enqueue_job(dispatch_waitlist)
+        flash(f"You will get {count} {gpu_type} GPU(s) as soon as they are free", "success")
+    except Exception as e:
+        logger.error(f"Error adding user {username} to the waitlist: {str(e)}")
+        flash("Failed to join the waitlist", "error")
+    return redirect(url_for('dashboard.dashboard'))
+
+@dashboard_bp.route('/leave_waitlist', methods=['POST'])
+@login_required
+def leave_waitlist_route():
+    """Cancel a waiting GPU request, admins can cancel anyone's"""
+    username = session['username']
+    is_admin = username in config('PRIVILEGED_USERS', cast=Csv())
+    try:
+        with MongoDBConnection() as (client, db):
+            if leave_waitlist(db, request.form.get('request_id'), username=None if is_admin else username):
+                flash("Request cancelled", "success")
+            else:
+                flash("Invalid request or it was already granted", "error")
+    except Exception as e:
+        logger.error(f"Error cancelling waitlist request: {str(e)}")
+        flash("Failed to cancel the request", "error")
+    return redirect(url_for('dashboard.dashboard'))
+
+@dashboard_bp.route('/book_gpu', methods=['POST'])
+@login_required
+@idempotent
+def book_gpu():
+    """Book GPUs for a future window, they are allocated automatically when it starts"""
+    username = session['username']
+    gpu_type = request.form.get('gpu_type', '')
+    count = request.form.get('count', '0')
+    days = request.form.get('days', '0')
+    if not count.isdigit() or not days.isdigit():
+        flash("Invalid input values", "error")
+        return redirect(url_for('dashboard.dashboard'))
+    try:
+        start = datetime.strptime(request.form.get('start', ''), '%Y-%m-%dT%H:%M')
+    except ValueError:
+        flash("Invalid start time", "error")
+        return redirect(url_for('dashboard.dashboard'))
+    
+    try:
+        with MongoDBConnection() as (client, db):
+            success, result = create_booking(db, username, gpu_type, int(count), start, int(days))
+        if not success:
+            flash(result, "error")
+        else:
+            flash(f"Booked {count} {gpu_type} GPU(s) from {start.strftime('%Y-%m-%d %H:%M')} for {days} days", "success")
+    except Exception as e:
+        logger.error(f"Error booking GPUs for user {username}: {str(e)}")
+        flash("Failed to book GPUs", "error")
+    return redirect(url_for('dashboard.dashboard'))
+
+@dashboard_bp.route('/cancel_booking', methods=['POST'])
+@login_required
+def cancel_booking_route():
+    """Cancel a booking that hasn't started, admins can cancel anyone's"""
+    username = session['username']
+    is_admin = username in config('PRIVILEGED_USERS', cast=Csv())
+    try:
+        with MongoDBConnection() as (client, db):
+            if cancel_booking(db, request.form.get('booking_id'), username=None if is_admin else username):
+                flash("Booking cancelled", "success")
             else:
-                logger.warning(f"User '{username}' attempted to register for notifications multiple times.")
-                return jsonify({"message": "You are already registered for notifications.", "status": "info"})
+                flash("Invalid booking or it has already started", "error")
     except Exception as e:
-        logger.error(f"Error adding user to notification list: {str(e)}")
-        return jsonify({"message": "Failed to register for notifications.", "status": "error"}), 500
+        logger.error(f"Error cancelling booking: {str(e)}")
+        flash("Failed to cancel the booking", "error")
+    return redirect(url_for('dashboard.dashboard'))
 
 def format_allocations_for_display(allocations):
     """Format allocation dates for display using jdatetime or regular datetime based on config"""
@@ -542,9 +683,23 @@ def format_allocations_for_display(allocations):
             if allocation.get('released_at'):
                 allocation['released_at_str'] = allocation['released_at'].strftime('%Y-%m-%d %H:%M:%S')
                 
+        allocation['gpu_label'] = format_unit(allocation)
         if allocation.get('comment'):
             allocation['comment_str'] = allocation['comment']
         else:
             allocation['comment_str'] = '-'    
     return allocations
 
+def format_bookings_for_display(bookings):
+    """Format booking windows for display the same way as allocation dates"""
+    use_jalali = config('USE_JALALI_DATES', default=True, cast=bool)
+    
+    for booking in bookings:
+        for field in ('start', 'end'):
+            if use_jalali:
+                booking[f'{field}_str'] = jdatetime.datetime.fromgregorian(
+                    datetime=booking[field]).strftime('%Y-%m-%d %H:%M')
+            else:
+                booking[f'{field}_str'] = booking[field].strftime('%Y-%m-%d %H:%M')
+        booking['gpu_ids_str'] = ', '.join(str(gpu_id) for gpu_id in booking['gpu_ids'])
+    return bookings
@@ -0,0 +1,293 @@
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+import pymongo
+from bson import ObjectId
+from decouple import config
+from app.utils.logger import logger
+from app.utils import notification
+from app.utils.db import MongoDBConnection
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.redis_utils import DistributedLock, GPULease, claim_specific_gpus, return_gpus, get_gpu_config
+from app.utils.gpu_monitoring import allocate_gpus, unallocate_gpu, on_allocation_released
+from app.utils.topology import get_gpu_topology, place_gpus
+
+# Bookings of a GPU never overlap, so the interval index of a GPU is a sorted
+# set of its bookings scored by start time whose members carry the end time.
+# Sorted by start they are also sorted by end, which makes overlap and
+# next-booking queries a single O(log n) range lookup.
+
+def _index_key(gpu_id):
+    return f"{REDIS_KEYS['gpu_bookings']}:{gpu_id}"
+
+def _index_member(booking_id, end):
+    return f"{booking_id}:{end.timestamp()}"
+
+def _parse_member(member, score):
+    booking_id, _, end = member.rpartition(':')
+    return booking_id, datetime.fromtimestamp(score), datetime.fromtimestamp(float(end))
+
+def find_overlapping_booking(gpu_id, start, end):
+    """Find the booking of a GPU overlapping [start, end)
+
+    Returns:
+        tuple: (booking_id, start, end) of the overlapping booking, or None
+    """
+    # Only the last booking starting before end can overlap, the ones before it end before it starts
+    last = REDIS_CLIENT.zrevrangebyscore(_index_key(gpu_id), f"({end.timestamp()}", '-inf', start=0, num=1, withscores=True)
+    if last:
+        booking = _parse_member(*last[0])
+        if booking[2] > start:
+            return booking
+    return None
+
+def next_booking(gpu_id, after):
+    """Get the first booking of a GPU ending after a time
+
+    Returns:
+        tuple: (booking_id, start, end), or None if the GPU has no later booking
+    """
+    overlapping = find_overlapping_booking(gpu_id, after, after + timedelta(microseconds=1))
+    if overlapping:
+        return overlapping
+    upcoming = REDIS_CLIENT.zrangebyscore(_index_key(gpu_id), after.timestamp(), '+inf', start=0, num=1, withscores=True)
+    return _parse_member(*upcoming[0]) if upcoming else None
+
+def booked_gpus(gpu_ids, start, end):
+    """Get the GPUs that have a booking overlapping [start, end)
+
+    Returns:
+        set: IDs of the booked GPUs
+    """
+    return {gpu_id for gpu_id in gpu_ids if find_overlapping_booking(gpu_id, start, end)}
+
+def _busy_until(db, gpu_ids):
+    """Expiration time of the active allocation of each GPU"""
+    return {allocation['gpu_id']: allocation['expiration_time'] for allocation in
+            db.gpu_allocations.find({'gpu_id': {'$in': list(gpu_ids)}, 'released_at': None}, {'gpu_id': 1, 'expiration_time': 1})}
+
+def _free_gpus(db, gpu_ids, start, end):
+    """GPUs with no booking in [start, end) and no allocation running past start"""
+    busy_until = _busy_until(db, gpu_ids)
+    return [gpu_id for gpu_id in gpu_ids
+            if busy_until.get(gpu_id, start) <= start and not find_overlapping_booking(gpu_id, start, end)]
+
+def find_free_slot(db, gpu_type, count, days, after=None):
+    """Find the earliest start at which enough GPUs of a type are free for a duration
+
+    Args:
+        db: MongoDB database connection
+        gpu_type: Type of GPU
+        count: Number of GPUs needed
+        days: Length of the window
+        after: Earliest acceptable start (default: now)
+
+    Returns:
+        datetime: Earliest start, or None if the type doesn't have enough GPUs
+    """
+    gpu_ids = get_gpu_config().get(gpu_type, [])
+    if count > len(gpu_ids):
+        return None
+    duration = timedelta(days=days)
+    busy_until = _busy_until(db, gpu_ids)
+    # Every window boundary is a candidate start: the earliest one where enough GPUs are free wins
+    candidates = {after or datetime.now()}
+    candidates.update(until for until in busy_until.values() if until > min(candidates))
+    for gpu_id in gpu_ids:
+        for member, _ in REDIS_CLIENT.zrangebyscore(_index_key(gpu_id), min(candidates).timestamp(), '+inf', withscores=True):
+            candidates.add(datetime.fromtimestamp(float(member.rpartition(':')[2])))
+    for start in sorted(candidates):
+        if len(_free_gpus(db, gpu_ids, start, start + duration)) >= count:
+            return start
+    return None
+
+def create_booking(db, username, gpu_type, count, start, days):
+    """Book GPUs of a type for a future window
+
+    Args:
+        db: MongoDB database connection
+        username: User the GPUs are booked for
+        gpu_type: Type of GPU
+        count: Number of GPUs
+        start: Start of the window
+        days: Length of the window in days
+
+    Returns:
+        tuple: (success, booking_id or error_message)
+    """
+    gpu_config = get_gpu_config()
+    if gpu_type not in gpu_config:
+        return False, f"Invalid GPU type: {gpu_type}"
+    if count <= 0 or count > len(gpu_config[gpu_type]):
+        return False, f"Number of {gpu_type} GPUs must be between 1 and {len(gpu_config[gpu_type])}"
+    if days <= 0 or days > 7:
+        return False, "Number of days must be between 1 and 7"
+    max_ahead = config('BOOKING_MAX_DAYS_AHEAD', default=30, cast=int)
+    if start < datetime.now() or start > datetime.now() + timedelta(days=max_ahead):
+        return False, f"Bookings must start within the next {max_ahead} days"
+    end = start + timedelta(days=days)
+
+    # Serialize bookings so two of them can't take the same free GPU
+    with DistributedLock(REDIS_KEYS['booking_lock']):
+        free_gpus = _free_gpus(db, gpu_config[gpu_type], start, end)
+        if len(free_gpus) < count:
+            slot = find_free_slot(db, gpu_type, count, days, after=start)
+            suggestion = f", the earliest free window starts {slot.strftime('%Y-%m-%d %H:%M')}" if slot else ""
+            return False, f"Not enough {gpu_type} GPUs free in that window{suggestion}"
+        gpu_ids = place_gpus(free_gpus, count, get_gpu_topology())
+        booking_id = db.gpu_bookings.insert_one({
+            'username': username,
+            'gpu_type': gpu_type,
+            'gpu_ids': gpu_ids,
+            'start': start,
+            'end': end,
+            'status': 'booked',
+            'created_at': datetime.now()
+        }).inserted_id
+        pipe = REDIS_CLIENT.pipeline()
+        for gpu_id in gpu_ids:
+            pipe.zadd(_index_key(gpu_id), {_index_member(booking_id, end): start.timestamp()})
+        pipe.execute()
+    logger.info(f"User {username} booked {gpu_type} GPUs {gpu_ids} from {start} to {end}")
+    return True, booking_id
+
+def _remove_from_index(booking):
+    pipe = REDIS_CLIENT.pipeline()
+    for gpu_id in booking['gpu_ids']:
+        pipe.zrem(_index_key(gpu_id), _index_member(booking['_id'], booking['end']))
+    pipe.execute()
+
+def cancel_booking(db, booking_id, username=None):
+    """Cancel a booking that hasn't started yet
+
+    Args:
+        db: MongoDB database connection
+        booking_id: ID of the booking
+        username: Only cancel the booking if it belongs to this user (None for admins)
+
+    Returns:
+        bool: True if the booking was cancelled
+    """
+    query = {'_id': ObjectId(booking_id), 'status': 'booked'}
+    if username is not None:
+        query['username'] = username
+    booking = db.gpu_bookings.find_one_and_update(query, {'$set': {'status': 'cancelled', 'cancelled_at': datetime.now()}})
+    if not booking:
+        return False
+    _remove_from_index(booking)
+    logger.info(f"Booking {booking_id} of {booking['username']} cancelled")
+    return True
+
+def get_bookings(db, username=None):
+    """Get the bookings that haven't started yet, soonest first"""
+    query = {'status': 'booked'}
+    if username is not None:
+        query['username'] = username
+    return list(db.gpu_bookings.find(query).sort('start', pymongo.ASCENDING))
+
+def _activate_booking(db, booking, now):
+    gpu_ids = booking['gpu_ids']
+    # The previous holders' allocations end before the booking starts, release them if they haven't been yet
+    for allocation in db.gpu_allocations.find({'gpu_id': {'$in': gpu_ids}, 'released_at': None}):
+        if allocation['expiration_time'] <= booking['start']:
+            unallocate_gpu(allocation['username'], allocation['gpu_id'], allocation['gpu_type'], allocation['_id'], db,
+                           comment=f"Released for a booking of {booking['username']}")
+
+    if not claim_specific_gpus([(booking['gpu_type'], gpu_id) for gpu_id in gpu_ids]):
+        logger.warning(f"GPUs {gpu_ids} of booking {booking['_id']} are not free yet, retrying later")
+        return False
+    days = (booking['end'] - now).total_seconds() / 86400
+    try:
+        with ExitStack() as stack:
+            leases = {gpu_id: stack.enter_context(GPULease(gpu_id)) for gpu_id in gpu_ids}
+            success, result = allocate_gpus(booking['username'], [(booking['gpu_type'], gpu_id, days, {'booking_id': booking['_id']}) for gpu_id in gpu_ids], leases=leases)
+        if not success:
+            raise Exception(result)
+    except Exception as e:
+        logger.error(f"Failed to activate booking {booking['_id']}: {str(e)}")
+        return_gpus([(booking['gpu_type'], gpu_id) for gpu_id in gpu_ids])
+        return False
+
+    db.gpu_bookings.update_one({'_id': booking['_id']}, {'$set': {'status': 'active', 'activated_at': now, 'allocation_ids': result}})
+    logger.info(f"Activated booking {booking['_id']}: {booking['gpu_type']} GPUs {gpu_ids} for {booking['username']}")
+    notification.send_notification(booking['username'],
+                                   f"Your booking of {booking['gpu_type']} GPU {', '.join(str(gpu_id) for gpu_id in gpu_ids)} has started and lasts until {booking['end'].strftime('%Y-%m-%d %H:%M')}.")
+    return True
+
+@on_allocation_released
+def release_booked_gpu(db, allocation):
+    """Give back the rest of a booking's window when its GPU is released early
+
+    The GPU's index entry is dropped so others can book or get it, and the
+    booking is done once none of its allocations is active anymore.
+
+    Args:
+        db: MongoDB database connection
+        allocation: The released allocation document
+    """
+    if allocation.get('booking_id') is None:
+        return
+    booking = db.gpu_bookings.find_one({'_id': allocation['booking_id'], 'status': 'active'})
+    if not booking:
+        return
+    REDIS_CLIENT.zrem(_index_key(allocation['gpu_id']), _index_member(booking['_id'], booking['end']))
+    if not db.gpu_allocations.count_documents({'_id': {'$in': booking.get('allocation_ids', [])}, 'released_at': None}):
+        db.gpu_bookings.update_one({'_id': booking['_id'], 'status': 'active'}, {'$set': {'status': 'done', 'done_at': datetime.now()}})
+        logger.info(f"Booking {booking['_id']} of {booking['username']} is done, its GPUs were released")
+
+def activate_due_bookings():
+    """Turn the bookings whose window has started into allocations
+
+    Bookings that can't be activated are retried on the next run until their
+    window is over. Index entries of bookings that ended are dropped.
+
+    Returns:
+        int: Number of bookings activated
+    """
+    activated = 0
+    try:
+        now = datetime.now()
+        with MongoDBConnection() as (client, db):
+            for booking in db.gpu_bookings.find({'status': 'booked', 'start': {'$lte': now}}).sort('start', pymongo.ASCENDING):
+                if booking['end'] <= now:
+                    db.gpu_bookings.update_one({'_id': booking['_id']}, {'$set': {'status': 'missed'}})
+                    _remove_from_index(booking)
+                    logger.warning(f"Booking {booking['_id']} of {booking['username']} ended before it could be activated")
+                    notification.send_notification(booking['username'], f"Your booking of {booking['gpu_type']} GPUs could not be activated because the GPUs were not free.")
+                    continue
+                if _activate_booking(db, booking, now):
+                    activated += 1
+
+            # Bookings are at most 7 days long, so everything starting before that has ended
+            horizon = (now - timedelta(days=7)).timestamp()
+            pipe = REDIS_CLIENT.pipeline()
+            for gpu_ids in get_gpu_config().values():
+                for gpu_id in gpu_ids:
+                    pipe.zremrangebyscore(_index_key(gpu_id), '-inf', f"({horizon}")
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to activate bookings: {str(e)}")
+    return activated
+
+def rebuild_booking_index():
+    """Rebuild the interval index of every GPU from the gpu_bookings collection"""
+    try:
+        with MongoDBConnection() as (client, db):
+            bookings = list(db.gpu_bookings.find({'status': {'$in': ['booked', 'active']}, 'end': {'$gt': datetime.now()}}))
+            # GPUs of an active booking released early are free for the rest of its window
+            held = {(allocation['booking_id'], allocation['gpu_id']) for allocation in db.gpu_allocations.find(
+                {'booking_id': {'$in': [booking['_id'] for booking in bookings]}, 'released_at': None}, {'booking_id': 1, 'gpu_id': 1})}
+        pipe = REDIS_CLIENT.pipeline()
+        for gpu_ids in get_gpu_config().values():
+            for gpu_id in gpu_ids:
+                pipe.delete(_index_key(gpu_id))
+        for booking in bookings:
+            for gpu_id in booking['gpu_ids']:
+                if booking['status'] == 'active' and (booking['_id'], gpu_id) not in held:
+                    continue
+                pipe.zadd(_index_key(gpu_id), {_index_member(booking['_id'], booking['end']): booking['start'].timestamp()})
+        pipe.execute()
+        logger.info(f"Rebuilt booking index with {len(bookings)} bookings")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to rebuild booking index: {str(e)}")
+        return False
@@ -3,6 +3,7 @@ from contextlib import contextmanager
 from datetime import datetime, timedelta
 from app.utils.logger import logger
 from bson import ObjectId
+from decouple import config
 class MongoDBConnection:
     def __init__(self):
         self.client = None
@@ -34,9 +35,17 @@ def setup_database():
             
         if 'users' not in db.list_collection_names():
             db.create_collection('users')
-        if 'gpu_notif_list' not in db.list_collection_names():
-            db.create_collection('gpu_notif_list')
-            # Initialize with the list of users
+        # Requests waiting for GPUs to be freed
+        if 'gpu_requests' not in db.list_collection_names():
+            db.create_collection('gpu_requests')
+        db.gpu_requests.create_index([('status', 1), ('requested_at', 1)])
+        db.gpu_requests.create_index([('username', 1), ('status', 1)])
+        # Advance reservations of GPUs
+        if 'gpu_bookings' not in db.list_collection_names():
+            db.create_collection('gpu_bookings')
+        db.gpu_bookings.create_index([('status', 1), ('start', 1)])
+        db.gpu_bookings.create_index([('username', 1), ('status', 1)])
+        # Initialize with the list of users
         default_users = [
             "root", "sync", "user01", "admin", "zteam", "ehsan", "amin", 
             "khalooei", "armin", "mabanayeean", "mirzaei", "hosna", 
@@ -54,6 +63,24 @@ def setup_database():
             
         if 'notifications' not in db.list_collection_names():
             db.create_collection('notifications')
+        
+        # GPU memory used by each user's processes, per GPU
+        if 'gpu_user_memory' not in db.list_collection_names():
+            db.create_collection('gpu_user_memory')
+        ttl_days = config('GPU_USER_MEMORY_HISTORY_DAYS', default=7, cast=int)
+        db.gpu_user_memory.create_index('timestamp', expireAfterSeconds=ttl_days * 24 * 60 * 60)
+        db.gpu_user_memory.create_index([('username', 1), ('timestamp', 1)])
+        
+        # Health readings (temperature, clocks, throttling, ECC) per GPU
+        if 'gpu_health' not in db.list_collection_names():
+            db.create_collection('gpu_health')
+        ttl_days = config('GPU_HEALTH_HISTORY_DAYS', default=30, cast=int)
+        db.gpu_health.create_index('timestamp', expireAfterSeconds=ttl_days * 24 * 60 * 60)
+        db.gpu_health.create_index([('gpu_id', 1), ('timestamp', 1)])
+        
+        # Raw utilization samples and their minute/hour rollups
+        from app.utils.rollups import setup_utilization_collections
+        setup_utilization_collections(db)
             
         logger.info("Database setup complete")
     finally:
@@ -62,13 +89,15 @@ def setup_database():
     
 
 
-def update_allocation_status(db, allocation_id, released=True, comment=None):
+def update_allocation_status(db, allocation_id, released=True, comment=None, fencing_token=None):
     """Update the status of a GPU allocation in the database
     Args:
         db: MongoDB database connection
         allocation_id: ID of the allocation to update
         released: True to mark as released, False to mark as active
         comment: Optional comment explaining the status change
+        fencing_token: Token of the GPU lease the update is made under. The
+            update is rejected if the allocation was written under a newer lease
     Returns:
         bool: Success status
     """
@@ -80,13 +109,18 @@ def update_allocation_status(db, allocation_id, released=True, comment=None):
                 update_data['comment'] = comment
         else:
             update_data['released_at'] = None
+        
+        query = {'_id': ObjectId(allocation_id) if isinstance(allocation_id, str) else allocation_id}
+        if fencing_token is not None:
+            query['$or'] = [{'fencing_token': None}, {'fencing_token': {'$lte': fencing_token}}]
+            update_data['fencing_token'] = fencing_token
             
-        db.gpu_allocations.update_one(
-            {'_id': ObjectId(allocation_id) if isinstance(allocation_id, str) else allocation_id},
-            {'$set': update_data}
-        )
+        result = db.gpu_allocations.update_one(query, {'$set': update_data})
+        if fencing_token is not None and result.matched_count == 0:
+            logger.error(f"Rejected update of allocation {allocation_id} under stale fencing token {fencing_token}")
+            return False
         logger.debug(f"Updated allocation {allocation_id} status: released={released}, comment={comment}")
         return True
     except Exception as e:
         logger.error(f"Failed to update allocation status: {str(e)}")
-        return False
\ No newline at end of file
+        return False
@@ -1,8 +1,8 @@
 from app.config import REDIS_BINARY,REDIS_KEYS,DISK_CACHE_TIMEOUT
 import pwd
 import shutil
-import subprocess
 from app.utils.logger import logger
+from app.utils.privileged import get_privileged_helper
 import pickle
 def format_size(size_bytes):
     """Format bytes to human-readable size
@@ -73,13 +73,9 @@ def get_user_disk_usage(username):
             # Get total disk usage for the filesystem
             total, used_total, free = shutil.disk_usage(home_dir)
             
-            # Get user's specific usage by running du command
-            du_process = subprocess.run(
-                ['sudo', 'du', '-sb', home_dir],
-                capture_output=True, text=True,
-            )
+            # Get user's specific usage from the privileged helper
             try:
-                user_used = int(du_process.stdout.split()[0])
+                user_used = int(get_privileged_helper().disk_usage(username))
             except Exception as e:
                 logger.error(f"Error calculating disk usage for {username}: {str(e)}")
                 return (0, 0, 0)
@@ -104,7 +100,7 @@ def get_user_disk_usage(username):
             
             return disk_data
             
-        except (subprocess.CalledProcessError, ValueError) as e:
+        except (KeyError, ValueError) as e:
             logger.error(f"Error calculating disk usage for {username}: {str(e)}")
             return (0, 0, 0)
             
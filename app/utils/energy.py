@@ -0,0 +1,126 @@
+from bson import ObjectId
+from decouple import config
+from app.utils.logger import logger
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.rollups import tier_collection
+
+class GPUEnergyMeter:
+    """Integrates the power draw of every GPU into watt-hours
+
+    Samples are integrated with the trapezoidal rule as they arrive, so no
+    power series needs to be kept. Gaps longer than max_gap seconds (e.g.
+    while the collector was down) are not integrated.
+    """
+    def __init__(self, max_gap=10.0):
+        self.max_gap = max_gap
+        self._last = {}
+        self._pending = {}
+
+    def add(self, gpu_id, timestamp, power_draw):
+        if power_draw is None:
+            return
+        last = self._last.get(gpu_id)
+        self._last[gpu_id] = (timestamp, power_draw)
+        if last is None:
+            return
+        elapsed = timestamp - last[0]
+        if 0 < elapsed <= self.max_gap:
+            self._pending[gpu_id] = self._pending.get(gpu_id, 0.0) + (last[1] + power_draw) / 2 * elapsed / 3600
+
+    def drain(self):
+        """Get the watt-hours integrated per GPU since the last drain
+
+        Returns:
+            dict: {gpu_id: Wh}
+        """
+        pending, self._pending = self._pending, {}
+        return pending
+
+def publish_gpu_energy(energy):
+    """Add integrated watt-hours to the monotonic per-GPU energy counters in Redis
+
+    Args:
+        energy: {gpu_id: Wh} as returned by GPUEnergyMeter.drain()
+    """
+    if not energy:
+        return
+    pipe = REDIS_CLIENT.pipeline()
+    for gpu_id, watt_hours in energy.items():
+        pipe.hincrbyfloat(REDIS_KEYS['gpu_energy'], gpu_id, watt_hours)
+    pipe.execute()
+
+def read_gpu_energy(gpu_id):
+    """Read the energy counter of a GPU
+
+    Returns:
+        float: Watt-hours the GPU drew since the counter was created
+    """
+    energy = REDIS_CLIENT.hget(REDIS_KEYS['gpu_energy'], gpu_id)
+    return float(energy) if energy else 0.0
+
+def record_allocation_energy(db, allocation_id):
+    """Write the energy drawn during an allocation onto its document
+
+    The energy is the difference between the GPU's energy counter now and
+    when the allocation was made ('energy_start_wh'). A MIG instance or time
+    slice is charged its 'energy_share' of it, the other tenants of the GPU
+    drew the rest.
+
+    Args:
+        db: MongoDB database connection
+        allocation_id: ID of the allocation being released
+
+    Returns:
+        float: Energy in kWh, or None if it can't be determined
+    """
+    try:
+        allocation_id = ObjectId(allocation_id) if isinstance(allocation_id, str) else allocation_id
+        allocation = db.gpu_allocations.find_one({'_id': allocation_id}, {'gpu_id': 1, 'energy_start_wh': 1, 'energy_share': 1})
+        if not allocation or allocation.get('energy_start_wh') is None:
+            return None
+        watt_hours = read_gpu_energy(allocation['gpu_id']) - allocation['energy_start_wh']
+        if watt_hours < 0:
+            # The counter was reset (e.g. Redis was flushed) during the allocation
+            logger.warning(f"Energy counter of GPU {allocation['gpu_id']} went backwards, not recording energy of {allocation_id}")
+            return None
+        energy_kwh = watt_hours * allocation.get('energy_share', 1.0) / 1000
+        db.gpu_allocations.update_one({'_id': allocation_id}, {'$set': {'energy_kwh': energy_kwh}})
+        return energy_kwh
+    except Exception as e:
+        logger.error(f"Failed to record energy of allocation {allocation_id}: {str(e)}")
+        return None
+
+def get_energy_leaderboard(db, start, end):
+    """Rank users by the energy their allocations drew, from the hourly rollups
+
+    Every utilization sample stands for GPU_ACTIVITY_CHECK_MINUTES of use,
+    so a bucket's energy is the sum of its power samples times that period,
+    times the 'energy_share' of the GPU for MIG instances and time slices.
+
+    Args:
+        db: MongoDB database connection
+        start: Start of the period
+        end: End of the period
+
+    Returns:
+        list: {'username', 'energy_kwh', 'gpu_hours', 'mean_power'} dicts, highest energy first
+    """
+    sample_hours = config('GPU_ACTIVITY_CHECK_MINUTES', default=5, cast=int) / 60
+    pipeline = [
+        {'$match': {'meta.scope': 'allocation', 'timestamp': {'$gte': start, '$lt': end}}},
+        {'$group': {
+            '_id': '$meta.username',
+            'power_sum': {'$sum': {'$multiply': ['$power_draw.sum', {'$ifNull': ['$meta.energy_share', 1]}]}},
+            'count': {'$sum': '$count'}
+        }}
+    ]
+    leaderboard = []
+    for row in db[tier_collection('1h')].aggregate(pipeline):
+        leaderboard.append({
+            'username': row['_id'],
+            'energy_kwh': row['power_sum'] * sample_hours / 1000,
+            'gpu_hours': row['count'] * sample_hours,
+            'mean_power': row['power_sum'] / row['count'] if row['count'] else 0
+        })
+    leaderboard.sort(key=lambda entry: entry['energy_kwh'], reverse=True)
+    return leaderboard
@@ -0,0 +1,121 @@
+import math
+from datetime import datetime, timedelta
+from decouple import config
+from app.utils.logger import logger
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.db import MongoDBConnection
+
+# Active allocations are indexed in a sorted set scored by the time they
+# become reclaimable, their expiration plus USER_LOCKOUT_HOURS. Allocating,
+# extending and releasing keep it up to date, so finding the due ones is a
+# range query over the expiring allocations instead of a scan of all of them.
+
+# Takes the due allocations and pushes them back by a retry delay in one
+# step, so each is handled by a single caller and one whose handling
+# crashed comes due again instead of being lost.
+# KEYS: expiry index. ARGV: now, retry time, most allocations to take
+_CLAIM_DUE_SCRIPT = REDIS_CLIENT.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, allocation_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[2], allocation_id)
+end
+return due
+""")
+
+# Retry delay of a claimed allocation whose handling didn't finish
+_CLAIM_RETRY_SECONDS = 300
+
+def reclaimable_at(expiration_time):
+    """Time at which an allocation expiring at expiration_time can be reclaimed"""
+    return expiration_time + timedelta(hours=config('USER_LOCKOUT_HOURS', default=24, cast=int))
+
+def _wake_expiry_loop():
+    # Only the newest wake-up matters
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.lpush(REDIS_KEYS['expiry_wakeup'], 1)
+    pipe.ltrim(REDIS_KEYS['expiry_wakeup'], 0, 0)
+    pipe.execute()
+
+def index_expiration(allocation_id, expiration_time):
+    """Add or move an allocation in the expiry index
+
+    Args:
+        allocation_id: ID of the allocation
+        expiration_time: Current expiration time of the allocation
+    """
+    try:
+        score = reclaimable_at(expiration_time).timestamp()
+        earliest = REDIS_CLIENT.zrange(REDIS_KEYS['expiry_index'], 0, 0, withscores=True)
+        REDIS_CLIENT.zadd(REDIS_KEYS['expiry_index'], {str(allocation_id): score})
+        # The expiry loop sleeps until the earliest entry, wake it if this one comes first
+        if not earliest or score < earliest[0][1]:
+            _wake_expiry_loop()
+    except Exception as e:
+        logger.error(f"Failed to index expiration of allocation {allocation_id}: {str(e)}")
+
+def unindex_expiration(allocation_id):
+    """Remove a released allocation from the expiry index"""
+    try:
+        REDIS_CLIENT.zrem(REDIS_KEYS['expiry_index'], str(allocation_id))
+    except Exception as e:
+        logger.error(f"Failed to remove allocation {allocation_id} from the expiry index: {str(e)}")
+
+def claim_due_expirations(now=None, limit=100):
+    """Take the allocations that have become reclaimable
+
+    They stay in the index, pushed back by a few minutes, until they are
+    released, rescheduled or unindexed.
+
+    Returns:
+        list: String IDs of the due allocations
+    """
+    now = now or datetime.now()
+    return _CLAIM_DUE_SCRIPT(keys=[REDIS_KEYS['expiry_index']],
+                             args=[now.timestamp(), now.timestamp() + _CLAIM_RETRY_SECONDS, limit])
+
+def reschedule_expiration(allocation_id, when):
+    """Check an allocation again at a later time"""
+    REDIS_CLIENT.zadd(REDIS_KEYS['expiry_index'], {str(allocation_id): when.timestamp()})
+
+def seconds_until_next_expiration(now=None):
+    """Seconds until the earliest allocation becomes reclaimable, None if nothing is indexed"""
+    earliest = REDIS_CLIENT.zrange(REDIS_KEYS['expiry_index'], 0, 0, withscores=True)
+    if not earliest:
+        return None
+    return max(0.0, earliest[0][1] - (now or datetime.now()).timestamp())
+
+def wait_for_expiration(max_seconds):
+    """Sleep until the earliest allocation becomes reclaimable or the index gets an earlier one
+
+    Args:
+        max_seconds: Longest time to sleep
+    """
+    timeout = seconds_until_next_expiration()
+    timeout = max_seconds if timeout is None else min(timeout, max_seconds)
+    if timeout <= 0:
+        return
+    # BLPOP returns early when index_expiration adds an earlier entry. It
+    # takes whole seconds and 0 would block forever
+    REDIS_CLIENT.blpop(REDIS_KEYS['expiry_wakeup'], timeout=max(1, math.ceil(timeout)))
+
+def rebuild_expiry_index():
+    """Rebuild the expiry index from the active allocations, run once at startup
+
+    Returns:
+        bool: True if the index was rebuilt
+    """
+    try:
+        with MongoDBConnection() as (client, db):
+            allocations = list(db.gpu_allocations.find({'released_at': None}, {'expiration_time': 1}))
+        pipe = REDIS_CLIENT.pipeline()
+        pipe.delete(REDIS_KEYS['expiry_index'])
+        if allocations:
+            pipe.zadd(REDIS_KEYS['expiry_index'], {str(allocation['_id']): reclaimable_at(allocation['expiration_time']).timestamp()
+                                                    for allocation in allocations})
+        pipe.execute()
+        _wake_expiry_loop()
+        logger.info(f"Rebuilt expiry index with {len(allocations)} allocations")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to rebuild expiry index: {str(e)}")
+        return False
@@ -0,0 +1,521 @@
+import json
+import re
+import subprocess
+import threading
+import time
+from decouple import config
+from app.utils.logger import logger
+from app.utils.privileged import get_privileged_helper, HelperError
+
+try:
+    import pynvml
+except ImportError:  # nvidia-ml-py is optional, nvidia-smi is used without it
+    pynvml = None
+
+# Health fields reported by query_gpus() next to utilization and memory
+HEALTH_FIELDS = ('temperature', 'sm_clock', 'max_sm_clock', 'throttle_reasons', 'ecc_errors', 'retired_pages_pending')
+
+class GPUBackend:
+    """Interface for querying the GPUs of this host
+
+    Memory values are always reported in MiB, utilization in percent,
+    power draw in watts, temperatures in degrees Celsius and clocks in MHz.
+    Utilization, power and health fields a GPU can't report (e.g.
+    utilization in MIG mode, ECC on consumer cards) are None.
+    """
+    name = None
+
+    def query_gpus(self):
+        """Query the status of every GPU
+
+        Returns:
+            list: One {'index', 'utilization', 'memory_used', 'memory_total', 'power_draw'}
+                  dict per GPU, plus the HEALTH_FIELDS
+        """
+        raise NotImplementedError
+
+    def query_compute_apps(self, gpu_ids=None):
+        """Query the compute processes running on the GPUs
+
+        Args:
+            gpu_ids: Optional list of GPU indexes to restrict the query to
+
+        Returns:
+            list: One {'gpu_id', 'pid', 'used_memory'} dict per process
+        """
+        raise NotImplementedError
+
+    def query_topology(self):
+        """Query how every pair of GPUs is connected
+
+        Links use the names of `nvidia-smi topo -m`: 'X' for the GPU itself,
+        'NV<n>' for n bonded NVLinks, then 'PIX', 'PXB', 'PHB', 'NODE' and
+        'SYS' for PCIe paths through ever more distant bridges.
+
+        Returns:
+            dict: {gpu_id: {gpu_id: link}} for every pair of GPUs
+        """
+        raise NotImplementedError
+
+    def query_mig_instances(self):
+        """Query the MIG GPU instances set up on the GPUs
+
+        GPUs in MIG mode can only be used through their instances. GPUs
+        without MIG have none.
+
+        Returns:
+            list: One {'gpu_id', 'instance_id', 'profile', 'memory_total'} dict per instance
+        """
+        return []
+
+    def sample_gpu(self, gpu_id, duration=1.0, interval=0.1):
+        """Sample a single GPU repeatedly over a short period
+
+        Args:
+            gpu_id: GPU index to sample
+            duration: Sampling period in seconds
+            interval: Seconds between two samples
+
+        Returns:
+            list: (utilization, memory_used) tuples
+        """
+        samples = []
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for gpu in self.query_gpus():
+                if gpu['index'] == gpu_id and gpu['utilization'] is not None:
+                    samples.append((gpu['utilization'], gpu['memory_used']))
+            time.sleep(interval)
+        return samples
+
+    def stream_gpus(self, interval=0.5):
+        """Continuously sample every GPU
+
+        Args:
+            interval: Seconds between two samples
+
+        Yields:
+            list: The query_gpus() result of each sample
+        """
+        while True:
+            started = time.monotonic()
+            yield self.query_gpus()
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+def _optional_number(value, cast=float):
+    # nvidia-smi prints [N/A] or [Not Supported] for fields a GPU can't report
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+def query_compute_apps_as_root(gpu_ids, uuid_to_index):
+    """Query the compute processes of all users through the privileged helper
+
+    Other users' processes are only visible to root, to NVML as much as to nvidia-smi.
+
+    Args:
+        gpu_ids: Optional list of GPU indexes to restrict the query to
+        uuid_to_index: {GPU UUID: index} of this host's GPUs
+
+    Returns:
+        list: One {'gpu_id', 'pid', 'used_memory'} dict per process
+    """
+    return [{'gpu_id': uuid_to_index[process['gpu_uuid']], 'pid': process['pid'], 'used_memory': process['used_memory']}
+            for process in get_privileged_helper().gpu_processes(gpu_ids) if process['gpu_uuid'] in uuid_to_index]
+
+def parse_mig_instances(output):
+    """Parse the GPU instance table printed by `nvidia-smi mig -lgi`
+
+    The memory of an instance is taken from its profile name, e.g. 20 GiB for 3g.20gb.
+
+    Returns:
+        list: One {'gpu_id', 'instance_id', 'profile', 'memory_total'} dict per instance
+    """
+    instances = []
+    for match in re.finditer(r'^\|\s*(\d+)\s+MIG\s+(\S+)\s+\d+\s+(\d+)\s+\d+:\d+\s*\|', output, re.MULTILINE):
+        memory = re.search(r'\.(\d+)gb', match.group(2))
+        instances.append({
+            'gpu_id': int(match.group(1)),
+            'instance_id': int(match.group(3)),
+            'profile': match.group(2),
+            'memory_total': float(memory.group(1)) * 1024 if memory else None
+        })
+    return instances
+
+def parse_topology_matrix(output):
+    """Parse the GPU to GPU part of the `nvidia-smi topo -m` matrix
+
+    Args:
+        output: Text printed by `nvidia-smi topo -m`
+
+    Returns:
+        dict: {gpu_id: {gpu_id: link}}, NIC rows and columns and the affinity columns are dropped
+    """
+    lines = [line for line in output.splitlines() if line.strip()]
+    header = next((line.split() for line in lines if line.split() and line.split()[0].startswith('GPU')), None)
+    if header is None:
+        return {}
+    columns = [int(name[3:]) if name.startswith('GPU') and name[3:].isdigit() else None
+               for name in header if name.startswith(('GPU', 'NIC', 'mlx'))]
+    topology = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) < 2 or not parts[0].startswith('GPU') or not parts[0][3:].isdigit():
+            continue
+        links = {gpu_id: link for gpu_id, link in zip(columns, parts[1:]) if gpu_id is not None}
+        topology[int(parts[0][3:])] = links
+    return topology
+
+class NvidiaSmiBackend(GPUBackend):
+    """Backend forking nvidia-smi for every query"""
+    name = 'nvidia-smi'
+    query = ('index,utilization.gpu,memory.used,memory.total,temperature.gpu,clocks.sm,clocks.max.sm,'
+             'clocks_throttle_reasons.active,ecc.errors.uncorrected.volatile.total,retired_pages.pending,power.draw')
+
+    def __init__(self):
+        self._uuid_to_index = None
+
+    def _run(self, args):
+        return subprocess.run(['nvidia-smi'] + args, capture_output=True, text=True, check=True).stdout
+
+    @staticmethod
+    def _parse_csv(output):
+        for line in output.strip().split('\n'):
+            if line.strip():
+                yield [part.strip() for part in line.split(',')]
+
+    @staticmethod
+    def _parse_gpu(parts):
+        return {
+            'index': int(parts[0]),
+            'utilization': _optional_number(parts[1]),
+            'memory_used': float(parts[2]),
+            'memory_total': float(parts[3]),
+            'temperature': _optional_number(parts[4]),
+            'sm_clock': _optional_number(parts[5]),
+            'max_sm_clock': _optional_number(parts[6]),
+            'throttle_reasons': _optional_number(parts[7], lambda value: int(value, 16)),
+            'ecc_errors': _optional_number(parts[8], int),
+            'retired_pages_pending': parts[9] == 'Yes' if parts[9] in ('Yes', 'No') else None,
+            'power_draw': _optional_number(parts[10])
+        }
+
+    def query_gpus(self):
+        output = self._run([f'--query-gpu={self.query}', '--format=csv,noheader,nounits'])
+        gpus = []
+        for parts in self._parse_csv(output):
+            if len(parts) < 11:
+                continue
+            try:
+                gpus.append(self._parse_gpu(parts))
+            except ValueError:
+                # Only this GPU is left out, e.g. one reporting [GPU is lost]
+                logger.warning(f"Skipping GPU with unreadable status: {', '.join(parts)}")
+        return gpus
+
+    def query_topology(self):
+        return parse_topology_matrix(self._run(['topo', '-m']))
+
+    def query_mig_instances(self):
+        # Listing GPU instances needs root
+        try:
+            return parse_mig_instances(get_privileged_helper().mig_instances())
+        except HelperError as e:
+            logger.warning(f"Could not list MIG instances: {str(e)}")
+            return []
+
+    def stream_gpus(self, interval=0.5):
+        # One long-lived nvidia-smi looping by itself, parsed line by line
+        gpu_count = len(self.query_gpus())
+        process = subprocess.Popen(
+            ['nvidia-smi', f'--query-gpu={self.query}',
+             '--format=csv,noheader,nounits', '-lms', str(int(interval * 1000))],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1
+        )
+        try:
+            batch = []
+            for line in process.stdout:
+                parts = [part.strip() for part in line.split(',')]
+                if len(parts) < 11:
+                    continue
+                try:
+                    sample = self._parse_gpu(parts)
+                except ValueError:
+                    # Skip values like [N/A] or [GPU is lost]
+                    continue
+                # nvidia-smi prints every GPU once per loop, in index order
+                if batch and sample['index'] <= batch[-1]['index']:
+                    yield batch
+                    batch = []
+                batch.append(sample)
+                if len(batch) >= gpu_count:
+                    yield batch
+                    batch = []
+        finally:
+            process.kill()
+            process.wait()
+
+    def _gpu_index_by_uuid(self):
+        # Compute apps are reported by GPU UUID, which never changes while the host is up
+        if self._uuid_to_index is None:
+            output = self._run(['--query-gpu=index,uuid', '--format=csv,noheader'])
+            self._uuid_to_index = {parts[1]: int(parts[0]) for parts in self._parse_csv(output) if len(parts) >= 2}
+        return self._uuid_to_index
+
+    def query_compute_apps(self, gpu_ids=None):
+        return query_compute_apps_as_root(gpu_ids, self._gpu_index_by_uuid())
+
+    def sample_gpu(self, gpu_id, duration=1.0, interval=0.1):
+        # Let nvidia-smi loop itself instead of forking once per sample
+        output = subprocess.run(
+            ['timeout', f'{duration}s', 'nvidia-smi',
+             f'--id={gpu_id}', '--query-gpu=utilization.gpu,memory.used',
+             '--format=csv,noheader,nounits', '-lms', str(int(interval * 1000))],
+            capture_output=True, text=True, check=False,
+        ).stdout
+        samples = [(_optional_number(parts[0]), _optional_number(parts[1])) for parts in self._parse_csv(output) if len(parts) >= 2]
+        return [sample for sample in samples if None not in sample]
+
+class NVMLBackend(GPUBackend):
+    """In-process backend using NVML, no fork/exec per query"""
+    name = 'nvml'
+
+    def __init__(self):
+        if pynvml is None:
+            raise RuntimeError("nvidia-ml-py is not installed")
+        pynvml.nvmlInit()
+        self._handles = [pynvml.nvmlDeviceGetHandleByIndex(index) for index in range(pynvml.nvmlDeviceGetCount())]
+        self._uuid_to_index = {}
+        for index, handle in enumerate(self._handles):
+            uuid = pynvml.nvmlDeviceGetUUID(handle)
+            self._uuid_to_index[uuid.decode() if isinstance(uuid, bytes) else uuid] = index
+
+    @staticmethod
+    def _optional(query, *args):
+        # Health queries raise NVMLError_NotSupported on GPUs lacking the feature
+        try:
+            return query(*args)
+        except pynvml.NVMLError:
+            return None
+
+    def query_gpus(self):
+        gpus = []
+        for index, handle in enumerate(self._handles):
+            try:
+                memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+            except pynvml.NVMLError as e:
+                # Only this GPU is left out, e.g. one that fell off the bus
+                logger.warning(f"Skipping GPU {index} with unreadable memory: {str(e)}")
+                continue
+            retired_pages_pending = self._optional(pynvml.nvmlDeviceGetRetiredPagesPendingStatus, handle)
+            gpus.append({
+                'index': index,
+                # Not supported in MIG mode
+                'utilization': self._optional(lambda: float(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)),
+                'memory_used': memory.used / 1024 ** 2,
+                'memory_total': memory.total / 1024 ** 2,
+                'temperature': self._optional(pynvml.nvmlDeviceGetTemperature, handle, pynvml.NVML_TEMPERATURE_GPU),
+                'sm_clock': self._optional(pynvml.nvmlDeviceGetClockInfo, handle, pynvml.NVML_CLOCK_SM),
+                'max_sm_clock': self._optional(pynvml.nvmlDeviceGetMaxClockInfo, handle, pynvml.NVML_CLOCK_SM),
+                'throttle_reasons': self._optional(pynvml.nvmlDeviceGetCurrentClocksThrottleReasons, handle),
+                'ecc_errors': self._optional(pynvml.nvmlDeviceGetTotalEccErrors, handle,
+                                             pynvml.NVML_MEMORY_ERROR_TYPE_UNCORRECTED, pynvml.NVML_VOLATILE_ECC),
+                'retired_pages_pending': None if retired_pages_pending is None else bool(retired_pages_pending),
+                'power_draw': self._optional(lambda: pynvml.nvmlDeviceGetPowerUsage(handle) / 1000)  # mW
+            })
+        return gpus
+
+    def query_topology(self):
+        levels = {
+            pynvml.NVML_TOPOLOGY_INTERNAL: 'X',
+            pynvml.NVML_TOPOLOGY_SINGLE: 'PIX',
+            pynvml.NVML_TOPOLOGY_MULTIPLE: 'PXB',
+            pynvml.NVML_TOPOLOGY_HOSTBRIDGE: 'PHB',
+            pynvml.NVML_TOPOLOGY_NODE: 'NODE',
+            pynvml.NVML_TOPOLOGY_SYSTEM: 'SYS'
+        }
+        # NVLinks are found by the PCI bus of the GPU at the other end of each active link
+        bus_ids = {self._bus_id(pynvml.nvmlDeviceGetPciInfo(handle)): index for index, handle in enumerate(self._handles)}
+        topology = {}
+        for index, handle in enumerate(self._handles):
+            nvlinks = {}
+            for link in range(pynvml.NVML_NVLINK_MAX_LINKS):
+                if self._optional(pynvml.nvmlDeviceGetNvLinkState, handle, link) != pynvml.NVML_FEATURE_ENABLED:
+                    continue
+                remote = self._optional(pynvml.nvmlDeviceGetNvLinkRemotePciInfo, handle, link)
+                peer = bus_ids.get(self._bus_id(remote)) if remote else None
+                if peer is not None:
+                    nvlinks[peer] = nvlinks.get(peer, 0) + 1
+            topology[index] = {}
+            for peer, peer_handle in enumerate(self._handles):
+                if peer in nvlinks:
+                    topology[index][peer] = f"NV{nvlinks[peer]}"
+                elif peer == index:
+                    topology[index][peer] = 'X'
+                else:
+                    level = self._optional(pynvml.nvmlDeviceGetTopologyCommonAncestor, handle, peer_handle)
+                    topology[index][peer] = levels.get(level, 'SYS')
+        return topology
+
+    def query_mig_instances(self):
+        instances = []
+        for index, handle in enumerate(self._handles):
+            mode = self._optional(pynvml.nvmlDeviceGetMigMode, handle)
+            if not mode or mode[0] != pynvml.NVML_DEVICE_MIG_ENABLE:
+                continue
+            for position in range(pynvml.nvmlDeviceGetMaxMigDeviceCount(handle)):
+                mig_handle = self._optional(pynvml.nvmlDeviceGetMigDeviceHandleByIndex, handle, position)
+                if mig_handle is None:
+                    continue
+                name = pynvml.nvmlDeviceGetName(mig_handle)
+                name = name.decode() if isinstance(name, bytes) else name
+                instances.append({
+                    'gpu_id': index,
+                    'instance_id': pynvml.nvmlDeviceGetGpuInstanceId(mig_handle),
+                    'profile': name.split('MIG ')[-1],
+                    'memory_total': pynvml.nvmlDeviceGetMemoryInfo(mig_handle).total / 1024 ** 2
+                })
+        return instances
+
+    @staticmethod
+    def _bus_id(pci_info):
+        bus_id = pci_info.busId.decode() if isinstance(pci_info.busId, bytes) else pci_info.busId
+        # The remote PCI info of a link pads the domain with fewer zeros
+        return bus_id.lower()[-12:]
+
+    def query_compute_apps(self, gpu_ids=None):
+        # NVML running as the app user only sees its own processes
+        return query_compute_apps_as_root(gpu_ids, self._uuid_to_index)
+
+class FakeGPUBackend(GPUBackend):
+    """Deterministic backend replaying a recorded trace, for hosts without GPUs
+
+    A trace is a dict of the form::
+
+        {
+            "gpus": {"0": {"memory_total": 24564}},
+            "frames": [
+                {"gpus": {"0": {"utilization": 0, "memory_used": 3, "temperature": 41}},
+                 "processes": [{"gpu_id": 0, "pid": 1234, "used_memory": 300}]}
+            ]
+        }
+
+    Every call to query_gpus() moves to the next frame, looping at the end
+    of the trace. query_compute_apps() reports the processes of the frame
+    query_gpus() last returned, or of the first frame before it is called.
+    The topology is the trace's optional "topology" entry, shaped like the
+    query_topology() result, or the `nvidia-smi topo -m` output saved in
+    topology_file. Without either every pair of GPUs is linked through 'SYS'.
+    MIG instances come from the optional "mig" entry, shaped like the
+    query_mig_instances() result.
+    """
+    name = 'fake'
+
+    def __init__(self, trace=None, trace_file=None, topology_file=None):
+        if trace is None:
+            with open(trace_file) as f:
+                trace = json.load(f)
+        self.gpus = {int(gpu_id): info for gpu_id, info in trace['gpus'].items()}
+        self.frames = trace.get('frames') or [{}]
+        self.position = 0
+        self._lock = threading.Lock()
+        self.mig_instances = [dict(instance) for instance in trace.get('mig', [])]
+        if topology_file:
+            with open(topology_file) as f:
+                self.topology = parse_topology_matrix(f.read())
+        else:
+            self.topology = {int(gpu_id): {int(peer): link for peer, link in links.items()}
+                             for gpu_id, links in trace.get('topology', {}).items()}
+
+    def _frame(self):
+        return self.frames[self.position % len(self.frames)]
+
+    def advance(self):
+        """Move to the next frame of the trace"""
+        with self._lock:
+            self.position += 1
+
+    def query_gpus(self):
+        with self._lock:
+            frame = self._frame()
+            self.position += 1
+        gpus = []
+        for index in sorted(self.gpus):
+            state = frame.get('gpus', {}).get(str(index), {})
+            gpu = {
+                'index': index,
+                'utilization': float(state.get('utilization', 0)),
+                'memory_used': float(state.get('memory_used', 0)),
+                'memory_total': float(self.gpus[index].get('memory_total', 0)),
+                'power_draw': state.get('power_draw')
+            }
+            gpu.update({field: state.get(field) for field in HEALTH_FIELDS})
+            gpus.append(gpu)
+        return gpus
+
+    def query_compute_apps(self, gpu_ids=None):
+        with self._lock:
+            # The frame last returned by query_gpus(), the first one before any call
+            frame = self.frames[max(self.position - 1, 0) % len(self.frames)]
+        return [dict(process) for process in frame.get('processes', [])
+                if gpu_ids is None or process['gpu_id'] in gpu_ids]
+
+    def query_topology(self):
+        if self.topology:
+            return {gpu_id: dict(links) for gpu_id, links in self.topology.items()}
+        return {gpu_id: {peer: 'X' if peer == gpu_id else 'SYS' for peer in self.gpus} for gpu_id in self.gpus}
+
+    def query_mig_instances(self):
+        return [dict(instance) for instance in self.mig_instances]
+
+    def sample_gpu(self, gpu_id, duration=1.0, interval=0.1):
+        # Replay instantly, the trace already defines the samples
+        samples = []
+        for _ in range(max(1, int(duration / interval))):
+            for gpu in self.query_gpus():
+                if gpu['index'] == gpu_id:
+                    samples.append((gpu['utilization'], gpu['memory_used']))
+        return samples
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def create_gpu_backend(name):
+    """Create a GPU backend by name
+
+    Args:
+        name: 'nvml', 'nvidia-smi', 'fake' or 'auto' (NVML when available, nvidia-smi otherwise)
+
+    Returns:
+        GPUBackend: The backend instance
+    """
+    if name == 'fake':
+        return FakeGPUBackend(trace_file=config('GPU_FAKE_TRACE_FILE'),
+                              topology_file=config('GPU_FAKE_TOPOLOGY_FILE', default=None))
+    if name == 'nvidia-smi':
+        return NvidiaSmiBackend()
+    if name == 'nvml':
+        return NVMLBackend()
+    if name == 'auto':
+        try:
+            return NVMLBackend()
+        except Exception as e:
+            logger.warning(f"NVML backend unavailable ({str(e)}), falling back to nvidia-smi")
+            return NvidiaSmiBackend()
+    raise ValueError(f"Unknown GPU backend: {name}")
+
+def get_gpu_backend():
+    """Get the process-wide GPU backend selected by GPU_BACKEND"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_gpu_backend(config('GPU_BACKEND', default='auto'))
+            logger.info(f"Using {_backend.name} GPU backend")
+        return _backend
+
+def set_gpu_backend(backend):
+    """Replace the process-wide GPU backend, e.g. with a FakeGPUBackend"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -1,10 +1,10 @@
 import subprocess
-import re
 import os
 import pwd
 import pickle
 import pymongo
 import asyncio
+import time
 #import schedule as sched_module
 from datetime import datetime, timedelta
 from app.utils.logger import logger
@@ -15,15 +15,50 @@ from app.utils.db import get_db_connection,update_allocation_status
 from datetime import datetime, timedelta
 from bson import ObjectId
 import json
-from app.config import REDIS_BINARY,REDIS_KEYS,REDIS_CLIENT
-from app.utils.redis_utils import get_available_gpus,set_available_gpus,DistributedLock
+from app.config import REDIS_BINARY,REDIS_KEYS,REDIS_CLIENT,enqueue_job
+from app.utils.redis_utils import get_available_gpus,set_available_gpus,DistributedLock,GPULease,claim_gpus,claim_specific_gpus,return_gpus
+from app.utils.redis_utils import set_mig_config,claim_mig_instance,return_mig_instance,claim_gpu_share,return_gpu_share,clear_shared_gpus
+from app.utils.redis_utils import initialize_gpu_config,get_gpu_config
+from app.utils.telemetry import read_gpu_snapshot,sample_gpu_status,get_gpu_process_map,read_gpu_window_stats,read_user_gpu_memory
+from app.utils.gpu_backend import get_gpu_backend
+from app.utils.privileged import get_privileged_helper,HelperError
+from app.utils.rollups import summarize_utilization
+from app.utils.ingest import record_utilization_sample,close_utilization_run,flush_all_buffers
+from app.utils.energy import read_gpu_energy,record_allocation_energy
+from app.utils.idle_detector import update_idle_state,clear_idle_state,IdlePolicy,evaluate_idle_allocations
+from app.utils.quotas import record_allocations,record_release
+from app.utils.expiry import index_expiration,unindex_expiration,claim_due_expirations,reschedule_expiration,reclaimable_at,wait_for_expiration
 from bot import build_bot
-def set_gpu_permission(username, gpu_id, grant=True):
+MIG_MINORS_FILE = '/proc/driver/nvidia-caps/mig-minors'
+
+# Fields of the allocations of a MIG instance or a time slice of a GPU rather than a whole GPU
+UNIT_FIELDS = ('unit', 'mig_instance', 'mig_profile', 'memory_budget', 'energy_share')
+
+def get_mig_cap_devices(gpu_id, instance_id):
+    """Get the capability devices granting access to a MIG GPU instance and its compute instances
+    Args:
+        gpu_id: GPU the instance is on
+        instance_id: GPU instance ID
+    Returns:
+        list: Paths of the /dev/nvidia-caps devices
+    """
+    prefix = f'gpu{gpu_id}/gi{instance_id}/'
+    devices = []
+    with open(MIG_MINORS_FILE) as f:
+        for line in f:
+            parts = line.split()
+            # Lines look like "gpu0/gi1/access 12" and "gpu0/gi1/ci0/access 13"
+            if len(parts) == 2 and parts[0].startswith(prefix) and parts[0].endswith('/access'):
+                devices.append(f'/dev/nvidia-caps/nvidia-cap{parts[1]}')
+    return devices
+
+def set_gpu_permission(username, gpu_id, grant=True, mig_instance=None):
     """Set or remove GPU permission for a user
     Args:
         username: Username to modify permissions for
         gpu_id: GPU ID to modify permissions for
         grant: True to grant access, False to remove access
+        mig_instance: MIG GPU instance ID, to only give access to that instance of the GPU
     Returns:
         bool: Success status
     """
@@ -31,127 +66,130 @@ def set_gpu_permission(username, gpu_id, grant=True):
         # authorized_users = config('PRIVILEGED_USERS', cast=Csv())
         # if username in authorized_users and not grant:
         #     return True
-        user_info = pwd.getpwnam(username)
-        uid = user_info.pw_uid
-        gpu_device = f'/dev/nvidia{gpu_id}'
-        subprocess.run(['sudo', 'setfacl', '-x', f'u:{uid}', gpu_device], check=True)
+        gpu_device = [f'/dev/nvidia{gpu_id}']
+        if mig_instance is not None:
+            gpu_device += get_mig_cap_devices(gpu_id, mig_instance)
+        # Setting the entry replaces the user's existing one
+        get_privileged_helper().set_device_acl(username, gpu_device, 'rw' if grant else 'none')
         if grant:
-            subprocess.run(['sudo', 'setfacl', '-m', f'u:{uid}:rw', gpu_device], check=True)
             logger.debug(f'Granted access to GPU {gpu_id} for user {username}')
         else:
-            subprocess.run(['sudo', 'setfacl', '-m', f'u:{uid}:000', gpu_device], check=True)
             logger.debug(f'Removed access to GPU {gpu_id} for user {username}')
         return True
-    except (KeyError, subprocess.CalledProcessError) as e:
+    except (KeyError, OSError, HelperError) as e:
         logger.error(f'Failed to {"grant" if grant else "remove"} access for user {username}: {str(e)}')
         return False
-    
-
 
-    
-def check_if_available(requested_gpu_dict):
-    """
-    Check if requested GPU resources are available
+def set_gpu_permissions(username, gpu_ids, grant=True, mig_instances=()):
+    """Set or remove permission on several GPUs for a user with a single helper command
     Args:
-        requested_gpu_dict: Dictionary with gpu_type as key and requested count as value
+        username: Username to modify permissions for
+        gpu_ids: GPU IDs to modify permissions for
+        grant: True to grant access, False to remove access
+        mig_instances: (gpu_id, instance_id) tuples of the MIG instances among the GPUs
     Returns:
-        bool: True if resources are available, False otherwise
+        bool: Success status, False if any device couldn't be changed
     """
-    gpu_dict=get_gpu_config()
-    for gpu_type, requested_count in requested_gpu_dict.items():
-        # Check if gpu_type exists in GPU_DICT
-        if gpu_type not in gpu_dict.keys():
-            logger.error(f"Requested GPU type {gpu_type} not available")
-            return False
-            
-        # Check if requested count is valid
-        if requested_count < 0:
-            logger.error(f"Invalid requested count {requested_count} for {gpu_type}")
-            return False
-            
-        # Check if enough GPUs of this type are available
-        if len(gpu_dict[gpu_type]) < requested_count:
-            logger.error(f"Not enough {gpu_type} GPUs available. Requested: {requested_count}, Available: {len(gpu_dict[gpu_type])}")
-            return False
+    try:
+        devices = [f'/dev/nvidia{gpu_id}' for gpu_id in gpu_ids]
+        for gpu_id, instance_id in mig_instances:
+            devices += get_mig_cap_devices(gpu_id, instance_id)
+        get_privileged_helper().set_device_acl(username, devices, 'rw' if grant else 'none')
+        logger.debug(f'{"Granted" if grant else "Removed"} access to GPUs {list(gpu_ids)} for user {username}')
+        return True
+    except (KeyError, OSError, HelperError) as e:
+        logger.error(f'Failed to {"grant" if grant else "remove"} access to GPUs {list(gpu_ids)} for user {username}: {str(e)}')
+        return False
     
-    logger.debug("Requested GPU resources are available")
-    return True
 
-def allocate_gpu(username, gpu_type, gpu_id, days):
-    """Allocate a GPU to a user with proper permission setting and database tracking
+
+    
+def allocate_gpus(username, gpus, leases=None):
+    """Allocate several GPUs to a user as one unit
+    
+    The GPUs must already have been taken out of the available pool with
+    claim_gpus(); on failure the caller returns them with return_gpus().
+    Permissions are granted with one setfacl call, the allocations are
+    recorded with one insert_many and their monitoring is registered with
+    one scheduler message. If a step fails, the earlier ones are undone.
     
     Args:
-        username: Username to allocate GPU to
-        gpu_type: Type of GPU being allocated
-        gpu_id: ID of the GPU to allocate
-        days: Number of days for allocation
+        username: Username to allocate the GPUs to
+        gpus: List of (gpu_type, gpu_id, days) tuples. A fourth element holds
+            extra fields of the allocation: the fields of a sub-GPU unit
+            claimed with app.utils.sharing, or the booking_id of a booking
+        leases: {gpu_id: GPULease} held on the GPUs, checked before each write
         
     Returns:
-        tuple: (success, allocation_id or error_message)
+        tuple: (success, allocation_ids in the order of gpus or error_message)
     """
+    if not gpus:
+        return True, []
+    leases = leases or {}
+    gpus = [gpu if len(gpu) == 4 else (*gpu, {}) for gpu in gpus]
+    gpu_ids = [gpu_id for _, gpu_id, _, _ in gpus]
+    mig_instances = [(gpu_id, unit['mig_instance']) for _, gpu_id, _, unit in gpus if unit.get('mig_instance') is not None]
+    
+    def check_leases():
+        for lease in leases.values():
+            lease.check()
+    
     try:
-        # Remove the redundant lock since lock_gpu() already has one
-        available_gpus = get_available_gpus()
-        
-        # Verify GPU is still available
-        if gpu_id not in available_gpus.get(gpu_type, []):
-            return False, "GPU no longer available"
+        logger.debug(f"Allocating GPUs {gpus} to user {username}")
         
-        # Remove GPU from available pool
-        available_gpus[gpu_type].remove(gpu_id)
-        set_available_gpus(available_gpus)
-        
-        logger.debug(f"Allocating GPU {gpu_id} ({gpu_type}) to user {username} for {days} days")
-        
-        # Calculate expiration time
         allocation_time = datetime.now()
-        expiration_time = allocation_time + timedelta(days=days)
-        # Connect to database
-        client, db = get_db_connection()
-    
-        try:
-            # Step 1: Set GPU permission for user
-            if set_gpu_permission(username, gpu_id, grant=True):
-                logger.debug(f"Set permissions for GPU {gpu_id} for user {username}")
-                
-                try:
-                    # Step 2: Record allocation in MongoDB
-                    allocation_id = db.gpu_allocations.insert_one({
-                        'username': username,
-                        'gpu_type': gpu_type,
-                        'gpu_id': gpu_id,
-                        'allocated_at': allocation_time,
-                        'expiration_time': expiration_time,
-                        'released_at': None
-                    }).inserted_id
-                    
-                    # Step 3: Schedule monitoring jobs for this allocation
-                    schedule_allocation_monitoring(str(allocation_id), {
-                        'username': username,
-                        'gpu_type': gpu_type,
-                        'gpu_id': gpu_id,
-                        '_id': allocation_id
-                    })
-                    
-                    logger.info(f"Granted access to GPU {gpu_id} ({gpu_type}) for user {username} until {expiration_time}")
-                    return True, allocation_id
-                    
-                except Exception as e:
-                    # Rollback Step 1: Remove permissions if database insert fails
-                    logger.error(f"Failed to record allocation in database: {str(e)}")
-                    set_gpu_permission(username, gpu_id, grant=False)
-                    return False, f"Database error: {str(e)}"
-            else:
+        documents = [{
+            'username': username,
+            'gpu_type': gpu_type,
+            'gpu_id': gpu_id,
+            'allocated_at': allocation_time,
+            'expiration_time': allocation_time + timedelta(days=days),
+            'released_at': None,
+            'fencing_token': leases[gpu_id].token if gpu_id in leases else None,
+            # Energy counter of the GPU, the allocation's energy is computed from it on release
+            'energy_start_wh': read_gpu_energy(gpu_id),
+            **unit
+        } for gpu_type, gpu_id, days, unit in gpus]
+        
+        with MongoDBConnection() as (client, db):
+            # Step 1: Set GPU permissions for user
+            check_leases()
+            if not set_gpu_permissions(username, gpu_ids, grant=True, mig_instances=mig_instances):
+                # setfacl may have changed some of the devices before failing
+                set_gpu_permissions(username, gpu_ids, grant=False, mig_instances=mig_instances)
                 return False, "Failed to set GPU permissions"
-        except Exception as e:
-            logger.error(f"Error during GPU allocation: {str(e)}")
-            return False, str(e)
-        finally:
-            client.close()
+            logger.debug(f"Set permissions for GPUs {gpu_ids} for user {username}")
+            
+            try:
+                # Step 2: Record allocations in MongoDB
+                check_leases()
+                allocation_ids = db.gpu_allocations.insert_many(documents).inserted_ids
+            except Exception as e:
+                # Rollback Step 2 and Step 1: insert_many set the _id of every document
+                logger.error(f"Failed to record allocations in database: {str(e)}")
+                db.gpu_allocations.delete_many({'_id': {'$in': [document['_id'] for document in documents if '_id' in document]}})
+                set_gpu_permissions(username, gpu_ids, grant=False, mig_instances=mig_instances)
+                return False, f"Database error: {str(e)}"
+        record_allocations(username, len(gpus), allocation_time)
+        for document, allocation_id in zip(documents, allocation_ids):
+            index_expiration(allocation_id, document['expiration_time'])
+        
+        # Step 3: Schedule monitoring jobs for these allocations
+        schedule_allocations_monitoring([{
+            'username': username,
+            'gpu_type': document['gpu_type'],
+            'gpu_id': document['gpu_id'],
+            '_id': allocation_id,
+            **unit
+        } for document, allocation_id, (_, _, _, unit) in zip(documents, allocation_ids, gpus)])
+        
+        for document in documents:
+            logger.info(f"Granted access to GPU {document['gpu_id']} ({document['gpu_type']}) for user {username} until {document['expiration_time']}")
+        return True, allocation_ids
     except Exception as e:
-        logger.error(f"Error in allocate_gpu: {str(e)}")
+        logger.error(f"Error in allocate_gpus: {str(e)}")
         return False, str(e)
-    
+
 def reset_gpu_access():
     
     try:
@@ -212,27 +250,26 @@ def reset_user_access():
         # First, collect all users that should keep access
         users_to_keep = set()  # Using a set to avoid duplicates
         
-        # Check each GPU's allocations
+        # Check each GPU's allocations, a GPU shared in MIG instances or time slices has several
         gpu_dict=get_gpu_config()
         for gpu_type in gpu_dict.keys():
             for gpu_id in gpu_dict[gpu_type]:
-                # Find active allocation for this GPU
-                allocation = db.gpu_allocations.find_one({
+                # Find active allocations for this GPU
+                for allocation in db.gpu_allocations.find({
                     'gpu_id': gpu_id,
                     'gpu_type': gpu_type,
                     'released_at': None
-                })
-                
-                if allocation:
+                }):
                     # expiration_with_penalty = allocation['expiration_time'].replace(
                     #     hour=allocation['expiration_time'].hour + penalty_hours
                     # )
                     
                     # if current_time < expiration_with_penalty:
                     users_to_keep.add((allocation['username'], gpu_id))
-                    available_gpus=get_available_gpus()
-                    available_gpus[gpu_type].remove(gpu_id)
-                    set_available_gpus(available_gpus)
+                    claim_allocation(allocation)
+                    if allocation.get('mig_instance') is not None:
+                        # The instance's capability devices aren't covered by the ACL check below
+                        set_gpu_permission(allocation['username'], gpu_id, grant=True, mig_instance=allocation['mig_instance'])
                     logger.debug(f"Found active allocation for GPU {gpu_id} ({gpu_type}) for user {allocation['username']}")
                     logger.debug(f"Removing GPU {gpu_id} from available {gpu_type} GPUs")
                     # else:
@@ -250,45 +287,42 @@ def reset_user_access():
             except KeyError:
                 logger.warning(f'Privileged user {username} not found in system')
         
-        # Check and update access for each GPU
-        for gpu_type in gpu_dict.keys():
-            for gpu_id in gpu_dict[gpu_type]:
-                gpu_device = f'/dev/nvidia{gpu_id}'
-                try:
-                    # Get current ACL entries
-                    acl_output = subprocess.run(
-                        ['sudo', 'getfacl', gpu_device],
-                        capture_output=True,
-                        text=True,
-                        check=True
-                    ).stdout
-                    
-                    # Parse ACL entries to get current users
-                    current_users = []
-                    for line in acl_output.splitlines():
-                        if line.startswith('user:'):
-                            # Format is "user:username:rw-"
-                            parts = line.split(':')
-                            if len(parts) >= 2 and parts[1]:  # Skip default user entry
-                                current_users.append(parts[1])
-                    
-                    # Remove access for users who shouldn't have it
-                    for username in current_users:
-                        if (username, gpu_id) not in users_to_keep:
-                            # Check if user is actively using the GPU before removing access
-                            set_gpu_permission(username, gpu_id, grant=False)
-                            logger.debug(f'Removed access to GPU {gpu_id} for user {username}')
-                    
-                    # Grant access to users who should have it but don't
-                    for username, kept_gpu_id in users_to_keep:
-                        if kept_gpu_id == gpu_id and username not in current_users:
-                            set_gpu_permission(username, gpu_id, grant=True)
-                            logger.debug(f'Granted access to GPU {gpu_id} for user {username}')
-                
-                except subprocess.CalledProcessError as e:
-                    logger.error(f'Failed to manage ACL for GPU {gpu_id}: {str(e)}')
-                    client.close()
-                    return False
+        # Read the ACLs of all GPUs and apply the changes each in one helper request
+        gpu_ids = [gpu_id for gpu_type in gpu_dict.keys() for gpu_id in gpu_dict[gpu_type]]
+        helper = get_privileged_helper()
+        try:
+            acls = helper.get_device_acls([f'/dev/nvidia{gpu_id}' for gpu_id in gpu_ids])
+        except HelperError as e:
+            logger.error(f'Failed to read the ACLs of the GPUs: {str(e)}')
+            client.close()
+            return False
+        
+        changes = []
+        for gpu_id in gpu_ids:
+            gpu_device = f'/dev/nvidia{gpu_id}'
+            current_users = acls.get(gpu_device, {})
+            
+            # Remove access for users who shouldn't have it, entries already denying access stay as they are
+            for username, permission in current_users.items():
+                if (username, gpu_id) not in users_to_keep and permission != '---':
+                    changes.append({'op': 'set_acl', 'username': username, 'devices': [gpu_device], 'permission': 'none'})
+                    logger.debug(f'Removing access to GPU {gpu_id} for user {username}')
+            
+            # Grant access to users who should have it but don't
+            for username, kept_gpu_id in users_to_keep:
+                if kept_gpu_id == gpu_id and username not in current_users:
+                    changes.append({'op': 'set_acl', 'username': username, 'devices': [gpu_device], 'permission': 'rw'})
+                    logger.debug(f'Granting access to GPU {gpu_id} for user {username}')
+        
+        try:
+            results = helper.execute(changes)
+        except HelperError as e:
+            logger.error(f'Failed to update the ACLs of the GPUs: {str(e)}')
+            client.close()
+            return False
+        for change, result in zip(changes, results):
+            if not result['ok']:
+                logger.error(f"Failed to set access of {change['username']} to {change['devices'][0]} to {change['permission']}: {result['error']}")
         
         logger.info('Successfully reset and configured user-specific GPU access')
         client.close()
@@ -302,27 +336,38 @@ def reset_user_access():
 
 
 def check_expired_reservations():
-    logger.info("Running scheduled check for expired reservations")
+    """Release the allocations whose expiration plus USER_LOCKOUT_HOURS has passed
+    
+    Only the allocations that came due in the expiry index are loaded.
+    Those still in use are checked again after CHECK_FOR_IDLE_GPU_HOURS.
+    """
     try:
-        client, db = get_db_connection()
         current_time = datetime.now()
-        penalty_hours = config('USER_LOCKOUT_HOURS', default=24, cast=int)
-        
-        # Find all active allocations
-        active_allocations = list(db.gpu_allocations.find({'released_at': None}))
-        logger.info(f"Found {len(active_allocations)} active allocations to check")
+        due_ids = claim_due_expirations(current_time)
+        if not due_ids:
+            return
+        client, db = get_db_connection()
         
         # Filter allocations where expiration_time + penalty < current_time
         allocations_to_check = []
-        for allocation in active_allocations:
+        for allocation in db.gpu_allocations.find({'_id': {'$in': [ObjectId(allocation_id) for allocation_id in due_ids]}}):
             expiration_time = allocation['expiration_time']
-            expiration_with_penalty = expiration_time+timedelta(hours=penalty_hours)
-            if current_time > expiration_with_penalty:
+            expiration_with_penalty = reclaimable_at(expiration_time)
+            if allocation.get('released_at') is not None:
+                unindex_expiration(allocation['_id'])
+            elif current_time > expiration_with_penalty:
                 logger.debug(f"Allocation {allocation['_id']} has expired (expiration: {expiration_time}, with penalty: {expiration_with_penalty})")
                 allocations_to_check.append(allocation)
-                
+            else:
+                # Extended after it was indexed
+                index_expiration(allocation['_id'], expiration_time)
+        
         logger.info(f"Found {len(allocations_to_check)} allocations within penalty period to check for GPU usage")
         
+        # Query the GPU processes once for all allocations of this run
+        process_map = get_gpu_process_map() if allocations_to_check else {}
+        
+        released = 0
         for allocation in allocations_to_check:
             username = allocation['username']
             gpu_id = allocation['gpu_id']
@@ -332,21 +377,36 @@ def check_expired_reservations():
             logger.debug(f"Checking allocation {allocation_id}: GPU {gpu_id} ({gpu_type}) for user {username}")
             
             # Check if the user is actually using the GPU
-            if not is_user_using_gpu(username, gpu_id) or config('FORCE_REVOKE', default=False, cast=bool):
+            if not is_user_using_gpu(username, gpu_id, process_map) or config('FORCE_REVOKE', default=False, cast=bool):
                 logger.info(f"User {username} is not using allocated GPU {gpu_id}. Releasing allocation {allocation_id}.")
                 
                 # Use the common unallocate function
-                unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=f"Released due to expiration")
+                if unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=f"Released due to expiration", process_map=process_map):
+                    released += 1
             else:
                 logger.debug(f"User {username} is actively using GPU {gpu_id}, skipping release")
+                reschedule_expiration(allocation_id, current_time + timedelta(hours=config('CHECK_FOR_IDLE_GPU_HOURS', default=6, cast=int)))
         
-        logger.info("Completed checking all active allocations")
+        if released:
+            gpus_freed()
+        logger.info("Completed checking expired allocations")
         
     except Exception as e:
         logger.error(f"Error in check_expired_reservations: {str(e)}")
     finally:
         if 'client' in locals():
             client.close()
+def run_expiry_loop():
+    """Release expired allocations as soon as they come due, sleeping until the next one in between"""
+    while True:
+        try:
+            check_expired_reservations()
+            # Wake up now and then anyway, e.g. if the index was rebuilt elsewhere
+            wait_for_expiration(max_seconds=300)
+        except Exception as e:
+            logger.error(f"Error in expiry loop: {str(e)}")
+            time.sleep(30)
+
 def cancel_allocation_monitoring(allocation_id):
     """Cancel monitoring jobs for a GPU allocation
     
@@ -356,7 +416,6 @@ def cancel_allocation_monitoring(allocation_id):
     try:
         # Get jobs from Redis
         remove_job_from_redis({"id": allocation_id, "job_function": "check_allocation_utilization"})
-        remove_job_from_redis({"id": allocation_id, "job_function": "check_and_revoke_idle_allocation"})
         logger.debug(f"Cancelling jobs for allocation {allocation_id} sent to redis")
          
     except Exception as e:
@@ -372,41 +431,37 @@ def add_job_to_redis(job_data):
         pickle.dumps(job_data)
     )
 
-def schedule_allocation_monitoring(allocation_id, allocation_data):
-    """Schedule monitoring jobs for a GPU allocation
+def schedule_allocations_monitoring(allocations):
+    """Schedule monitoring jobs for several GPU allocations with one scheduler message
+    
+    The initial utilization check runs on the RQ worker, so the caller
+    doesn't wait for it.
     
     Args:
-        allocation_id: String ID of the allocation
-        allocation_data: Dictionary with allocation details
+        allocations: List of dictionaries with allocation details (username, gpu_type, gpu_id, _id)
     """
     try:
-        logger.debug(f"Scheduling monitoring jobs for allocation {allocation_id}")
+        allocation_ids = [str(allocation['_id']) for allocation in allocations]
+        logger.debug(f"Scheduling monitoring jobs for allocations {allocation_ids}")
         
         utilization_period_minutes = config('GPU_ACTIVITY_CHECK_MINUTES', default=5, cast=int)
         
-       
-        idle_check_hours=config('REVOKE_IDLE_GPU_AFTER_HOURS', default=24, cast=int)
+        # Idle checks run for all allocations at once in check_idle_allocations
         add_job_to_redis({
                 'job_function': "check_allocation_utilization",
-                'job_input': allocation_data,
+                'job_inputs': allocations,
                 'job_interval': utilization_period_minutes,
                 'job_unit': 'minutes'
             })
-        add_job_to_redis({
-                'job_function': "check_and_revoke_idle_allocation",
-                'job_input': allocation_data,
-                'job_interval': idle_check_hours,
-                'job_unit': 'hours'
-            })
-        
         
-        logger.info(f"Scheduled monitoring jobs for redis {allocation_id}")
+        logger.info(f"Scheduled monitoring jobs for redis {allocation_ids}")
         
-        # Run the utilization check immediately to get initial data
-        check_allocation_utilization(allocation_data)
+        # Get initial data without delaying the caller
+        enqueue_job(check_allocations_utilization, allocations)
         
     except Exception as e:
-        logger.error(f"Failed to schedule monitoring jobs for allocation {allocation_id}: {str(e)}")
+        logger.error(f"Failed to schedule monitoring jobs for allocations {allocations}: {str(e)}")
+
 def restore_monitoring_jobs():
     """
     Restore monitoring jobs for all active allocations when the application starts
@@ -420,54 +475,52 @@ def restore_monitoring_jobs():
             active_allocations = list(db.gpu_allocations.find({'released_at': None}))
             logger.info(f"Found {len(active_allocations)} active allocations to monitor")
             
-            # Schedule monitoring jobs for each allocation
-            for allocation in active_allocations:
-                allocation_id = str(allocation['_id'])
-                allocation_data = {
+            # Schedule monitoring jobs for all of them at once
+            if active_allocations:
+                schedule_allocations_monitoring([{
                     'username': allocation['username'],
                     'gpu_type': allocation['gpu_type'],
                     'gpu_id': allocation['gpu_id'],
-                    '_id': allocation['_id']
-                }
-                
-                # Schedule monitoring jobs
-                schedule_allocation_monitoring(allocation_id, allocation_data)
-                check_and_revoke_idle_allocation(allocation_data)
+                    '_id': allocation['_id'],
+                    **{field: allocation[field] for field in UNIT_FIELDS if field in allocation}
+                } for allocation in active_allocations])
             logger.info("Successfully restored monitoring jobs for existing allocations")
             
     except Exception as e:
         logger.error(f"Error restoring monitoring jobs: {str(e)}")
 
-def notify_users_of_unallocation():
-    """Notify users about the unallocation of a GPU"""
-    try:
-        # Logic to send notification (e.g., email, message, etc.)
-        with MongoDBConnection() as (client, db):
-            users_to_notify = list(db.gpu_notif_list.find())
-            if len(users_to_notify)==0:
-                logger.info("No users waiting for notification")
-                return
-            notification_message = "New GPU is available."
-            for user in users_to_notify:
-                username = user.get("username")
-                if username:
-                    
-                    # Delete user from notification list after sending
-                    db.gpu_notif_list.delete_one({'username': username})
-                    logger.info(f"Deleted user {username} from notification list after sending notification.")
-                    # Send notification
-                    notification.send_notification(username, notification_message)
-                    logger.info(f"Available GPU Notification sent to user: {username}")
-                else:
-                    logger.warning("Found a user entry without a username, skipping deletion.")
-        
-        # Log the completion of the notification process
-        logger.info("All notifications sent and users deleted from the notification list.")
-        
-    except Exception as e:
-        logger.error(f"Failed to send notification for unallocation: {str(e)}")
+# Callbacks run after an allocation is released, so modules that depend on
+# this one (bookings, waitlist) can react without being imported here
+_release_listeners = []
+_freed_listeners = []
+
+def on_allocation_released(listener):
+    """Register listener(db, allocation) to run after each released allocation
+
+    The allocation is the released document with its gpu_id and, for
+    allocations made for a booking, its booking_id.
+    """
+    _release_listeners.append(listener)
+    return listener
 
-def unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=None):
+def on_gpus_freed(listener):
+    """Register listener() to run when gpus_freed() is called"""
+    _freed_listeners.append(listener)
+    return listener
+
+def gpus_freed():
+    """Run the listeners waiting for GPUs to go back to the pool
+
+    unallocate_gpu() doesn't call it, callers releasing GPUs call it once
+    per batch of releases rather than once per GPU.
+    """
+    for listener in _freed_listeners:
+        try:
+            listener()
+        except Exception as e:
+            logger.error(f"Error in freed GPUs listener {listener.__name__}: {str(e)}")
+
+def unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=None, process_map=None):
     """Release a GPU allocation with proper cleanup of permissions and database
     
     Args:
@@ -476,6 +529,8 @@ def unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=None):
         gpu_type: Type of the GPU being released
         allocation_id: Database ID of the allocation
         db: MongoDB database connection
+        comment: Optional comment explaining the release
+        process_map: Optional map from get_gpu_process_map() to reuse within a tick
         
     Returns:
         bool: Success status
@@ -487,29 +542,15 @@ def unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=None):
         authorized_users = config('PRIVILEGED_USERS', cast=Csv())
         if username not in authorized_users:
             try:
-                # Get all processes running on this GPU
-                nvidia_smi = subprocess.run(
-                    ['sudo', 'nvidia-smi', '--id=' + str(gpu_id), '--query-compute-apps=pid', '--format=csv,noheader'],
-                    capture_output=True, text=True, check=True
-                )
+                # Get the user's processes running on this GPU
+                if process_map is None:
+                    process_map = get_gpu_process_map([gpu_id])
+                user_pids = process_map.get(gpu_id, {}).get(username, [])
                 
-                # For each process, check if it belongs to the user and kill it if so
-                for line in nvidia_smi.stdout.strip().split('\n'):
-                    if not line.strip():
-                        continue
-                    
-                    pid = line.strip()
-                    try:
-                        process_owner = subprocess.run(
-                            ['ps', '-o', 'user=', '-p', pid],
-                            capture_output=True, text=True, check=True
-                        ).stdout.strip()
-                        
-                        if process_owner == username:
-                            logger.info(f"Terminating process {pid} owned by {username} on GPU {gpu_id}")
-                            subprocess.run(['sudo', 'kill', '-9', pid], check=True)
-                    except subprocess.CalledProcessError:
-                        continue
+                # Kill all of them with a single command
+                if user_pids:
+                    logger.info(f"Terminating processes {user_pids} owned by {username} on GPU {gpu_id}")
+                    get_privileged_helper().kill_processes(username, user_pids)
                 
                 logger.debug(f"Terminated all processes for user {username} on GPU {gpu_id}")
             except Exception as e:
@@ -519,147 +560,128 @@ def unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=None):
         # Cancel monitoring jobs for this allocation
         cancel_allocation_monitoring(str(allocation_id) if isinstance(allocation_id, ObjectId) else allocation_id)
         
-        # Use distributed lock for the entire unallocation process
-        with DistributedLock(REDIS_KEYS['gpu_lock']):
-            # Get current available GPUs from Redis
-            available_gpus = get_available_gpus()
+        # Verify GPU configuration
+        gpu_config = get_gpu_config()
+        if not gpu_config or gpu_type not in gpu_config or gpu_id not in gpu_config[gpu_type]:
+            logger.error(f"Invalid GPU configuration for {gpu_type} {gpu_id}")
+            return False
+        
+        # Hold the GPU's lease so concurrent releases (expiry, idle check, admin) don't interleave
+        with GPULease(gpu_id) as lease:
+            allocation = db.gpu_allocations.find_one(
+                {'_id': ObjectId(allocation_id) if isinstance(allocation_id, str) else allocation_id},
+                {'released_at': 1, 'allocated_at': 1, 'gpu_id': 1, 'unit': 1, 'mig_instance': 1, 'memory_budget': 1, 'booking_id': 1}
+            )
+            if not allocation or allocation.get('released_at') is not None:
+                logger.warning(f"Allocation {allocation_id} of GPU {gpu_id} was already released")
+                return False
             
-            # Verify GPU configuration
-            gpu_config = get_gpu_config()
-            if not gpu_config or gpu_type not in gpu_config or gpu_id not in gpu_config[gpu_type]:
-                logger.error(f"Invalid GPU configuration for {gpu_type} {gpu_id}")
+            try:
+                # Step 1: Mark allocation as released in database
+                lease.check()
+                if not update_allocation_status(db, allocation_id, released=True, comment=comment, fencing_token=lease.token):
+                    raise Exception(f"Failed to update allocation status in database")
+                logger.debug(f"Updated allocation {allocation_id} status to released")
+                record_allocation_energy(db, allocation_id)
+            except Exception as e:
+                logger.error(f"Error updating database for GPU {gpu_id}: {str(e)}")
                 return False
             
             try:
-                # Step 1: Add GPU back to available pool
-                if gpu_type not in available_gpus:
-                    available_gpus[gpu_type] = []
-                if gpu_id not in available_gpus[gpu_type]:
-                    available_gpus[gpu_type].append(gpu_id)
-                    # Update available GPUs in Redis
-                    set_available_gpus(available_gpus)
-                logger.debug(f"Added GPU {gpu_id} back to available pool")
-                
-                try:
-                    # Step 2: Mark allocation as released in database
-                    if update_allocation_status(db, allocation_id, released=True, comment=comment):
-                        logger.debug(f"Updated allocation {allocation_id} status to released")
-                        
-                        try:
-                            # Step 3: Remove user's access to the GPU
-                            if set_gpu_permission(username, gpu_id, grant=False):
-                                logger.info(f"Successfully released GPU {gpu_id} from user {username}")
-                                
-                                # Notify users about the unallocation
-                                notify_users_of_unallocation()
-                                return True
-                            else:
-                                raise Exception(f"Failed to remove permissions for GPU {gpu_id}")
-                            
-                        except Exception as e:
-                            # Rollback Step 2: Revert the database update
-                            logger.error(f"Failed to remove permissions for GPU {gpu_id}: {str(e)}")
-                            update_allocation_status(db, allocation_id, released=False)
-                            # Rollback Step 1: Remove GPU from available pool
-                            available_gpus[gpu_type].remove(gpu_id)
-                            set_available_gpus(available_gpus)
-                            logger.error(f"Rolled back allocation release due to permission error")
-                            return False
-                    else:
-                        raise Exception(f"Failed to update allocation status in database")
-                        
-                except Exception as e:
-                    # Rollback Step 1: Remove GPU from available pool
-                    available_gpus[gpu_type].remove(gpu_id)
-                    set_available_gpus(available_gpus)
-                    logger.error(f"Error updating database for GPU {gpu_id}: {str(e)}")
-                    return False
-                    
+                # Step 2: Remove user's access to the GPU
+                lease.check()
+                if not set_gpu_permission(username, gpu_id, grant=False, mig_instance=allocation.get('mig_instance')):
+                    raise Exception(f"Failed to remove permissions for GPU {gpu_id}")
             except Exception as e:
-                logger.error(f"Error managing available GPUs for {gpu_id}: {str(e)}")
+                # Rollback Step 1: Revert the database update
+                logger.error(f"Failed to remove permissions for GPU {gpu_id}: {str(e)}")
+                update_allocation_status(db, allocation_id, released=False, fencing_token=lease.token)
+                logger.error(f"Rolled back allocation release due to permission error")
                 return False
+            record_release(username, allocation['allocated_at'], datetime.now())
+            unindex_expiration(allocation_id)
+            
+            # Step 3: Add GPU (or its MIG instance or time slice) back to available pool, only once nobody can use it anymore
+            return_allocation(gpu_type, gpu_id, allocation)
+        logger.debug(f"Added GPU {gpu_id} back to available pool")
+        logger.info(f"Successfully released GPU {gpu_id} from user {username}")
+        clear_idle_state(str(allocation_id))
+        close_utilization_run(str(allocation_id))
+        for listener in _release_listeners:
+            try:
+                listener(db, allocation)
+            except Exception as e:
+                logger.error(f"Error in release listener {listener.__name__} for allocation {allocation_id}: {str(e)}")
+        return True
                 
     except Exception as e:
         logger.error(f"Unexpected error releasing GPU {gpu_id}: {str(e)}")
         return False
-def is_user_using_gpu(username, gpu_id):
+def claim_allocation(allocation):
+    """Take the GPU, MIG instance or time slice of an active allocation out of its pool
+    
+    Used when the pools are rebuilt, so a time slice is claimed regardless of
+    the tenant and memory limits.
+    """
+    gpu_type, gpu_id = allocation['gpu_type'], allocation['gpu_id']
+    if allocation.get('unit') == 'mig':
+        return claim_mig_instance(gpu_type, gpu_id, allocation['mig_instance'])
+    if allocation.get('unit') == 'shared':
+        return claim_gpu_share(gpu_type, [(gpu_id, 0)], allocation['memory_budget'], force=True) is not None
+    return claim_specific_gpus([(gpu_type, gpu_id)])
+
+def return_allocation(gpu_type, gpu_id, allocation):
+    """Put the GPU, MIG instance or time slice of a released allocation back into its pool"""
+    if allocation.get('unit') == 'mig':
+        return return_mig_instance(gpu_type, gpu_id, allocation['mig_instance'])
+    if allocation.get('unit') == 'shared':
+        return return_gpu_share(gpu_type, gpu_id, allocation['memory_budget'])
+    return return_gpus([(gpu_type, gpu_id)])
+
+def is_user_using_gpu(username, gpu_id, process_map=None):
     """Check if a user is actively using a specific GPU
+    Args:
+        username: Username to check
+        gpu_id: GPU ID to check
+        process_map: Optional map from get_gpu_process_map() to reuse within a tick
     Returns:
         bool: True if user is using the GPU, False otherwise
     """
     try:
-        nvidia_smi = subprocess.run(
-            ['sudo', 'nvidia-smi', '--id=' + str(gpu_id), '--query-compute-apps=pid', '--format=csv,noheader'],
-            capture_output=True, text=True, check=True
-        )
-        
-        if not nvidia_smi.stdout.strip():
-            return False
-            
-        for line in nvidia_smi.stdout.strip().split('\n'):
-            if not line.strip():
-                continue
-            
-            pid = line.strip()
-            try:
-                process_owner = subprocess.run(
-                    ['ps', '-o', 'user=', '-p', pid],
-                    capture_output=True, text=True, check=True
-                ).stdout.strip()
-                
-                if process_owner == username:
-                    return True
-            except subprocess.CalledProcessError:
-                continue
-                
-        return False
-    except subprocess.CalledProcessError as e:
+        if process_map is None:
+            process_map = get_gpu_process_map([gpu_id])
+        return bool(process_map.get(gpu_id, {}).get(username))
+    except Exception as e:
         logger.error(f"Error checking if user {username} is using GPU {gpu_id}: {str(e)}")
         return False
     
-def initialize_gpu_config():
-    """Initialize GPU configuration in Redis"""
-    try:
-        gpu_config = eval(config('GPU_CONFIG'))
-        REDIS_CLIENT.set(REDIS_KEYS['gpu_config'], json.dumps(gpu_config))
-        logger.info(f"Initialized GPU configuration in Redis: {gpu_config}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to initialize GPU config in Redis: {str(e)}")
-        return False
+def initialize_gpu_tracking():
+    """Initialize available GPU tracking from GPU_DICT
     
-def get_gpu_config():
-    """
-    Get GPU configuration from Redis
-    Returns:
-        dict: GPU configuration dictionary or empty dict if not found
+    GPUs partitioned into MIG instances are handed out by instance, so they
+    are left out of the pool of whole GPUs and their instances get pools of their own.
     """
-    try:
-        gpu_config = REDIS_CLIENT.get(REDIS_KEYS['gpu_config'])
-        if gpu_config:
-            return json.loads(gpu_config)
-        
-        # If config not found in Redis, try to reinitialize
-        logger.warning("GPU configuration not found in Redis, attempting to reinitialize")
-        if initialize_gpu_config():
-            gpu_config = REDIS_CLIENT.get(REDIS_KEYS['gpu_config'])
-            if gpu_config:
-                return json.loads(gpu_config)
-        
-        logger.error("Could not retrieve or initialize GPU configuration")
-        return {}
-        
-    except Exception as e:
-        logger.error(f"Error getting GPU config from Redis: {str(e)}")
-        return {}
-    
-def initialize_gpu_tracking():
-    """Initialize available GPU tracking from GPU_DICT"""
     try:
         with DistributedLock(REDIS_KEYS['gpu_lock']):
             gpu_dict = {gpu_type: list(gpus) for gpu_type, gpus in eval(config('GPU_CONFIG')).items()}
+            try:
+                instances = get_gpu_backend().query_mig_instances()
+            except Exception as e:
+                logger.warning(f"Failed to query MIG instances, handing out whole GPUs only: {str(e)}")
+                instances = []
+            mig_config = {}
+            for instance in instances:
+                for gpu_type, gpus in gpu_dict.items():
+                    if instance['gpu_id'] in gpus:
+                        mig_config.setdefault(gpu_type, []).append(instance)
+            mig_gpus = {instance['gpu_id'] for instance in instances}
+            gpu_dict = {gpu_type: [gpu_id for gpu_id in gpus if gpu_id not in mig_gpus] for gpu_type, gpus in gpu_dict.items()}
+            clear_shared_gpus([gpu_id for gpus in gpu_dict.values() for gpu_id in gpus])
             set_available_gpus(gpu_dict)
+            set_mig_config(mig_config)
             logger.info(f"Initialized available GPUs: {gpu_dict}")
+            if mig_config:
+                logger.info(f"Initialized available MIG instances: {mig_config}")
             return True
     except Exception as e:
         logger.error(f"Failed to initialize GPU tracking: {str(e)}")
@@ -668,51 +690,21 @@ def initialize_gpu_tracking():
 def get_gpu_status():
     """Get current GPU status information
     
+    Reads the snapshot published by the telemetry collector instead of
+    running nvidia-smi, falling back to a direct sample only when the
+    snapshot is missing or stale.
+    
     Returns:
         dict: Dictionary with GPU IDs as keys and status information as values
     """
     try:
-        gpu_status = {}
-        
-        # Run nvidia-smi to get GPU utilization and memory usage
-        nvidia_smi = subprocess.run(
-            ['nvidia-smi', '--query-gpu=index,utilization.gpu,memory.used,memory.total', '--format=csv,noheader,nounits'],
-            capture_output=True, text=True, check=True
-        )
-        
-        # Parse the output
-        for line in nvidia_smi.stdout.strip().split('\n'):
-            if not line.strip():
-                continue
-                
-            parts = [part.strip() for part in line.split(',')]
-            if len(parts) >= 4:
-                gpu_id = int(parts[0])
-
-                utilization = float(parts[1])
-                memory_used = float(parts[2])
-                memory_total = float(parts[3])
-                
-                # Find which GPU type this ID belongs to
-                gpu_type = None
-                found=False
-                gpu_dict=get_gpu_config()
-                for type_name, ids in gpu_dict.items():
-                    if gpu_id in ids:
-                        found=True
-                        gpu_type = type_name
-                        break
-                if found==False:
-                    continue
-                gpu_status[gpu_id] = {
-                    'gpu_type': gpu_type,
-                    'utilization': utilization,
-                    'memory_used': memory_used,
-                    'memory_total': memory_total,
-                    'memory_percent': (memory_used / memory_total) * 100 if memory_total > 0 else 0
-                }
+        max_age = config('GPU_STATUS_MAX_AGE_SECONDS', default=10, cast=float)
+        snapshot = read_gpu_snapshot()
+        if snapshot and snapshot['age'] <= max_age:
+            return snapshot['gpus']
         
-        return gpu_status
+        logger.warning("GPU telemetry snapshot is missing or stale, sampling GPUs directly")
+        return sample_gpu_status()
     except Exception as e:
         logger.error(f"Error getting GPU status: {str(e)}")
         return {}
@@ -740,43 +732,35 @@ def check_allocation_utilization(allocation):
             logger.warning(f"GPU {gpu_id} not found in status data")
             return None
         
-        # Get GPU utilization and memory usage over a short period (1 second with 100ms sampling)
-        # This will give multiple samples that we can average
-        nvidia_smi_samples = subprocess.run(
-            ['timeout', '1s','setsid', 'sudo', 'nvidia-smi', 
-             f'--id={gpu_id}', '--query-gpu=utilization.gpu,memory.used', 
-             '--format=csv,noheader', '-lms', '100'],
-            capture_output=True, text=True, check=False,
-        )
-        
-        # Parse the samples to calculate average utilization and memory usage
-        utilization_samples = []
-        memory_samples = []
-        
-        for line in nvidia_smi_samples.stdout.strip().split('\n'):
-            if not line.strip():
-                continue
-                
-            parts = [part.strip() for part in line.split(',')]
-            if len(parts) >= 2:
-                # Extract utilization percentage (remove the % sign)
-                util_value = float(parts[0].replace('%', '').strip())
-                utilization_samples.append(util_value)
-                
-                # Extract memory usage (format like "24056 MiB")
-                memory_str = parts[1].strip()
-                memory_value = float(re.search(r'(\d+)', memory_str).group(1))
-                memory_unit = re.search(r'([A-Za-z]+)', memory_str).group(1)
-                
-                # Convert to MiB if needed
-                if memory_unit.lower() == 'gib':
-                    memory_value *= 1024
-                    
-                memory_samples.append(memory_value)
-        
-        # Calculate averages
-        avg_utilization = max(utilization_samples) if utilization_samples else 0
-        avg_memory_used = max(memory_samples) if memory_samples else 0
+        # Read the statistics the telemetry collector keeps over the last check interval
+        window = read_gpu_window_stats(gpu_id)
+        if window and window['age'] <= config('GPU_STATUS_MAX_AGE_SECONDS', default=10, cast=float):
+            max_utilization = window['utilization_max']
+            max_memory_used = window['memory_max']
+            mean_utilization = window['utilization_mean']
+            mean_memory_used = window['memory_mean']
+            mean_power_draw = window.get('power_mean')
+            sample_count = window['samples']
+        else:
+            # Collector is not running, probe the GPU over a short period (1 second with 100ms sampling)
+            logger.warning(f"No recent window statistics for GPU {gpu_id}, probing it directly")
+            samples = get_gpu_backend().sample_gpu(gpu_id, duration=1.0, interval=0.1)
+            utilization_samples = [utilization for utilization, _ in samples]
+            memory_samples = [memory_used for _, memory_used in samples]
+            max_utilization = max(utilization_samples) if utilization_samples else 0
+            max_memory_used = max(memory_samples) if memory_samples else 0
+            mean_utilization = sum(utilization_samples) / len(samples) if samples else 0
+            mean_memory_used = sum(memory_samples) / len(samples) if samples else 0
+            mean_power_draw = gpu_status[gpu_id].get('power_draw')
+            sample_count = len(samples)
+        
+        if allocation.get('unit'):
+            # The GPU's counters include the other tenants, only the user's own memory tells whether it's used
+            memory_used = read_user_gpu_memory(username).get(gpu_id, 0)
+            if not memory_used:
+                max_utilization = mean_utilization = 0
+            max_memory_used = mean_memory_used = memory_used
+            check_memory_budget(allocation, memory_used)
         
         # Create utilization record
         result = {
@@ -784,120 +768,215 @@ def check_allocation_utilization(allocation):
             'username': username,
             'gpu_id': gpu_id,
             'gpu_type': gpu_type,
-            'gpu_utilization': avg_utilization,
-            'memory_used': avg_memory_used,
+            'gpu_utilization': max_utilization,
+            'memory_used': max_memory_used,
+            'gpu_utilization_mean': mean_utilization,
+            'memory_used_mean': mean_memory_used,
+            'power_draw': mean_power_draw,
+            'samples': sample_count,
             'timestamp': datetime.now()
         }
         
-        # Save utilization data to database
-        try:
-            with MongoDBConnection() as (client, db):
-                # Create gpu_utilization collection if it doesn't exist
-                if 'gpu_utilization' not in db.list_collection_names():
-                    # Create time-based TTL index to automatically delete old records
-                    # Default to keeping 7 days of history
-                    ttl_days = config('GPU_UTILIZATION_HISTORY_DAYS', default=7, cast=int)
-                    db.create_collection('gpu_utilization')
-                    db.gpu_utilization.create_index('timestamp', expireAfterSeconds=ttl_days * 24 * 60 * 60)
-                
-                # Insert the utilization record
-                db.gpu_utilization.insert_one(result)
-                #logger.debug(f"Saved utilization data for GPU {gpu_id} (allocation {allocation_id})")
-        except Exception as e:
-            logger.error(f"Failed to save GPU utilization data: {str(e)}")
+        if allocation.get('energy_share') is not None:
+            # power_draw is the whole GPU's, the allocation draws this share of it
+            result['energy_share'] = allocation['energy_share']
+        
+        # Queue the record, it is written with the next batch (collection and indexes are created at startup)
+        record_utilization_sample(result)
+        
+        # Keep the idle state of the allocation up to date
+        update_idle_state(str(allocation_id), max_utilization, max_memory_used)
         
         return result
         
     except Exception as e:
         logger.error(f"Error checking allocation utilization: {str(e)}")
         return None
-def check_and_revoke_idle_allocation(allocation):
+def check_memory_budget(allocation, memory_used):
+    """Warn the user of a shared GPU using more memory than it reserved, at most once an hour
+    
+    Time-sliced GPUs don't partition memory, so overrunning a reservation
+    can make the other tenants run out of memory.
+    """
+    budget = allocation.get('memory_budget')
+    if allocation.get('unit') != 'shared' or not budget or memory_used <= budget:
+        return
+    if REDIS_CLIENT.set(f"{REDIS_KEYS['memory_budget_warning']}:{allocation['_id']}", 1, nx=True, ex=3600):
+        logger.warning(f"User {allocation['username']} uses {memory_used:.0f} MiB on shared GPU {allocation['gpu_id']}, "
+                       f"{budget:.0f} MiB reserved")
+        notification.send_notification(allocation['username'],
+                                       f"You are using {memory_used / 1024:.1f} GiB on shared GPU {allocation['gpu_id']} but reserved "
+                                       f"{budget / 1024:.1f} GiB. Please stay within your reservation, the GPU is shared with other users.")
+
+def check_allocations_utilization(allocations):
+    """Run check_allocation_utilization for several allocations, e.g. as one RQ job
+    
+    Args:
+        allocations: List of allocation dictionaries
+    """
+    try:
+        for allocation in allocations:
+            check_allocation_utilization(allocation)
+    finally:
+        # Run as an RQ job the samples would be lost with the work horse
+        flush_all_buffers()
+
+def check_idle_allocations():
+    """Check every active allocation for idleness, revoking the idle ones
+    
+    The idle states of all allocations are fetched in one round trip and
+    evaluated against the configured policy in a single pass, so this can
+    run every few minutes across all allocations.
+    """
+    try:
+        policy = IdlePolicy.from_config()
+        with MongoDBConnection() as (client, db):
+            active_allocations = list(db.gpu_allocations.find({'released_at': None}))
+            evaluations = evaluate_idle_allocations(active_allocations, policy)
+            revoked = 0
+            for allocation, evaluation in zip(active_allocations, evaluations):
+                if check_and_revoke_idle_allocation(allocation, db, policy, evaluation):
+                    revoked += 1
+        if revoked:
+            gpus_freed()
+    except Exception as e:
+        logger.error(f"Error in check_idle_allocations: {str(e)}")
+
+def resolve_idle_evaluation(allocation, db, policy, evaluation, now=None):
+    """Complete the idle evaluation of an allocation
+    
+    Allocations younger than the policy window are never idle. When the idle
+    state does not cover the window (e.g. Redis was flushed) the stored
+    samples are summarized instead, using their maxima as the percentile.
+    
+    Args:
+        allocation: Allocation document
+        db: MongoDB database connection
+        policy: IdlePolicy to apply
+        evaluation: Result of evaluate_idle_state() for the allocation
+        now: Datetime to evaluate at (default: now)
+        
+    Returns:
+        dict: The evaluation with 'idle', 'age_hours' and 'source' set
+    """
+    now = datetime.now() if now is None else now
+    evaluation = dict(evaluation, source='idle_state')
+    allocation_time = allocation.get('allocated_at')
+    if allocation_time is None:
+        allocation_record = db.gpu_allocations.find_one({'_id': allocation['_id']})
+        allocation_time = allocation_record['allocated_at'] if allocation_record else now
+    evaluation['age_hours'] = (now - allocation_time).total_seconds() / 3600
+    if evaluation['age_hours'] < policy.window_hours:
+        evaluation['idle'] = False
+        return evaluation
+    
+    if not evaluation['covered']:
+        evaluation['source'] = 'samples'
+        summary = summarize_utilization(db, now - timedelta(hours=policy.window_hours), now, allocation_id=allocation['_id'])
+        evaluation['samples'] = summary['count']
+        if not summary['count']:
+            # Without samples we can't determine if it's idle
+            evaluation['idle'] = False
+            return evaluation
+        evaluation['utilization_percentile'] = summary['gpu_utilization']['max']
+        evaluation['memory_percentile'] = summary['memory_used']['max']
+        evaluation['idle'] = (summary['gpu_utilization']['max'] <= policy.min_utilization and
+                              summary['memory_used']['max'] <= policy.min_memory)
+    return evaluation
+
+def build_idle_report(policy=None):
+    """Report which active allocations would be revoked under a policy, without revoking them
+    
+    Args:
+        policy: IdlePolicy to apply (default: the configured one)
+        
+    Returns:
+        list: One dict per active allocation with its evaluation
+    """
+    policy = IdlePolicy.from_config() if policy is None else policy
+    report = []
+    with MongoDBConnection() as (client, db):
+        active_allocations = list(db.gpu_allocations.find({'released_at': None}))
+        evaluations = evaluate_idle_allocations(active_allocations, policy)
+        for allocation, evaluation in zip(active_allocations, evaluations):
+            evaluation = resolve_idle_evaluation(allocation, db, policy, evaluation)
+            report.append(dict(evaluation,
+                               allocation_id=str(allocation['_id']),
+                               username=allocation['username'],
+                               gpu_id=allocation['gpu_id'],
+                               gpu_type=allocation['gpu_type'],
+                               would_revoke=evaluation['idle']))
+    return report
+
+def check_and_revoke_idle_allocation(allocation, db=None, policy=None, evaluation=None):
     """Check if a GPU allocation has been idle for too long and revoke it if necessary
     
     Args:
         allocation: Allocation object containing username, gpu_id, gpu_type, and _id
+        db: Optional MongoDB database connection to reuse
+        policy: Optional IdlePolicy (default: the configured one)
+        evaluation: Optional evaluate_idle_state() result computed in a batch
         
     Returns:
         bool: True if allocation was revoked, False otherwise
     """
+    if db is None:
+        with MongoDBConnection() as (client, db):
+            return check_and_revoke_idle_allocation(allocation, db, policy, evaluation)
     try:
         username = allocation['username']
         gpu_id = allocation['gpu_id']
         gpu_type = allocation['gpu_type']
         allocation_id = allocation['_id']
         
-        # Get configuration values
-        idle_hours = config('REVOKE_IDLE_GPU_AFTER_HOURS', default=24, cast=int)
-        min_gpu_util = config('MIN_GPU_UTILIZATION_PERCENT', default=5.0, cast=float)
-        min_gpu_mem = config('MIN_GPU_MEMORY_GB', default=2.0, cast=float) * 1024  #MB
+        if policy is None:
+            policy = IdlePolicy.from_config()
+        if evaluation is None:
+            evaluation = evaluate_idle_allocations([allocation], policy)[0]
+        evaluation = resolve_idle_evaluation(allocation, db, policy, evaluation)
+        idle_hours = policy.window_hours
         
-        # Connect to database
-        with MongoDBConnection() as (client, db):
-            # First check if the allocation has existed for at least REVOKE_IDLE_GPU_AFTER_HOURS
-            allocation_record = db.gpu_allocations.find_one({'_id': allocation_id})
-            if not allocation_record:
-                logger.debug(f"Allocation {allocation_id} not found in database")
-                return False
-                
-            # Calculate how long the allocation has existed
-            allocation_time = allocation_record['allocated_at']
-            current_time = datetime.now()
-            allocation_age_hours = (current_time - allocation_time).total_seconds() / 3600
-            # If allocation hasn't existed for the minimum time, skip the check
-            if allocation_age_hours < idle_hours:
-                logger.debug(f"Allocation {allocation_id} has only existed for {allocation_age_hours:.2f} hours, "
-                           f"which is less than the required {idle_hours} hours for idle check")
-                return False
-            
-            logger.debug(f"Checking if allocation {allocation_id} for GPU {gpu_id} by {username} has been idle for {idle_hours} hours")
-            
-            # Calculate the time threshold for utilization records
-            time_threshold = current_time - timedelta(hours=idle_hours)
-            
-            # Find utilization records for this allocation within the time period
-            utilization_records = list(db.gpu_utilization.find({
-                'allocation_id': str(allocation_id),
-                'timestamp': {'$gte': time_threshold}
-            }).sort('timestamp', pymongo.ASCENDING))
+        if evaluation['age_hours'] < idle_hours:
+            logger.debug(f"Allocation {allocation_id} has only existed for {evaluation['age_hours']:.2f} hours, "
+                       f"which is less than the required {idle_hours} hours for idle check")
+            return False
+        if not evaluation['samples']:
+            logger.debug(f"No utilization records found for allocation {allocation_id}")
+            return False
+        
+        utilization = evaluation['utilization_percentile']
+        memory = evaluation['memory_percentile']
+        logger.debug(f"Allocation {allocation_id}: p{policy.percentile:g} utilization={utilization}%, "
+                     f"p{policy.percentile:g} memory={memory}MB, EWMA={evaluation['ewma_utilization']}%/{evaluation['ewma_memory']}MB")
+        if evaluation['idle']:
+            logger.info(f"Allocation {allocation_id} for GPU {gpu_id} by {username} has been idle for at least {idle_hours} hours. "
+                       f"p{policy.percentile:g} utilization: {utilization}% (threshold: {policy.min_utilization}%), "
+                       f"p{policy.percentile:g} memory: {memory}MB (threshold: {policy.min_memory}MB)")
             
-            # If no records found, we can't determine if it's idle
-            if not utilization_records:
-                logger.debug(f"No utilization records found for allocation {allocation_id}")
-                return False
-                
-            # Calculate maximum utilization and memory usage
-            utilization_list = [record['gpu_utilization'] for record in utilization_records]
-            memory_list = [record['memory_used'] for record in utilization_records]
-            max_utilization=max(utilization_list)
-            max_memory=max(memory_list)
-            logger.debug(f"Allocation {allocation_id}: Max utilization={max_utilization}%, Max memory={max_memory}MB")
-            # Check if either utilization or memory is below thresholds
-            if len(set(memory_list))==1 and len(set(utilization_list))==1:
-                logger.info(f"Allocation {allocation_id} for GPU {gpu_id} by {username} has been idle for at least {idle_hours} hours. "
-                           f"Max utilization: {max_utilization}% (threshold: {min_gpu_util}%), "
-                           f"Max memory: {max_memory}MB (threshold: {min_gpu_mem}MB)")
-                
-                # Revoke the allocation
-                if not is_user_using_gpu(username, gpu_id) or config('FORCE_REVOKE', default=False, cast=bool):
-                    logger.info(f"GPU {gpu_id} is not being used by {username}, skipping idle check")
-                    if unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=f"Released due to idle"):
-                        logger.info(f"Successfully revoked idle allocation {allocation_id} for GPU {gpu_id} from user {username}")
-                        return True
-                    else:
-                        logger.error(f"Failed to revoke idle allocation {allocation_id}")
-                        return False
+            # Revoke the allocation
+            process_map = get_gpu_process_map([gpu_id])
+            if not is_user_using_gpu(username, gpu_id, process_map) or config('FORCE_REVOKE', default=False, cast=bool):
+                logger.info(f"GPU {gpu_id} is not being used by {username}, skipping idle check")
+                if unallocate_gpu(username, gpu_id, gpu_type, allocation_id, db, comment=f"Released due to idle", process_map=process_map):
+                    logger.info(f"Successfully revoked idle allocation {allocation_id} for GPU {gpu_id} from user {username}")
+                    return True
                 else:
+                    logger.error(f"Failed to revoke idle allocation {allocation_id}")
+                    return False
+            else:
+                # The check runs every few minutes, warn once per idle window
+                if REDIS_CLIENT.set(f"{REDIS_KEYS['idle_warning']}:{allocation_id}", 1, nx=True, ex=max(1, int(idle_hours * 3600))):
                     authorized_users = config('PRIVILEGED_USERS', cast=Csv())
                     for user in authorized_users:
                         notification.send_notification(user,f"GPU {gpu_id} is being idle at least {idle_hours} hours, but {username} has active process on it.")
                    
                     notification.send_notification(username,f"GPU {gpu_id} is being idle at least {idle_hours} hours, but you have active process on it please consider releasing it.")
-                    logger.warning(f"GPU {gpu_id} is being used by {username}, but utilization and memory are below thresholds")
-                    return False
-            else:
-                logger.debug(f"Allocation {allocation_id} is not idle (util: {max_utilization}%, mem: {max_memory}MB)")
+                logger.warning(f"GPU {gpu_id} is being used by {username}, but utilization and memory are below thresholds")
                 return False
-                            
+        else:
+            logger.debug(f"Allocation {allocation_id} is not idle (util: {utilization}%, mem: {memory}MB)")
+            return False
+                        
     except Exception as e:
         logger.error(f"Error checking idle allocation {allocation['_id'] if 'allocation' in locals() else 'unknown'}: {str(e)}")
-        return False
\ No newline at end of file
+        return False
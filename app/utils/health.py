@@ -0,0 +1,199 @@
+import json
+import time
+from datetime import datetime
+import pymongo
+from decouple import config, Csv
+from app.utils.logger import logger
+from app.utils import notification
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.gpu_backend import HEALTH_FIELDS
+from app.utils.ingest import get_health_buffer
+
+# Clock throttle reasons (NVML bitmask) that mean the GPU is slowed down by a fault,
+# as opposed to being idle or capped by application/power settings
+THROTTLE_REASONS = {
+    0x8: 'hardware slowdown',
+    0x20: 'software thermal slowdown',
+    0x40: 'hardware thermal slowdown',
+    0x80: 'hardware power brake slowdown'
+}
+
+# Replaces the health states of GPUs that weren't changed since they were read.
+# KEYS: health hash. ARGV: GPU ID, state read (empty if none) and new state of each GPU
+# Returns the IDs of the GPUs whose state was replaced
+_SWAP_STATES_SCRIPT = REDIS_CLIENT.register_script("""
+local swapped = {}
+for i = 1, #ARGV, 3 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i]) or ''
+    if current == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+        table.insert(swapped, ARGV[i])
+    end
+end
+return swapped
+""")
+
+def check_gpu_health(gpu, baseline=None):
+    """Find the health problems of a GPU sample
+
+    Uncorrectable ECC errors and pending retired pages stay reported until
+    the driver is reset, so only those beyond the baseline taken when an
+    admin last cleared the GPU count.
+
+    Args:
+        gpu: GPU dict as returned by GPUBackend.query_gpus()
+        baseline: Optional {'ecc_errors', 'retired_pages_pending'} readings when the GPU was cleared
+
+    Returns:
+        list: Human readable problems, empty if the GPU looks healthy
+    """
+    baseline = baseline or {}
+    problems = []
+    max_temperature = config('GPU_HEALTH_MAX_TEMPERATURE', default=90, cast=float)
+    if gpu.get('temperature') is not None and gpu['temperature'] >= max_temperature:
+        problems.append(f"temperature {gpu['temperature']:g}C (limit {max_temperature:g}C)")
+    if gpu.get('throttle_reasons'):
+        for bit, reason in THROTTLE_REASONS.items():
+            if gpu['throttle_reasons'] & bit:
+                problems.append(reason)
+    ecc_errors = (gpu.get('ecc_errors') or 0) - (baseline.get('ecc_errors') or 0)
+    if ecc_errors > 0:
+        problems.append(f"{ecc_errors} uncorrectable ECC errors")
+    if gpu.get('retired_pages_pending') and not baseline.get('retired_pages_pending'):
+        problems.append("retired pages pending")
+    return problems
+
+def _read_health_states():
+    return {int(gpu_id): json.loads(state) for gpu_id, state in REDIS_CLIENT.hgetall(REDIS_KEYS['gpu_health']).items()}
+
+def _swap_health_states(swaps):
+    """Write {gpu_id: (state read or None, new state)} unless a state changed since it was read
+
+    Returns:
+        set: IDs of the GPUs whose state was written
+    """
+    args = [value for gpu_id, (old, new) in swaps.items() for value in (gpu_id, old or '', new)]
+    return {int(gpu_id) for gpu_id in _SWAP_STATES_SCRIPT(keys=[REDIS_KEYS['gpu_health']], args=args)} if args else set()
+
+def update_gpu_health(gpus, timestamp=None):
+    """Fold a sample of every GPU into the per-GPU health state
+
+    A GPU is marked unhealthy once its problems persist for
+    GPU_HEALTH_GRACE_SAMPLES consecutive samples, so a short thermal spike
+    doesn't exclude it. An unhealthy GPU stays so until an admin clears it,
+    even if its readings recover. A state changed meanwhile, e.g. by
+    clear_gpu_health(), is left alone until the next sample.
+
+    Args:
+        gpus: List of GPU dicts as returned by GPUBackend.query_gpus()
+        timestamp: Epoch time of the sample (default: now)
+
+    Returns:
+        list: IDs of the GPUs that just became unhealthy
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    grace_samples = config('GPU_HEALTH_GRACE_SAMPLES', default=3, cast=int)
+    raw_states = {int(gpu_id): state for gpu_id, state in REDIS_CLIENT.hgetall(REDIS_KEYS['gpu_health']).items()}
+    swaps = {}
+    newly_unhealthy = []
+    for gpu in gpus:
+        gpu_id = gpu['index']
+        raw_state = raw_states.get(gpu_id)
+        state = json.loads(raw_state) if raw_state else {'status': 'healthy', 'strikes': 0, 'reasons': [], 'since': timestamp}
+        baseline = state.get('baseline')
+        if baseline and baseline.get('retired_pages_pending') and not gpu.get('retired_pages_pending'):
+            # The pages were retired by a reset, new pending pages count again
+            baseline['retired_pages_pending'] = False
+        problems = check_gpu_health(gpu, baseline)
+        if state['status'] == 'healthy':
+            state['strikes'] = state['strikes'] + 1 if problems else 0
+            state['reasons'] = problems
+            if state['strikes'] >= grace_samples:
+                state.update({'status': 'unhealthy', 'since': timestamp})
+                newly_unhealthy.append(gpu_id)
+        elif problems:
+            # Keep the reasons that got it excluded, add any new ones
+            state['reasons'] = state['reasons'] + [problem for problem in problems if problem not in state['reasons']]
+        state['last_checked'] = timestamp
+        state.update({field: gpu.get(field) for field in HEALTH_FIELDS})
+        swaps[gpu_id] = (raw_state, json.dumps(state))
+
+    written = _swap_health_states(swaps)
+    newly_unhealthy = [gpu_id for gpu_id in newly_unhealthy if gpu_id in written]
+    for gpu_id in newly_unhealthy:
+        reasons = ', '.join(json.loads(swaps[gpu_id][1])['reasons'])
+        logger.warning(f"GPU {gpu_id} marked unhealthy and excluded from allocation: {reasons}")
+        for user in config('PRIVILEGED_USERS', cast=Csv()):
+            notification.send_notification(user, f"GPU {gpu_id} was marked unhealthy and excluded from allocation: {reasons}")
+    return newly_unhealthy
+
+def get_gpu_health():
+    """Get the health state of every GPU
+
+    Returns:
+        dict: {gpu_id: {'status', 'reasons', 'since', 'last_checked', ...HEALTH_FIELDS}}
+    """
+    return _read_health_states()
+
+def get_unhealthy_gpus():
+    """Get the IDs of the GPUs excluded from allocation
+
+    Returns:
+        set: IDs of the unhealthy GPUs
+    """
+    return {gpu_id for gpu_id, state in _read_health_states().items() if state['status'] == 'unhealthy'}
+
+def clear_gpu_health(gpu_id, cleared_by):
+    """Mark a GPU healthy again so it can be allocated
+
+    The GPU's current ECC error count and pending retired pages become its
+    baseline, so the errors it was cleared with don't exclude it again.
+
+    Args:
+        gpu_id: ID of the GPU to clear
+        cleared_by: Username of the admin clearing it
+
+    Returns:
+        bool: True if the GPU was unhealthy
+    """
+    raw_state = REDIS_CLIENT.hget(REDIS_KEYS['gpu_health'], gpu_id)
+    state = json.loads(raw_state) if raw_state else None
+    if not state or state['status'] != 'unhealthy':
+        return False
+    state.update({'status': 'healthy', 'strikes': 0, 'reasons': [], 'since': time.time(),
+                  'baseline': {'ecc_errors': state.get('ecc_errors') or 0,
+                               'retired_pages_pending': bool(state.get('retired_pages_pending'))}})
+    if not _swap_health_states({gpu_id: (raw_state, json.dumps(state))}):
+        # The collector wrote a new sample meanwhile, clear that one instead
+        return clear_gpu_health(gpu_id, cleared_by)
+    logger.info(f"GPU {gpu_id} health cleared by {cleared_by}")
+    return True
+
+def record_gpu_health(gpus, timestamp=None):
+    """Append the health readings of every GPU to the gpu_health collection
+
+    Args:
+        gpus: List of GPU dicts as returned by GPUBackend.query_gpus()
+        timestamp: Datetime of the sample (default: now)
+    """
+    timestamp = datetime.now() if timestamp is None else timestamp
+    states = _read_health_states()
+    buffer = get_health_buffer()
+    for gpu in gpus:
+        document = {'timestamp': timestamp, 'gpu_id': gpu['index'],
+                    'status': states.get(gpu['index'], {}).get('status', 'healthy')}
+        document.update({field: gpu.get(field) for field in HEALTH_FIELDS})
+        buffer.add(document)
+
+def get_gpu_health_history(db, gpu_id, start, end):
+    """Get the recorded health readings of a GPU
+
+    Returns:
+        list: {'timestamp', 'status', ...HEALTH_FIELDS} points, oldest first
+    """
+    series = []
+    query = {'gpu_id': gpu_id, 'timestamp': {'$gte': start, '$lt': end}}
+    for document in db.gpu_health.find(query, {'_id': 0, 'gpu_id': 0}).sort('timestamp', pymongo.ASCENDING):
+        document['timestamp'] = document['timestamp'].isoformat()
+        series.append(document)
+    return series
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import uuid
+from functools import wraps
+from flask import request, session, flash, redirect, url_for
+from decouple import config
+from app.utils.logger import logger
+from app.config import REDIS_CLIENT, REDIS_KEYS
+
+# A request that is still running holds its key this long, so a worker
+# killed mid-request doesn't block retries for the whole TTL
+_PENDING_TTL_SECONDS = 120
+
+def new_idempotency_key():
+    """Fresh key for a form, every render gets its own so only resubmissions of the same form repeat it"""
+    return uuid.uuid4().hex
+
+def _fingerprint():
+    """Hash of the submitted form, a key reused for a different request is refused"""
+    form = sorted((field, value) for field, value in request.form.items(multi=True) if field != 'idempotency_key')
+    return hashlib.sha256(json.dumps([request.endpoint, form]).encode()).hexdigest()
+
+def idempotent(f):
+    """Run a POST route at most once per idempotency key
+
+    The key comes from the idempotency_key form field or the Idempotency-Key
+    header. The first request with a key runs the route and stores its
+    flashed messages and redirect for IDEMPOTENCY_TTL_SECONDS, duplicates
+    replay them without doing the work again. Requests without a key run as
+    usual.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        redis_key = f"{REDIS_KEYS['idempotency']}:{session.get('username')}:{key}"
+        fingerprint = _fingerprint()
+
+        if not REDIS_CLIENT.set(redis_key, json.dumps({'status': 'pending', 'fingerprint': fingerprint}),
+                                nx=True, ex=_PENDING_TTL_SECONDS):
+            stored = REDIS_CLIENT.get(redis_key)
+            outcome = json.loads(stored) if stored else {'status': 'pending', 'fingerprint': fingerprint}
+            if outcome['fingerprint'] != fingerprint:
+                flash("This request ID was already used for a different request", "error")
+            elif outcome['status'] == 'pending':
+                flash("This request is already being processed", "info")
+            else:
+                logger.info(f"Replaying the result of request {key} of {session.get('username')} to {request.endpoint}")
+                for category, message in outcome['flashes']:
+                    flash(message, category)
+                return redirect(outcome['location'])
+            return redirect(url_for('dashboard.dashboard'))
+
+        flashes_before = len(session.get('_flashes', []))
+        try:
+            response = f(*args, **kwargs)
+        except Exception:
+            REDIS_CLIENT.delete(redis_key)
+            raise
+        outcome = {
+            'status': 'done',
+            'fingerprint': fingerprint,
+            'flashes': session.get('_flashes', [])[flashes_before:],
+            'location': response.location if getattr(response, 'location', None) else url_for('dashboard.dashboard')
+        }
+        REDIS_CLIENT.set(redis_key, json.dumps(outcome), ex=config('IDEMPOTENCY_TTL_SECONDS', default=86400, cast=int))
+        return response
+    return decorated_function
@@ -0,0 +1,247 @@
+import json
+import math
+import time
+from decouple import config
+from app.config import REDIS_CLIENT, REDIS_KEYS
+
+# Idle state of an allocation is dropped this long after its last sample
+IDLE_STATE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Histogram slots are one hour wide and kept for the longest window a policy may ask for
+HISTOGRAM_SLOT_SECONDS = 3600
+HISTOGRAM_MAX_SLOTS = 7 * 24
+
+# Edges of the histogram bins, utilization in percent and memory in MiB
+UTILIZATION_BINS = (0, 1, 2, 5, 10, 20, 30, 50, 75, 90, 100)
+MEMORY_BINS = (0, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 1048576)
+
+SCALAR_FIELDS = ('first_sample_at', 'last_sample_at', 'last_utilization', 'last_memory',
+                 'max_utilization', 'max_memory', 'ewma_utilization', 'ewma_memory', 'samples')
+
+class IdlePolicy:
+    """Thresholds deciding when an allocation counts as idle
+
+    An allocation is idle when, over the last window_hours, the given
+    percentile of both its utilization and memory usage stays below the
+    thresholds, and so do their exponentially weighted moving averages.
+    """
+    def __init__(self, window_hours, min_utilization, min_memory, percentile):
+        self.window_hours = window_hours
+        self.min_utilization = min_utilization
+        self.min_memory = min_memory
+        self.percentile = percentile
+
+    @classmethod
+    def from_config(cls, **overrides):
+        """Build the policy configured in .env, optionally overriding some thresholds"""
+        policy = {
+            'window_hours': config('REVOKE_IDLE_GPU_AFTER_HOURS', default=24, cast=int),
+            'min_utilization': config('MIN_GPU_UTILIZATION_PERCENT', default=5.0, cast=float),
+            'min_memory': config('MIN_GPU_MEMORY_GB', default=2.0, cast=float) * 1024,  #MB
+            'percentile': config('IDLE_PERCENTILE', default=95.0, cast=float)
+        }
+        policy.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**policy)
+
+    def to_dict(self):
+        return {
+            'window_hours': self.window_hours,
+            'min_utilization': self.min_utilization,
+            'min_memory': self.min_memory,
+            'percentile': self.percentile
+        }
+
+def _idle_state_key(allocation_id):
+    return f"{REDIS_KEYS['idle_state']}:{allocation_id}"
+
+def _bin_index(bins, value):
+    index = 0
+    while index + 2 < len(bins) and value >= bins[index + 1]:
+        index += 1
+    return index
+
+def _parse_idle_state(state):
+    if not state:
+        return None
+    parsed = {'histograms': {}}
+    for field, value in state.items():
+        if field.startswith('hist:'):
+            parsed['histograms'][int(field[5:])] = json.loads(value)
+        else:
+            parsed[field] = float(value)
+    parsed['samples'] = int(parsed['samples'])
+    return parsed
+
+def update_idle_state(allocation_id, utilization, memory_used, timestamp=None):
+    """Fold a utilization sample into the idle state of an allocation
+
+    Called at ingest time so deciding whether an allocation is idle never
+    needs to read its sample history. The state holds the last sample,
+    running maxima, time-decayed EWMAs and hourly histograms of utilization
+    and memory usage from which window percentiles are computed.
+
+    Args:
+        allocation_id: ID of the allocation the sample belongs to
+        utilization: GPU utilization of the sample in percent
+        memory_used: GPU memory used of the sample in MiB
+        timestamp: Epoch time of the sample (default: now)
+
+    Returns:
+        dict: The updated idle state
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    half_life = config('IDLE_EWMA_HALF_LIFE_MINUTES', default=60, cast=float) * 60
+    key = _idle_state_key(allocation_id)
+    state = get_idle_state(allocation_id)
+
+    if state is None:
+        state = {
+            'first_sample_at': timestamp,
+            'max_utilization': utilization,
+            'max_memory': memory_used,
+            'ewma_utilization': utilization,
+            'ewma_memory': memory_used,
+            'samples': 0,
+            'histograms': {}
+        }
+    else:
+        # Time-decayed weight so irregular sampling intervals are handled correctly
+        alpha = 1 - math.pow(0.5, max(0.0, timestamp - state['last_sample_at']) / half_life)
+        state['ewma_utilization'] += alpha * (utilization - state['ewma_utilization'])
+        state['ewma_memory'] += alpha * (memory_used - state['ewma_memory'])
+
+    state['last_sample_at'] = timestamp
+    state['last_utilization'] = utilization
+    state['last_memory'] = memory_used
+    state['max_utilization'] = max(state['max_utilization'], utilization)
+    state['max_memory'] = max(state['max_memory'], memory_used)
+    state['samples'] += 1
+
+    slot = int(timestamp // HISTOGRAM_SLOT_SECONDS)
+    histogram = state['histograms'].setdefault(slot, {
+        'utilization': [0] * (len(UTILIZATION_BINS) - 1),
+        'memory': [0] * (len(MEMORY_BINS) - 1)
+    })
+    histogram['utilization'][_bin_index(UTILIZATION_BINS, utilization)] += 1
+    histogram['memory'][_bin_index(MEMORY_BINS, memory_used)] += 1
+    expired_slots = [old_slot for old_slot in state['histograms'] if old_slot <= slot - HISTOGRAM_MAX_SLOTS]
+
+    pipe = REDIS_CLIENT.pipeline()
+    mapping = {field: state[field] for field in SCALAR_FIELDS}
+    mapping[f'hist:{slot}'] = json.dumps(histogram)
+    pipe.hset(key, mapping=mapping)
+    if expired_slots:
+        pipe.hdel(key, *[f'hist:{old_slot}' for old_slot in expired_slots])
+    pipe.expire(key, IDLE_STATE_TTL_SECONDS)
+    pipe.execute()
+    for old_slot in expired_slots:
+        del state['histograms'][old_slot]
+    return state
+
+def get_idle_state(allocation_id):
+    """Get the idle state of an allocation
+
+    Returns:
+        dict: first/last sample timestamps, last and max
+              utilization and memory, EWMAs, sample count and hourly
+              histograms; None if no sample was seen
+    """
+    return _parse_idle_state(REDIS_CLIENT.hgetall(_idle_state_key(allocation_id)))
+
+def get_idle_states(allocation_ids):
+    """Get the idle states of many allocations in a single round trip
+
+    Returns:
+        list: Idle states in the order of allocation_ids, None where unknown
+    """
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for allocation_id in allocation_ids:
+        pipe.hgetall(_idle_state_key(allocation_id))
+    return [_parse_idle_state(state) for state in pipe.execute()]
+
+def clear_idle_state(allocation_id):
+    """Forget the idle state and idle warning of a released allocation"""
+    REDIS_CLIENT.delete(_idle_state_key(allocation_id), f"{REDIS_KEYS['idle_warning']}:{allocation_id}")
+
+def _percentile_upper_bound(bins, counts, percentile):
+    """Upper edge of the histogram bin holding the given percentile"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = math.ceil(total * percentile / 100)
+    cumulative = 0
+    for index, count in enumerate(counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bins[index + 1]
+    return bins[-1]
+
+def evaluate_idle_state(state, policy, now=None):
+    """Decide whether an allocation is idle under a policy
+
+    Percentiles are read from the hourly histograms of the policy window
+    and are upper bounds at bin granularity, so an allocation straddling
+    a threshold is never reported idle.
+
+    Args:
+        state: Idle state as returned by get_idle_state()
+        policy: IdlePolicy to apply
+        now: Epoch time to evaluate at (default: now)
+
+    Returns:
+        dict: {'covered', 'idle', 'samples', 'utilization_percentile',
+               'memory_percentile', 'ewma_utilization', 'ewma_memory'}
+    """
+    now = time.time() if now is None else now
+    window_start = now - policy.window_hours * 3600
+    evaluation = {
+        'covered': False,
+        'idle': False,
+        'samples': 0,
+        'utilization_percentile': None,
+        'memory_percentile': None,
+        'ewma_utilization': None,
+        'ewma_memory': None
+    }
+    if state is None:
+        return evaluation
+
+    first_slot = int(window_start // HISTOGRAM_SLOT_SECONDS)
+    utilization_counts = [0] * (len(UTILIZATION_BINS) - 1)
+    memory_counts = [0] * (len(MEMORY_BINS) - 1)
+    for slot, histogram in state['histograms'].items():
+        if slot < first_slot:
+            continue
+        utilization_counts = [a + b for a, b in zip(utilization_counts, histogram['utilization'])]
+        memory_counts = [a + b for a, b in zip(memory_counts, histogram['memory'])]
+
+    evaluation.update({
+        # Only decide once samples cover the whole window
+        'covered': state['first_sample_at'] <= window_start,
+        'samples': sum(utilization_counts),
+        'utilization_percentile': _percentile_upper_bound(UTILIZATION_BINS, utilization_counts, policy.percentile),
+        'memory_percentile': _percentile_upper_bound(MEMORY_BINS, memory_counts, policy.percentile),
+        'ewma_utilization': state['ewma_utilization'],
+        'ewma_memory': state['ewma_memory']
+    })
+    evaluation['idle'] = (evaluation['covered'] and evaluation['samples'] > 0
+                          and evaluation['utilization_percentile'] <= policy.min_utilization
+                          and evaluation['memory_percentile'] <= policy.min_memory
+                          and state['ewma_utilization'] < policy.min_utilization
+                          and state['ewma_memory'] < policy.min_memory)
+    return evaluation
+
+def evaluate_idle_allocations(allocations, policy, now=None):
+    """Evaluate many allocations against a policy in one pass
+
+    Args:
+        allocations: Allocation documents with an '_id'
+        policy: IdlePolicy to apply
+        now: Epoch time to evaluate at (default: now)
+
+    Returns:
+        list: evaluate_idle_state() results in the order of allocations
+    """
+    now = time.time() if now is None else now
+    states = get_idle_states([str(allocation['_id']) for allocation in allocations])
+    return [evaluate_idle_state(state, policy, now) for state in states]
@@ -0,0 +1,214 @@
+import atexit
+import pickle
+import threading
+import time
+from decouple import config
+from pymongo.errors import BulkWriteError
+from app.utils.logger import logger
+from app.utils.db import get_db_connection
+from app.config import REDIS_BINARY, REDIS_KEYS
+
+class SampleBuffer:
+    """Bounded in-memory buffer batching documents into one collection
+
+    Documents are flushed with a single unordered insert_many once
+    batch_size of them are pending or flush_interval seconds have passed,
+    from a background thread holding one long-lived MongoDB connection.
+    When max_size documents are pending, add() blocks until a flush makes
+    room, so producers slow down instead of growing memory without bound.
+    """
+    def __init__(self, collection_name, batch_size=500, flush_interval=10.0, max_size=10000, block_timeout=5.0):
+        self.collection_name = collection_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.block_timeout = block_timeout
+        self._pending = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._client = None
+        self._collection = None
+        self._closed = False
+        self._thread = None
+
+    def _get_collection(self):
+        if self._collection is None:
+            self._client, db = get_db_connection()
+            self._collection = db[self.collection_name]
+        return self._collection
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=f"{self.collection_name}-flusher", daemon=True)
+            self._thread.start()
+
+    def add(self, document):
+        """Queue a document for insertion
+
+        Args:
+            document: Document to insert
+
+        Returns:
+            bool: False if the buffer stayed full for block_timeout and the document was dropped
+        """
+        with self._condition:
+            if self._closed:
+                logger.warning(f"{self.collection_name} buffer is closed, dropping document")
+                return False
+            self._start()
+            deadline = time.monotonic() + self.block_timeout
+            while len(self._pending) >= self.max_size:
+                # Backpressure: wait for the flusher to make room
+                self._condition.notify_all()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"{self.collection_name} buffer is full, dropping document")
+                    return False
+                self._condition.wait(remaining)
+            self._pending.append(document)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+            return True
+
+    def flush(self):
+        """Insert every pending document now
+
+        Returns:
+            int: Number of documents inserted
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, []
+                self._condition.notify_all()
+            if not batch:
+                return 0
+            try:
+                return len(self._get_collection().insert_many(batch, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                # Unordered: everything but the failed documents was inserted
+                logger.error(f"Failed to insert {len(e.details.get('writeErrors', []))} documents into {self.collection_name}")
+                return e.details.get('nInserted', 0)
+            except Exception as e:
+                logger.error(f"Failed to flush {len(batch)} documents into {self.collection_name}: {str(e)}")
+                with self._condition:
+                    # Keep them for the next flush as far as the buffer allows
+                    room = max(0, self.max_size - len(self._pending))
+                    self._pending = batch[:room] + self._pending
+                return 0
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self):
+        """Stop accepting documents and drain the buffer"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.flush()
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+            self._collection = None
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+def _get_buffer(collection_name):
+    with _buffers_lock:
+        if collection_name not in _buffers:
+            _buffers[collection_name] = SampleBuffer(
+                collection_name,
+                batch_size=config('GPU_UTILIZATION_BATCH_SIZE', default=500, cast=int),
+                flush_interval=config('GPU_UTILIZATION_FLUSH_SECONDS', default=10, cast=float),
+                max_size=config('GPU_UTILIZATION_BUFFER_SIZE', default=10000, cast=int)
+            )
+            atexit.register(_buffers[collection_name].close)
+        return _buffers[collection_name]
+
+def flush_all_buffers():
+    """Insert the pending documents of every buffer now
+
+    RQ work horses leave through os._exit, skipping the drain at exit, so
+    jobs that record samples call this before they return.
+    """
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+    for buffer in buffers:
+        buffer.flush()
+
+def get_utilization_buffer():
+    """Get the process-wide buffer of raw utilization samples, drained at exit"""
+    return _get_buffer('gpu_utilization')
+
+def get_user_memory_buffer():
+    """Get the process-wide buffer of per-user GPU memory samples, drained at exit"""
+    return _get_buffer('gpu_user_memory')
+
+def get_health_buffer():
+    """Get the process-wide buffer of GPU health readings, drained at exit"""
+    return _get_buffer('gpu_health')
+
+def _run_key(allocation_id):
+    return f"{REDIS_KEYS['utilization_run']}:{allocation_id}"
+
+def _extends_run(run, record):
+    max_run = config('GPU_UTILIZATION_MAX_RUN_MINUTES', default=60, cast=int) * 60
+    return (abs(record['gpu_utilization'] - run['gpu_utilization']) <= config('GPU_UTILIZATION_RUN_TOLERANCE_PERCENT', default=1.0, cast=float)
+            and abs(record['memory_used'] - run['memory_used']) <= config('GPU_UTILIZATION_RUN_TOLERANCE_MB', default=16.0, cast=float)
+            and (record['timestamp'] - run['timestamp']).total_seconds() < max_run)
+
+def record_utilization_sample(record):
+    """Store a utilization record of an allocation
+
+    With GPU_UTILIZATION_COMPACT_STORAGE enabled, consecutive records whose
+    utilization and memory usage stay within a tolerance of the first one
+    are kept as a single open run in Redis. A run is written as one document
+    with its first values, 'timestamp' and 'end_timestamp' of its first and
+    last samples and their 'count' once a record differs, the next record
+    would take it past GPU_UTILIZATION_MAX_RUN_MINUTES or the allocation is
+    released.
+
+    Args:
+        record: Utilization record with allocation_id, gpu_utilization, memory_used and timestamp
+    """
+    if not config('GPU_UTILIZATION_COMPACT_STORAGE', default=False, cast=bool):
+        get_utilization_buffer().add(dict(record))
+        return
+
+    key = _run_key(record['allocation_id'])
+    run = REDIS_BINARY.get(key)
+    run = pickle.loads(run) if run else None
+    if run and _extends_run(run, record):
+        run['end_timestamp'] = record['timestamp']
+        run['count'] += 1
+    else:
+        if run:
+            get_utilization_buffer().add(run)
+        run = dict(record, end_timestamp=record['timestamp'], count=1)
+    # Close a run the next record can't extend anymore rather than waiting
+    # for that record, so runs are written at most GPU_UTILIZATION_MAX_RUN_MINUTES after they start
+    interval = config('GPU_ACTIVITY_CHECK_MINUTES', default=5, cast=int) * 60
+    max_run = config('GPU_UTILIZATION_MAX_RUN_MINUTES', default=60, cast=int) * 60
+    if (run['end_timestamp'] - run['timestamp']).total_seconds() + interval >= max_run:
+        get_utilization_buffer().add(run)
+        REDIS_BINARY.delete(key)
+        return
+    # Open runs of vanished allocations expire on their own
+    REDIS_BINARY.set(key, pickle.dumps(run), ex=2 * config('GPU_UTILIZATION_MAX_RUN_MINUTES', default=60, cast=int) * 60)
+
+def close_utilization_run(allocation_id):
+    """Write the open run of an allocation, e.g. when it is released"""
+    run = REDIS_BINARY.getdel(_run_key(allocation_id))
+    if run:
+        get_utilization_buffer().add(pickle.loads(run))
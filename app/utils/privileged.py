@@ -0,0 +1,279 @@
+import json
+import os
+import pwd
+import socket
+import subprocess
+import threading
+from decouple import config
+from app.utils.logger import logger
+
+# Device ACLs, other users' GPU processes, signals and disk usage need
+# root. They go through a PrivilegedHelper: the root daemon of
+# privileged_helper.py over its Unix socket, one request per batch of
+# commands, or `sudo` per command when the daemon isn't installed. The
+# commands and their results are the same for all of them, see the
+# docstring of privileged_helper.py.
+
+def _process_owner(pid):
+    """Real UID owning a process, None if it is gone"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Uid:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+class HelperError(Exception):
+    """A privileged command failed or the helper couldn't be reached"""
+
+class PrivilegedHelper:
+    """Interface of the privileged helpers
+
+    execute() runs a batch of commands and returns one
+    {'ok': bool, 'result' or 'error'} dict per command, the other methods
+    run a single command and raise HelperError when it fails.
+    """
+    name = None
+
+    def execute(self, commands):
+        raise NotImplementedError
+
+    def _call(self, op, **args):
+        result = self.execute([dict(args, op=op)])[0]
+        if not result['ok']:
+            raise HelperError(result['error'])
+        return result.get('result')
+
+    def set_device_acl(self, username, devices, permission):
+        """Set a user's ACL entry on devices
+
+        Args:
+            username: User whose entry is changed
+            devices: Device paths, /dev/nvidiaN or MIG capability devices
+            permission: 'rw', 'none' to deny access, or None to remove the entry
+        """
+        return self._call('set_acl', username=username, devices=list(devices), permission=permission)
+
+    def get_device_acls(self, devices):
+        """Get the named user entries of the ACLs of devices
+
+        Returns:
+            dict: {device: {username: 'rw-'}}
+        """
+        return self._call('get_acl', devices=list(devices))
+
+    def gpu_processes(self, gpu_ids=None):
+        """List the compute processes of all users on the GPUs
+
+        Returns:
+            list: {'gpu_uuid', 'pid', 'used_memory'} dicts, memory in MiB
+        """
+        return self._call('gpu_processes', gpu_ids=None if gpu_ids is None else list(gpu_ids))
+
+    def kill_processes(self, username, pids, signal='KILL'):
+        """Signal processes of a user, PIDs owned by someone else are skipped
+
+        Returns:
+            dict: {'signalled': [pid, ...], 'skipped': [pid, ...]}
+        """
+        return self._call('kill', username=username, pids=list(pids), signal=signal)
+
+    def disk_usage(self, username):
+        """Bytes used by a user's home directory"""
+        return self._call('disk_usage', username=username)
+
+    def mig_instances(self):
+        """The GPU instance table printed by `nvidia-smi mig -lgi`, empty without MIG"""
+        return self._call('mig_instances')
+
+class SocketHelper(PrivilegedHelper):
+    """Helper talking to the root daemon, one round trip per batch"""
+    name = 'socket'
+
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+
+    def execute(self, commands):
+        if not commands:
+            return []
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(self.timeout)
+                connection.connect(self.path)
+                connection.sendall(json.dumps({'commands': commands}).encode() + b'\n')
+                with connection.makefile('rb') as reader:
+                    line = reader.readline()
+        except OSError as e:
+            raise HelperError(f"Privileged helper at {self.path} unavailable: {str(e)}")
+        if not line:
+            raise HelperError("Privileged helper closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            raise HelperError(response['error'])
+        return response['results']
+
+class SudoHelper(PrivilegedHelper):
+    """Helper running every command through sudo, for hosts without the daemon"""
+    name = 'sudo'
+
+    def _set_acl(self, username, devices, permission):
+        uid = pwd.getpwnam(username).pw_uid
+        if permission is None:
+            subprocess.run(['sudo', 'setfacl', '-x', f'u:{uid}'] + devices, check=True)
+        else:
+            # -m replaces the user's existing entry on every device
+            subprocess.run(['sudo', 'setfacl', '-m', f'u:{uid}:{"rw" if permission == "rw" else "000"}'] + devices, check=True)
+
+    def _get_acl(self, devices):
+        output = subprocess.run(['sudo', 'getfacl', '-p'] + devices, capture_output=True, text=True, check=True).stdout
+        acls = {device: {} for device in devices}
+        device = None
+        for line in output.splitlines():
+            if line.startswith('# file: '):
+                device = line[len('# file: '):]
+            elif line.startswith('user:') and device in acls:
+                # Format is "user:username:rw-", the owner's entry has no name
+                parts = line.split(':')
+                if len(parts) >= 3 and parts[1]:
+                    acls[device][parts[1]] = parts[2].split()[0]
+        return acls
+
+    def _gpu_processes(self, gpu_ids):
+        args = ['sudo', 'nvidia-smi', '--query-compute-apps=gpu_uuid,pid,used_memory', '--format=csv,noheader,nounits']
+        if gpu_ids is not None:
+            args.insert(2, '--id=' + ','.join(str(gpu_id) for gpu_id in gpu_ids))
+        output = subprocess.run(args, capture_output=True, text=True, check=True).stdout
+        processes = []
+        for line in output.strip().split('\n'):
+            parts = [part.strip() for part in line.split(',')]
+            if len(parts) >= 3 and parts[1].isdigit():
+                processes.append({'gpu_uuid': parts[0], 'pid': int(parts[1]),
+                                  'used_memory': float(parts[2]) if parts[2].replace('.', '', 1).isdigit() else 0.0})
+        return processes
+
+    def _kill(self, username, pids, signal):
+        uid = pwd.getpwnam(username).pw_uid
+        # Only the user's own processes, /proc/<pid>/status is readable without sudo
+        signalled = [int(pid) for pid in pids if int(pid) > 1 and _process_owner(pid) == uid]
+        if signalled:
+            subprocess.run(['sudo', 'kill', f'-{signal}'] + [str(pid) for pid in signalled], check=False)
+        return {'signalled': signalled, 'skipped': [int(pid) for pid in pids if int(pid) not in signalled]}
+
+    def _disk_usage(self, username):
+        output = subprocess.run(['sudo', 'du', '-sb', pwd.getpwnam(username).pw_dir], capture_output=True, text=True).stdout
+        return int(output.split()[0])
+
+    def _mig_instances(self):
+        return subprocess.run(['sudo', 'nvidia-smi', 'mig', '-lgi'], capture_output=True, text=True, check=False).stdout
+
+    def execute(self, commands):
+        handlers = {'set_acl': self._set_acl, 'get_acl': self._get_acl, 'gpu_processes': self._gpu_processes,
+                    'kill': self._kill, 'disk_usage': self._disk_usage, 'mig_instances': self._mig_instances}
+        results = []
+        for command in commands:
+            args = dict(command)
+            try:
+                results.append({'ok': True, 'result': handlers[args.pop('op')](**args)})
+            except (KeyError, ValueError, IndexError, OSError, subprocess.CalledProcessError) as e:
+                results.append({'ok': False, 'error': str(e)})
+        return results
+
+class MockHelper(PrivilegedHelper):
+    """In-memory helper for tests and hosts without GPUs
+
+    Keeps the ACL entries it was asked to set, reports the processes put in
+    `processes` and records the commands it ran in `commands`.
+
+    Args:
+        processes: Optional list of {'gpu_uuid', 'pid', 'used_memory', 'username'} dicts
+        disk_usage: Optional {username: bytes}
+        mig_table: Optional `nvidia-smi mig -lgi` output
+    """
+    name = 'mock'
+
+    def __init__(self, processes=None, disk_usage=None, mig_table=''):
+        self.acls = {}
+        self.processes = list(processes or [])
+        self.disk = dict(disk_usage or {})
+        self.mig_table = mig_table
+        self.commands = []
+        self._lock = threading.Lock()
+
+    def _run(self, op, **args):
+        if op == 'set_acl':
+            for device in args['devices']:
+                if args['permission'] is None:
+                    self.acls.get(device, {}).pop(args['username'], None)
+                else:
+                    self.acls.setdefault(device, {})[args['username']] = 'rw-' if args['permission'] == 'rw' else '---'
+            return None
+        if op == 'get_acl':
+            return {device: dict(self.acls.get(device, {})) for device in args['devices']}
+        if op == 'gpu_processes':
+            return [{key: process[key] for key in ('gpu_uuid', 'pid', 'used_memory')} for process in self.processes]
+        if op == 'kill':
+            owned = {process['pid'] for process in self.processes if process.get('username') == args['username']}
+            signalled = [pid for pid in args['pids'] if pid in owned]
+            self.processes = [process for process in self.processes if process['pid'] not in signalled]
+            return {'signalled': signalled, 'skipped': [pid for pid in args['pids'] if pid not in owned]}
+        if op == 'disk_usage':
+            return self.disk.get(args['username'], 0)
+        if op == 'mig_instances':
+            return self.mig_table
+        raise ValueError(f"Unknown command {op}")
+
+    def execute(self, commands):
+        results = []
+        with self._lock:
+            for command in commands:
+                self.commands.append(command)
+                try:
+                    results.append({'ok': True, 'result': self._run(**command)})
+                except (KeyError, ValueError) as e:
+                    results.append({'ok': False, 'error': str(e)})
+        return results
+
+_helper = None
+_helper_lock = threading.Lock()
+
+def create_privileged_helper(name):
+    """Create a privileged helper by name
+
+    Args:
+        name: 'socket', 'sudo', 'mock' or 'auto' (the daemon when its socket exists, sudo otherwise)
+
+    Returns:
+        PrivilegedHelper: The helper instance
+    """
+    path = config('PRIVILEGED_HELPER_SOCKET', default='/run/gpulocker/helper.sock')
+    timeout = config('PRIVILEGED_HELPER_TIMEOUT_SECONDS', default=60, cast=float)
+    if name == 'socket':
+        return SocketHelper(path, timeout)
+    if name == 'sudo':
+        return SudoHelper()
+    if name == 'mock':
+        return MockHelper()
+    if name == 'auto':
+        if os.path.exists(path):
+            return SocketHelper(path, timeout)
+        logger.warning(f"No privileged helper listening at {path}, falling back to sudo")
+        return SudoHelper()
+    raise ValueError(f"Unknown privileged helper: {name}")
+
+def get_privileged_helper():
+    """Get the process-wide helper selected by PRIVILEGED_HELPER"""
+    global _helper
+    with _helper_lock:
+        if _helper is None:
+            _helper = create_privileged_helper(config('PRIVILEGED_HELPER', default='auto'))
+            logger.info(f"Using {_helper.name} privileged helper")
+        return _helper
+
+def set_privileged_helper(helper):
+    """Replace the process-wide helper, e.g. with a MockHelper"""
+    global _helper
+    with _helper_lock:
+        _helper = helper
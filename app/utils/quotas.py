@@ -0,0 +1,275 @@
+import grp
+import pwd
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from decouple import config
+from app.utils.logger import logger
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.db import MongoDBConnection
+from app.utils.redis_utils import DistributedLock
+
+# Usage is kept per user and per quota group in a small hash, updated at
+# allocate and release time so checking a request never scans gpu_allocations:
+#   active_gpus, active_start_sum: GPUs held now and the sum of their start
+#       timestamps, so the hours they ran so far are active_gpus * now - active_start_sum
+#   day:<YYYYMMDD>: GPU-hours that released allocations ran on that day
+#   decayed_hours, decayed_at: released GPU-hours decayed with FAIRSHARE_HALF_LIFE_HOURS
+# KEYS: usage hash of the user and of each of its quota groups
+# ARGV: GPUs delta, start timestamp sum delta, GPU-hours released, now,
+#       half-life in seconds, oldest day field to keep, then pairs of day field
+#       and the GPU-hours released on that day
+_RECORD_USAGE_SCRIPT = REDIS_CLIENT.register_script("""
+local hours = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+for _, key in ipairs(KEYS) do
+    redis.call('HINCRBY', key, 'active_gpus', ARGV[1])
+    redis.call('HINCRBYFLOAT', key, 'active_start_sum', ARGV[2])
+    if hours > 0 then
+        for i = 7, #ARGV, 2 do
+            redis.call('HINCRBYFLOAT', key, ARGV[i], ARGV[i + 1])
+        end
+        local decayed = tonumber(redis.call('HGET', key, 'decayed_hours') or '0')
+        local decayed_at = tonumber(redis.call('HGET', key, 'decayed_at') or ARGV[4])
+        decayed = decayed * 2 ^ (-(now - decayed_at) / tonumber(ARGV[5])) + hours
+        redis.call('HSET', key, 'decayed_hours', tostring(decayed), 'decayed_at', ARGV[4])
+        for _, field in ipairs(redis.call('HKEYS', key)) do
+            if string.sub(field, 1, 4) == 'day:' and field < ARGV[6] then redis.call('HDEL', key, field) end
+        end
+    end
+end
+return 1
+""")
+
+def _usage_key(subject):
+    return f"{REDIS_KEYS['quota_usage']}:{subject}"
+
+def _half_life_seconds():
+    return config('FAIRSHARE_HALF_LIFE_HOURS', default=168, cast=float) * 3600
+
+def _day_field(moment):
+    return f"day:{moment.strftime('%Y%m%d')}"
+
+def _oldest_day_field(now):
+    # The rolling week is today and the six days before
+    return _day_field(now - timedelta(days=6))
+
+def _daily_hours(allocated_at, released_at, oldest_day):
+    """Split the GPU-hours of an allocation across the days it ran, from oldest_day on"""
+    hours = {}
+    start = allocated_at
+    while start < released_at:
+        midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        end = min(midnight, released_at)
+        day = _day_field(start)
+        if day >= oldest_day:
+            hours[day] = hours.get(day, 0.0) + (end - start).total_seconds() / 3600
+        start = end
+    return hours
+
+def get_quota_overrides():
+    """Per-user and per-group limits from QUOTA_OVERRIDES, groups are prefixed with @"""
+    try:
+        return eval(config('QUOTA_OVERRIDES', default='{}'))
+    except Exception as e:
+        logger.error(f"Invalid QUOTA_OVERRIDES: {str(e)}")
+        return {}
+
+def get_user_groups(username, overrides=None):
+    """Get the quota groups of a user, the Unix groups named in QUOTA_OVERRIDES it belongs to
+
+    Returns:
+        list: Group subjects, e.g. ['@students']
+    """
+    overrides = get_quota_overrides() if overrides is None else overrides
+    groups = [subject[1:] for subject in overrides if subject.startswith('@')]
+    if not groups:
+        return []
+    try:
+        primary_group = grp.getgrgid(pwd.getpwnam(username).pw_gid).gr_name
+    except KeyError:
+        primary_group = None
+    subjects = []
+    for group in groups:
+        try:
+            if group == primary_group or username in grp.getgrnam(group).gr_mem:
+                subjects.append(f"@{group}")
+        except KeyError:
+            continue
+    return subjects
+
+def get_quota(subject, overrides=None):
+    """Get the limits of a user or @group, 0 meaning unlimited
+
+    Users default to USER_MAX_GPUS and USER_WEEKLY_GPU_HOURS, groups are
+    only limited when they are in QUOTA_OVERRIDES.
+
+    Returns:
+        dict: {'max_gpus', 'weekly_gpu_hours'}
+    """
+    overrides = get_quota_overrides() if overrides is None else overrides
+    if subject.startswith('@'):
+        quota = {'max_gpus': 0, 'weekly_gpu_hours': 0}
+    else:
+        quota = {'max_gpus': config('USER_MAX_GPUS', default=0, cast=int),
+                 'weekly_gpu_hours': config('USER_WEEKLY_GPU_HOURS', default=0, cast=float)}
+    quota.update(overrides.get(subject, {}))
+    return quota
+
+def get_usage(subject, now=None):
+    """Get the usage of a user or @group from its usage hash
+
+    Returns:
+        dict: {'active_gpus', 'weekly_gpu_hours', 'decayed_gpu_hours'}, counting
+        the hours of the GPUs held now as used
+    """
+    now = now or datetime.now()
+    usage = REDIS_CLIENT.hgetall(_usage_key(subject))
+    active_gpus = int(usage.get('active_gpus', 0))
+    running_hours = max(0.0, (active_gpus * now.timestamp() - float(usage.get('active_start_sum', 0))) / 3600)
+    oldest_day = _oldest_day_field(now)
+    weekly_hours = sum(float(hours) for field, hours in usage.items() if field.startswith('day:') and field >= oldest_day)
+    decayed_hours = float(usage.get('decayed_hours', 0))
+    if decayed_hours:
+        decayed_hours *= 2 ** (-(now.timestamp() - float(usage['decayed_at'])) / _half_life_seconds())
+    return {
+        'active_gpus': active_gpus,
+        'weekly_gpu_hours': weekly_hours + running_hours,
+        'decayed_gpu_hours': decayed_hours + running_hours
+    }
+
+def get_priority(username, now=None):
+    """Fair-share priority of a user, from 1 without recent usage down towards 0
+
+    It halves with every FAIRSHARE_SHARE_HOURS of decayed GPU-hours, so users
+    who recently used fewer GPU-hours go first.
+    """
+    share_hours = config('FAIRSHARE_SHARE_HOURS', default=168, cast=float)
+    return 2 ** (-get_usage(username, now)['decayed_gpu_hours'] / share_hours)
+
+def check_quota(username, count, hours):
+    """Check whether a user may take more GPUs
+
+    Args:
+        username: User the GPUs are for
+        count: Number of GPUs requested
+        hours: GPU-hours requested, i.e. count times the allocation length
+
+    Returns:
+        tuple: (allowed, error_message or None)
+    """
+    overrides = get_quota_overrides()
+    now = datetime.now()
+    for subject in [username] + get_user_groups(username, overrides):
+        quota = get_quota(subject, overrides)
+        if not quota['max_gpus'] and not quota['weekly_gpu_hours']:
+            continue
+        usage = get_usage(subject, now)
+        name = f"Group {subject[1:]}" if subject.startswith('@') else "You"
+        if quota['max_gpus'] and usage['active_gpus'] + count > quota['max_gpus']:
+            return False, f"{name} can hold at most {quota['max_gpus']} GPUs at a time ({usage['active_gpus']} held now)"
+        if quota['weekly_gpu_hours'] and usage['weekly_gpu_hours'] + hours > quota['weekly_gpu_hours']:
+            return False, (f"{name} can use at most {quota['weekly_gpu_hours']:g} GPU-hours per week "
+                           f"({usage['weekly_gpu_hours']:.0f} used, {hours:.0f} requested)")
+    return True, None
+
+@contextmanager
+def quota_lock(username):
+    """Hold the quota locks of a user and of its limited groups
+
+    Taken around check_quota() and the allocation it allows, so concurrent
+    allocations of the same user or group can't all pass the check before
+    any of them is counted.
+    """
+    overrides = get_quota_overrides()
+    subjects = [subject for subject in [username] + get_user_groups(username, overrides)
+                if any(get_quota(subject, overrides).values())]
+    with ExitStack() as stack:
+        # Always locked in the same order so two users of a group can't deadlock
+        for subject in sorted(subjects):
+            stack.enter_context(DistributedLock(f"{REDIS_KEYS['quota_lock']}:{subject}", name='quota_lock'))
+        yield
+
+def get_quota_status(username):
+    """Usage of a user next to its limits, for the dashboard
+
+    Returns:
+        dict: get_usage() of the user plus its 'max_gpus', 'weekly_limit' and 'priority'
+    """
+    now = datetime.now()
+    quota = get_quota(username)
+    status = get_usage(username, now)
+    status.update({'max_gpus': quota['max_gpus'], 'weekly_limit': quota['weekly_gpu_hours'],
+                   'priority': get_priority(username, now)})
+    return status
+
+def _record(username, gpus, start_sum, hours, now, daily_hours=None):
+    keys = [_usage_key(subject) for subject in [username] + get_user_groups(username)]
+    args = [gpus, start_sum, hours, now.timestamp(), _half_life_seconds(), _oldest_day_field(now)]
+    for day, day_hours in (daily_hours or {}).items():
+        args += [day, day_hours]
+    _RECORD_USAGE_SCRIPT(keys=keys, args=args)
+
+def record_allocations(username, count, allocated_at):
+    """Count GPUs allocated to a user in its usage and its groups'"""
+    try:
+        _record(username, count, count * allocated_at.timestamp(), 0, allocated_at)
+    except Exception as e:
+        logger.error(f"Failed to record GPU usage of user {username}: {str(e)}")
+
+def record_release(username, allocated_at, released_at):
+    """Move a released allocation from the held GPUs to the used GPU-hours of a user and its groups
+
+    The GPU-hours count towards the days the allocation ran on, so an
+    allocation released after the rolling week started only counts its hours
+    within the week. The decayed GPU-hours take all of them.
+    """
+    try:
+        hours = max(0.0, (released_at - allocated_at).total_seconds() / 3600)
+        _record(username, -1, -allocated_at.timestamp(), hours, released_at,
+                _daily_hours(allocated_at, released_at, _oldest_day_field(released_at)))
+    except Exception as e:
+        logger.error(f"Failed to record GPU usage of user {username}: {str(e)}")
+
+def rebuild_quota_usage():
+    """Rebuild every usage hash from gpu_allocations, run once at startup
+
+    Returns:
+        bool: True if the usage was rebuilt
+    """
+    try:
+        now = datetime.now()
+        half_life = _half_life_seconds()
+        oldest_day = _oldest_day_field(now)
+        usage = {}
+        groups = {}
+        # Older allocations have decayed to nothing
+        since = now - timedelta(seconds=half_life * 10)
+        with MongoDBConnection() as (client, db):
+            allocations = list(db.gpu_allocations.find({'$or': [{'released_at': None}, {'released_at': {'$gte': since}}]},
+                                                       {'username': 1, 'allocated_at': 1, 'released_at': 1}))
+        for allocation in allocations:
+            username = allocation['username']
+            if username not in groups:
+                groups[username] = get_user_groups(username)
+            for subject in [username] + groups[username]:
+                entry = usage.setdefault(subject, {'active_gpus': 0, 'active_start_sum': 0.0, 'decayed_hours': 0.0})
+                if allocation['released_at'] is None:
+                    entry['active_gpus'] += 1
+                    entry['active_start_sum'] += allocation['allocated_at'].timestamp()
+                    continue
+                hours = max(0.0, (allocation['released_at'] - allocation['allocated_at']).total_seconds() / 3600)
+                entry['decayed_hours'] += hours * 2 ** (-(now - allocation['released_at']).total_seconds() / half_life)
+                for day, day_hours in _daily_hours(allocation['allocated_at'], allocation['released_at'], oldest_day).items():
+                    entry[day] = entry.get(day, 0.0) + day_hours
+        pipe = REDIS_CLIENT.pipeline()
+        for key in REDIS_CLIENT.scan_iter(f"{REDIS_KEYS['quota_usage']}:*"):
+            pipe.delete(key)
+        for subject, entry in usage.items():
+            entry['decayed_at'] = now.timestamp()
+            pipe.hset(_usage_key(subject), mapping=entry)
+        pipe.execute()
+        logger.info(f"Rebuilt GPU usage of {len(usage)} users and groups")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to rebuild GPU usage: {str(e)}")
+        return False
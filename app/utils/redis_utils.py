@@ -1,30 +1,503 @@
+import threading
+import time
 from redis.lock import Lock as RedisLock
+from redis.exceptions import LockError
 from app.config import REDIS_CLIENT,REDIS_KEYS
 import json
+from decouple import config
+from app.utils.logger import logger
+from app.utils.topology import get_gpu_topology, place_gpus
+
+# Topology-aware claims pick GPUs from a snapshot of the pool, this many
+# times before falling back to the lowest IDs when other claims keep racing
+_PLACEMENT_ATTEMPTS = 3
+
+# Adds one wait/hold observation to the metrics of a lock.
+# KEYS[1]: metrics hash, ARGV: lock name, metric ('wait' or 'hold'), seconds
+_RECORD_LOCK_METRIC_SCRIPT = REDIS_CLIENT.register_script("""
+local prefix = ARGV[1] .. ':' .. ARGV[2]
+local seconds = tonumber(ARGV[3])
+redis.call('HINCRBY', KEYS[1], prefix .. '_count', 1)
+redis.call('HINCRBYFLOAT', KEYS[1], prefix .. '_total', seconds)
+local current = tonumber(redis.call('HGET', KEYS[1], prefix .. '_max') or '0')
+if seconds > current then redis.call('HSET', KEYS[1], prefix .. '_max', ARGV[3]) end
+return 1
+""")
+
+def record_lock_metric(name, metric, seconds):
+    """Record how long a lock was waited for or held
+
+    Args:
+        name: Lock name the metrics are grouped under (e.g. 'gpu_lock', 'gpu_lease')
+        metric: 'wait', 'hold', or an event counted without a duration ('timeout', 'lost')
+        seconds: Duration of the wait or hold
+    """
+    try:
+        if metric in ('wait', 'hold'):
+            _RECORD_LOCK_METRIC_SCRIPT(keys=[REDIS_KEYS['lock_metrics']], args=[name, metric, seconds])
+        else:
+            REDIS_CLIENT.hincrby(REDIS_KEYS['lock_metrics'], f"{name}:{metric}", 1)
+    except Exception as e:
+        logger.error(f"Failed to record {metric} metric of lock {name}: {str(e)}")
+
+def get_lock_metrics():
+    """Get the contention metrics of every lock
+
+    Returns:
+        dict: {name: {'acquired', 'wait_mean', 'wait_max', 'hold_mean', 'hold_max', 'timeouts', 'lost'}}
+    """
+    raw = {}
+    for field, value in REDIS_CLIENT.hgetall(REDIS_KEYS['lock_metrics']).items():
+        name, _, stat = field.rpartition(':')
+        raw.setdefault(name, {})[stat] = float(value)
+    metrics = {}
+    for name, stats in raw.items():
+        metrics[name] = {
+            'acquired': int(stats.get('wait_count', 0)),
+            'wait_mean': stats.get('wait_total', 0) / stats['wait_count'] if stats.get('wait_count') else 0,
+            'wait_max': stats.get('wait_max', 0),
+            'hold_mean': stats.get('hold_total', 0) / stats['hold_count'] if stats.get('hold_count') else 0,
+            'hold_max': stats.get('hold_max', 0),
+            'timeouts': int(stats.get('timeout', 0)),
+            'lost': int(stats.get('lost', 0))
+        }
+    return metrics
+
 class DistributedLock:
-    """Redis-based distributed lock"""
-    def __init__(self, lock_key, expire_time=60):
+    """Redis-based distributed lock
+
+    The lock expires after expire_time seconds so a worker killed while
+    holding it can't block everyone else forever. Its metrics are recorded
+    under name, the last part of the key by default.
+    """
+    def __init__(self, lock_key, expire_time=None, blocking_timeout=None, name=None):
+        self.name = name or lock_key.rpartition(':')[2]
         self.lock = RedisLock(
             REDIS_CLIENT,
             lock_key,
-            #timeout=expire_time,
-            #blocking_timeout=5
+            timeout=expire_time or config('REDIS_LOCK_TIMEOUT_SECONDS', default=60, cast=int),
+            blocking_timeout=blocking_timeout or config('REDIS_LOCK_WAIT_SECONDS', default=30, cast=int)
         )
+        self._acquired_at = None
     
     def __enter__(self):
+        start = time.monotonic()
         if not self.lock.acquire():
+            record_lock_metric(self.name, 'timeout', 0)
             raise Exception("Could not acquire lock")
+        self._acquired_at = time.monotonic()
+        record_lock_metric(self.name, 'wait', self._acquired_at - start)
         return self
     
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.lock.release()
+        record_lock_metric(self.name, 'hold', time.monotonic() - self._acquired_at)
+        try:
+            self.lock.release()
+        except LockError:
+            record_lock_metric(self.name, 'lost', 0)
+            logger.warning(f"Lock {self.lock.name} expired before it was released")
+
+class LeaseLostError(Exception):
+    """Raised when a GPU lease expired or was taken over while it was in use"""
+
+class GPULease:
+    """Expiring lease on a single GPU with a fencing token
+
+    The lease is a Redis lock with a TTL of GPU_LEASE_TTL_SECONDS, renewed
+    by a background thread every third of the TTL while it is held, so it
+    outlives slow ACL or database work but is freed soon after its holder
+    dies. Every acquisition gets a fencing token from a per-GPU counter that
+    only grows. Writes made under the lease call check() first and store the
+    token, so a holder whose lease expired can't overwrite a newer holder.
+    """
+    def __init__(self, gpu_id, ttl=None, blocking_timeout=None):
+        self.gpu_id = gpu_id
+        self.ttl = ttl or config('GPU_LEASE_TTL_SECONDS', default=30, cast=int)
+        self.lock = RedisLock(
+            REDIS_CLIENT,
+            f"{REDIS_KEYS['gpu_lease']}:{gpu_id}",
+            timeout=self.ttl,
+            blocking_timeout=blocking_timeout or config('GPU_LEASE_WAIT_SECONDS', default=10, cast=int),
+            # Renewed from another thread
+            thread_local=False
+        )
+        self.token = None
+        self._acquired_at = None
+        self._stop = threading.Event()
+        self._renewer = None
+    
+    def _fence_key(self):
+        return f"{REDIS_KEYS['gpu_fence']}:{self.gpu_id}"
+    
+    def __enter__(self):
+        start = time.monotonic()
+        if not self.lock.acquire():
+            record_lock_metric('gpu_lease', 'timeout', 0)
+            raise Exception(f"Could not acquire lease on GPU {self.gpu_id}")
+        self._acquired_at = time.monotonic()
+        record_lock_metric('gpu_lease', 'wait', self._acquired_at - start)
+        self.token = REDIS_CLIENT.incr(self._fence_key())
+        self._renewer = threading.Thread(target=self._renew, name=f"gpu-lease-{self.gpu_id}", daemon=True)
+        self._renewer.start()
+        return self
+    
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self.lock.reacquire()
+            except Exception as e:
+                logger.warning(f"Failed to renew lease on GPU {self.gpu_id}: {str(e)}")
+                return
+    
+    def valid(self):
+        """Check whether the lease is still held and no newer holder got a token"""
+        try:
+            return self.lock.owned() and REDIS_CLIENT.get(self._fence_key()) == str(self.token)
+        except Exception as e:
+            logger.error(f"Failed to check lease on GPU {self.gpu_id}: {str(e)}")
+            return False
+    
+    def check(self):
+        """Raise LeaseLostError unless the lease is still valid"""
+        if not self.valid():
+            record_lock_metric('gpu_lease', 'lost', 0)
+            raise LeaseLostError(f"Lease on GPU {self.gpu_id} (token {self.token}) was lost")
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._renewer.join()
+        record_lock_metric('gpu_lease', 'hold', time.monotonic() - self._acquired_at)
+        try:
+            self.lock.release()
+        except LockError:
+            logger.warning(f"Lease on GPU {self.gpu_id} expired before it was released")
+
+# Claims GPUs from several pool sets at once, all or nothing.
+# KEYS: one pool set per GPU type
+# ARGV: number of excluded GPU IDs, the excluded IDs, then the count wanted from each key
+# Returns {0, ids of KEYS[1], ids of KEYS[2], ...}, or {k} if KEYS[k] can't satisfy its count
+_CLAIM_SCRIPT = REDIS_CLIENT.register_script("""
+local excluded = {}
+local n_excluded = tonumber(ARGV[1])
+for i = 2, n_excluded + 1 do
+    excluded[ARGV[i]] = true
+end
+local claims = {0}
+for k = 1, #KEYS do
+    local wanted = tonumber(ARGV[n_excluded + 1 + k])
+    local members = redis.call('SMEMBERS', KEYS[k])
+    table.sort(members, function(a, b) return tonumber(a) < tonumber(b) end)
+    local picked = {}
+    for _, gpu_id in ipairs(members) do
+        if #picked == wanted then break end
+        if not excluded[gpu_id] then table.insert(picked, gpu_id) end
+    end
+    if #picked < wanted then return {k} end
+    table.insert(claims, picked)
+end
+for k = 1, #KEYS do
+    if #claims[k + 1] > 0 then redis.call('SREM', KEYS[k], unpack(claims[k + 1])) end
+end
+return claims
+""")
+
+# Claims the given GPUs if every one of them is in its pool set.
+# KEYS: pool set of each GPU, ARGV: the GPU IDs. Returns 1 if claimed, 0 otherwise
+_CLAIM_SPECIFIC_SCRIPT = REDIS_CLIENT.register_script("""
+for i = 1, #KEYS do
+    if redis.call('SISMEMBER', KEYS[i], ARGV[i]) == 0 then return 0 end
+end
+for i = 1, #KEYS do
+    redis.call('SREM', KEYS[i], ARGV[i])
+end
+return 1
+""")
+
+# Puts GPUs back into their pool sets.
+# KEYS: pool set of each GPU, ARGV: the GPU IDs. Returns the number of GPUs that weren't already there
+_RETURN_SCRIPT = REDIS_CLIENT.register_script("""
+local added = 0
+for i = 1, #KEYS do
+    added = added + redis.call('SADD', KEYS[i], ARGV[i])
+end
+return added
+""")
+
+# Takes one tenant slot on the first candidate GPU that can host it. A GPU
+# already shared needs a free slot and enough unreserved memory, unless
+# forced, a whole GPU is taken out of the pool and becomes shared.
+# KEYS: pool set of the type, then the shared hash of each candidate GPU
+# ARGV: memory wanted, most tenants per GPU, 1 to ignore the tenant and
+#       memory limits, then the ID and memory of each candidate
+# Returns the ID of the GPU, or false if none can host the tenant
+_CLAIM_SHARE_SCRIPT = REDIS_CLIENT.register_script("""
+local memory = tonumber(ARGV[1])
+local max_tenants = tonumber(ARGV[2])
+local force = ARGV[3] == '1'
+for k = 2, #KEYS do
+    local gpu_id = ARGV[2 * k]
+    local memory_total = tonumber(ARGV[2 * k + 1])
+    local tenants = tonumber(redis.call('HGET', KEYS[k], 'tenants') or '0')
+    if tenants > 0 then
+        local reserved = tonumber(redis.call('HGET', KEYS[k], 'memory_reserved') or '0')
+        if force or (tenants < max_tenants and reserved + memory <= memory_total) then
+            redis.call('HINCRBY', KEYS[k], 'tenants', 1)
+            redis.call('HINCRBYFLOAT', KEYS[k], 'memory_reserved', ARGV[1])
+            return gpu_id
+        end
+    elseif (force or memory <= memory_total) and redis.call('SREM', KEYS[1], gpu_id) == 1 then
+        redis.call('HSET', KEYS[k], 'tenants', 1, 'memory_reserved', ARGV[1])
+        return gpu_id
+    end
+end
+return false
+""")
+
+# Frees a tenant slot, the GPU goes back to the pool with its last tenant.
+# KEYS: pool set of the type, shared hash of the GPU. ARGV: GPU ID, memory reserved by the tenant
+_RETURN_SHARE_SCRIPT = REDIS_CLIENT.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 0 then return 0 end
+local tenants = redis.call('HINCRBY', KEYS[2], 'tenants', -1)
+redis.call('HINCRBYFLOAT', KEYS[2], 'memory_reserved', -tonumber(ARGV[2]))
+if tenants <= 0 then
+    redis.call('DEL', KEYS[2])
+    redis.call('SADD', KEYS[1], ARGV[1])
+end
+return 1
+""")
+
+def _pool_key(gpu_type):
+    return f"{REDIS_KEYS['available_gpus']}:{gpu_type}"
+
 def get_available_gpus():
-    """Get available GPUs from Redis"""
-    gpu_data = REDIS_CLIENT.get(REDIS_KEYS['available_gpus'])
-    if gpu_data:
-        return json.loads(gpu_data)
-    return {}
+    """Get available GPUs from Redis
+    
+    Returns:
+        dict: {gpu_type: sorted list of available GPU IDs} for every configured type
+    """
+    gpu_types = list(get_gpu_config().keys())
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for gpu_type in gpu_types:
+        pipe.smembers(_pool_key(gpu_type))
+    return {gpu_type: sorted(int(gpu_id) for gpu_id in members)
+            for gpu_type, members in zip(gpu_types, pipe.execute())}
 
 def set_available_gpus(gpu_dict):
-    """Set available GPUs in Redis"""
-    REDIS_CLIENT.set(REDIS_KEYS['available_gpus'], json.dumps(gpu_dict))
\ No newline at end of file
+    """Replace the available GPU pool in Redis
+    
+    Every configured type not in gpu_dict is emptied. The replacement is
+    one MULTI transaction, so claims never see a half-written pool.
+    
+    Args:
+        gpu_dict: {gpu_type: list of available GPU IDs}
+    """
+    pipe = REDIS_CLIENT.pipeline()
+    # The pool used to be a single JSON string under the prefix key
+    pipe.delete(REDIS_KEYS['available_gpus'])
+    for gpu_type in set(get_gpu_config().keys()) | set(gpu_dict.keys()):
+        pipe.delete(_pool_key(gpu_type))
+        if gpu_dict.get(gpu_type):
+            pipe.sadd(_pool_key(gpu_type), *gpu_dict[gpu_type])
+    pipe.execute()
+
+def claim_gpus(requested, exclude=()):
+    """Atomically take GPUs out of the available pool
+    
+    When the GPU topology is known, the best-connected free subset of each
+    type is picked and claimed if it is still free. Otherwise the lowest
+    available IDs are claimed in a single round trip. Either every requested
+    GPU is claimed or none is.
+    
+    Args:
+        requested: {gpu_type: number of GPUs wanted}
+        exclude: GPU IDs that must not be claimed (e.g. unhealthy ones)
+    
+    Returns:
+        tuple: ({gpu_type: list of claimed GPU IDs}, None), or (None, gpu_type) naming
+        the first type that doesn't have enough GPUs available
+    """
+    gpu_types = [gpu_type for gpu_type, count in requested.items() if count > 0]
+    if not gpu_types:
+        return {}, None
+    topology = get_gpu_topology()
+    if topology:
+        excluded = {int(gpu_id) for gpu_id in exclude}
+        for _ in range(_PLACEMENT_ATTEMPTS):
+            available = get_available_gpus()
+            placed = {}
+            for gpu_type in gpu_types:
+                placed[gpu_type] = place_gpus([gpu_id for gpu_id in available.get(gpu_type, []) if gpu_id not in excluded],
+                                              requested[gpu_type], topology)
+                if placed[gpu_type] is None:
+                    return None, gpu_type
+            if claim_specific_gpus([(gpu_type, gpu_id) for gpu_type, gpu_ids in placed.items() for gpu_id in gpu_ids]):
+                return placed, None
+        logger.warning(f"GPU placement for {requested} kept racing other claims, claiming the lowest IDs")
+    exclude = [str(gpu_id) for gpu_id in exclude]
+    result = _CLAIM_SCRIPT(
+        keys=[_pool_key(gpu_type) for gpu_type in gpu_types],
+        args=[len(exclude), *exclude, *(requested[gpu_type] for gpu_type in gpu_types)]
+    )
+    if int(result[0]) != 0:
+        return None, gpu_types[int(result[0]) - 1]
+    return {gpu_type: [int(gpu_id) for gpu_id in claimed] for gpu_type, claimed in zip(gpu_types, result[1:])}, None
+
+def claim_specific_gpus(gpus):
+    """Atomically take specific GPUs out of the available pool
+    
+    Args:
+        gpus: List of (gpu_type, gpu_id) tuples
+    
+    Returns:
+        bool: True if every GPU was available and is now claimed, False if none was claimed
+    """
+    if not gpus:
+        return True
+    return bool(_CLAIM_SPECIFIC_SCRIPT(keys=[_pool_key(gpu_type) for gpu_type, _ in gpus],
+                                       args=[gpu_id for _, gpu_id in gpus]))
+
+def return_gpus(gpus):
+    """Atomically put GPUs back into the available pool
+    
+    Args:
+        gpus: List of (gpu_type, gpu_id) tuples
+    
+    Returns:
+        int: Number of GPUs that weren't already in the pool
+    """
+    if not gpus:
+        return 0
+    return int(_RETURN_SCRIPT(keys=[_pool_key(gpu_type) for gpu_type, _ in gpus],
+                              args=[gpu_id for _, gpu_id in gpus]))
+
+def _mig_pool_key(gpu_type):
+    return f"{REDIS_KEYS['available_mig']}:{gpu_type}"
+
+def _mig_member(gpu_id, instance_id):
+    return f"{gpu_id}:{instance_id}"
+
+def _shared_key(gpu_id):
+    return f"{REDIS_KEYS['shared_gpu']}:{gpu_id}"
+
+def set_mig_config(instances):
+    """Store the MIG instances of every GPU type and fill their pools
+    
+    Args:
+        instances: {gpu_type: list of query_mig_instances() dicts}
+    """
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.set(REDIS_KEYS['mig_config'], json.dumps(instances))
+    for gpu_type in set(get_gpu_config().keys()) | set(instances.keys()):
+        pipe.delete(_mig_pool_key(gpu_type))
+        members = [_mig_member(instance['gpu_id'], instance['instance_id']) for instance in instances.get(gpu_type, [])]
+        if members:
+            pipe.sadd(_mig_pool_key(gpu_type), *members)
+    pipe.execute()
+
+def get_mig_config():
+    """Get the MIG instances of every GPU type
+    
+    Returns:
+        dict: {gpu_type: list of {'gpu_id', 'instance_id', 'profile', 'memory_total'}}
+    """
+    mig_config = REDIS_CLIENT.get(REDIS_KEYS['mig_config'])
+    return json.loads(mig_config) if mig_config else {}
+
+def get_available_mig_instances(gpu_type):
+    """Get the free MIG instances of a GPU type
+    
+    Returns:
+        list: Sorted (gpu_id, instance_id) tuples
+    """
+    return sorted(tuple(int(part) for part in member.split(':')) for member in REDIS_CLIENT.smembers(_mig_pool_key(gpu_type)))
+
+def claim_mig_instance(gpu_type, gpu_id, instance_id):
+    """Atomically take a MIG instance out of its pool
+    
+    Returns:
+        bool: True if the instance was free and is now claimed
+    """
+    return bool(_CLAIM_SPECIFIC_SCRIPT(keys=[_mig_pool_key(gpu_type)], args=[_mig_member(gpu_id, instance_id)]))
+
+def return_mig_instance(gpu_type, gpu_id, instance_id):
+    """Put a MIG instance back into its pool"""
+    return int(REDIS_CLIENT.sadd(_mig_pool_key(gpu_type), _mig_member(gpu_id, instance_id)))
+
+def claim_gpu_share(gpu_type, candidates, memory, max_tenants=0, force=False):
+    """Atomically take a tenant slot on a time-sliced GPU
+    
+    Args:
+        gpu_type: Type of the GPUs
+        candidates: (gpu_id, memory_total) tuples in order of preference
+        memory: MiB the tenant reserves
+        max_tenants: Most tenants a GPU is shared by
+        force: Ignore max_tenants and memory_total, e.g. to count the tenants
+            of existing allocations when the pools are rebuilt
+    
+    Returns:
+        int: ID of the GPU the slot was taken on, or None
+    """
+    if not candidates:
+        return None
+    result = _CLAIM_SHARE_SCRIPT(keys=[_pool_key(gpu_type)] + [_shared_key(gpu_id) for gpu_id, _ in candidates],
+                                 args=[memory, max_tenants, 1 if force else 0] + [value for candidate in candidates for value in candidate])
+    return int(result) if result else None
+
+def return_gpu_share(gpu_type, gpu_id, memory):
+    """Free a tenant slot on a time-sliced GPU, returning the GPU to the pool with its last tenant"""
+    return int(_RETURN_SHARE_SCRIPT(keys=[_pool_key(gpu_type), _shared_key(gpu_id)], args=[gpu_id, memory]))
+
+def get_shared_gpus(gpu_ids):
+    """Get the tenants of the time-sliced GPUs among some GPUs
+    
+    Returns:
+        dict: {gpu_id: {'tenants', 'memory_reserved'}} for the GPUs being shared
+    """
+    gpu_ids = list(gpu_ids)
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    for gpu_id in gpu_ids:
+        pipe.hgetall(_shared_key(gpu_id))
+    return {gpu_id: {'tenants': int(shared['tenants']), 'memory_reserved': float(shared['memory_reserved'])}
+            for gpu_id, shared in zip(gpu_ids, pipe.execute()) if shared}
+
+def clear_shared_gpus(gpu_ids):
+    """Forget the tenants of GPUs, e.g. before the pool is rebuilt"""
+    gpu_ids = list(gpu_ids)
+    if gpu_ids:
+        REDIS_CLIENT.delete(*[_shared_key(gpu_id) for gpu_id in gpu_ids])
+
+def initialize_gpu_config():
+    """Initialize GPU configuration in Redis"""
+    try:
+        gpu_config = eval(config('GPU_CONFIG'))
+        REDIS_CLIENT.set(REDIS_KEYS['gpu_config'], json.dumps(gpu_config))
+        logger.info(f"Initialized GPU configuration in Redis: {gpu_config}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to initialize GPU config in Redis: {str(e)}")
+        return False
+    
+def get_gpu_config():
+    """
+    Get GPU configuration from Redis
+    Returns:
+        dict: GPU configuration dictionary or empty dict if not found
+    """
+    try:
+        gpu_config = REDIS_CLIENT.get(REDIS_KEYS['gpu_config'])
+        if gpu_config:
+            return json.loads(gpu_config)
+        
+        # If config not found in Redis, try to reinitialize
+        logger.warning("GPU configuration not found in Redis, attempting to reinitialize")
+        if initialize_gpu_config():
+            gpu_config = REDIS_CLIENT.get(REDIS_KEYS['gpu_config'])
+            if gpu_config:
+                return json.loads(gpu_config)
+        
+        logger.error("Could not retrieve or initialize GPU configuration")
+        return {}
+        
+    except Exception as e:
+        logger.error(f"Error getting GPU config from Redis: {str(e)}")
+        return {}
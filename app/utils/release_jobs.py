@@ -0,0 +1,190 @@
+import os
+import subprocess
+import uuid
+from datetime import datetime
+from bson import ObjectId
+from rq import Queue, get_current_job
+from rq.job import Job, Dependency
+from rq.exceptions import NoSuchJobError
+from app.utils.logger import logger
+from app.utils.db import MongoDBConnection, update_allocation_status
+from app.config import REDIS_BINARY, REDIS_CLIENT, REDIS_KEYS
+from app.utils.redis_utils import GPULease, get_gpu_config
+from app.utils.gpu_monitoring import unallocate_gpu, set_gpu_permission, cancel_allocation_monitoring, initialize_gpu_tracking, gpus_freed
+from app.utils.waitlist import dispatch_waitlist
+from app.utils.quotas import record_release
+from app.utils.expiry import unindex_expiration
+from app.utils.ingest import flush_all_buffers, close_utilization_run
+
+def _queue():
+    return Queue(connection=REDIS_BINARY)
+
+def release_allocation_job(allocation_id, comment):
+    """RQ job releasing an allocation with unallocate_gpu
+
+    Args:
+        allocation_id: String ID of the allocation
+        comment: Comment explaining the release
+
+    Returns:
+        dict: {'allocation_id', 'gpu_id', 'released', 'message'}
+    """
+    try:
+        with MongoDBConnection() as (client, db):
+            allocation = db.gpu_allocations.find_one({'_id': ObjectId(allocation_id)})
+            if not allocation or allocation.get('released_at') is not None:
+                return {'allocation_id': allocation_id, 'gpu_id': allocation['gpu_id'] if allocation else None,
+                        'released': False, 'message': 'The allocation was already released'}
+            released = unallocate_gpu(allocation['username'], allocation['gpu_id'], allocation['gpu_type'],
+                                      allocation['_id'], db, comment=comment)
+            if released:
+                gpus_freed()
+            message = f"Successfully released GPU {allocation['gpu_id']}" if released else f"Failed to release GPU {allocation['gpu_id']}"
+            return {'allocation_id': allocation_id, 'gpu_id': allocation['gpu_id'], 'released': released, 'message': message}
+    finally:
+        REDIS_CLIENT.hdel(REDIS_KEYS['release_jobs'], allocation_id)
+        # The last utilization run of the allocation was buffered by unallocate_gpu
+        flush_all_buffers()
+
+def submit_release(allocation_id, comment, requested_by):
+    """Queue the release of an allocation on the RQ worker
+
+    A release already queued or running for the allocation is reused
+    instead of queueing a second one.
+
+    Args:
+        allocation_id: String ID of the allocation
+        comment: Comment explaining the release
+        requested_by: Username the job status is shown to
+
+    Returns:
+        str: ID of the release job
+    """
+    allocation_id = str(allocation_id)
+    job_id = uuid.uuid4().hex
+    if not REDIS_CLIENT.hsetnx(REDIS_KEYS['release_jobs'], allocation_id, job_id):
+        existing_id = REDIS_CLIENT.hget(REDIS_KEYS['release_jobs'], allocation_id)
+        status = get_job_status(existing_id)
+        if status and status['status'] in ('queued', 'started', 'deferred', 'scheduled'):
+            return existing_id
+        # The previous job is gone or finished without cleaning up
+        REDIS_CLIENT.hset(REDIS_KEYS['release_jobs'], allocation_id, job_id)
+    _queue().enqueue(release_allocation_job, allocation_id, comment, job_id=job_id,
+                     meta={'requested_by': requested_by, 'description': f"Release of allocation {allocation_id}"})
+    logger.info(f"Queued release of allocation {allocation_id} as job {job_id}")
+    return job_id
+
+def revoke_allocation_job(allocation_id, comment):
+    """RQ job revoking the access of an allocation during a system reset
+
+    Unlike release_allocation_job the user's processes are left running and
+    the GPU isn't returned to the pool, finish_system_reset_job rebuilds it.
+
+    Returns:
+        dict: {'allocation_id', 'gpu_id', 'released'}
+    """
+    try:
+        with MongoDBConnection() as (client, db):
+            allocation = db.gpu_allocations.find_one({'_id': ObjectId(allocation_id)})
+            if not allocation or allocation.get('released_at') is not None:
+                return {'allocation_id': allocation_id, 'gpu_id': allocation['gpu_id'] if allocation else None, 'released': False}
+            cancel_allocation_monitoring(allocation_id)
+            with GPULease(allocation['gpu_id']) as lease:
+                lease.check()
+                # Remove user's access to the GPU
+                set_gpu_permission(allocation['username'], allocation['gpu_id'], grant=False, mig_instance=allocation.get('mig_instance'))
+                # Mark allocation as released in database with a comment
+                released = update_allocation_status(db, allocation['_id'], released=True, comment=comment, fencing_token=lease.token)
+            if released:
+                record_release(allocation['username'], allocation['allocated_at'], datetime.now())
+                unindex_expiration(allocation['_id'])
+                close_utilization_run(allocation_id)
+            logger.debug(f"Revoked access to GPU {allocation['gpu_id']} for user {allocation['username']}")
+            return {'allocation_id': allocation_id, 'gpu_id': allocation['gpu_id'], 'released': released}
+    finally:
+        flush_all_buffers()
+
+def finish_system_reset_job(admin):
+    """RQ job resetting every GPU's permissions and the available pool once all allocations were revoked
+
+    Returns:
+        dict: {'released', 'message'}
+    """
+    # Step 3: Reset all GPU permissions using reset_gpus.sh script
+    all_gpu_ids = [str(gpu_id) for gpu_ids in get_gpu_config().values() for gpu_id in gpu_ids]
+    if all_gpu_ids:
+        try:
+            script_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'reset_gpus.sh')
+            subprocess.run(['sudo', script_path] + all_gpu_ids, check=True,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            logger.info(f'Reset permissions for GPUs {all_gpu_ids} using reset_gpus.sh')
+        except subprocess.CalledProcessError as e:
+            logger.error(f'Failed to reset permissions using reset_gpus.sh: {str(e)}')
+
+    # Step 4: Reinitialize GPU tracking
+    initialize_gpu_tracking()
+    dispatch_waitlist()
+
+    # Count the revoke jobs this one waited for that released their allocation
+    job = get_current_job()
+    released = 0
+    for revoke_job_id in (job.meta.get('revoke_jobs', []) if job else []):
+        status = get_job_status(revoke_job_id)
+        if status and status['result'] and status['result']['released']:
+            released += 1
+    logger.info(f"Admin user {admin} successfully reset all GPU permissions and allocations")
+    return {'released': released, 'message': f"System reset complete, released {released} allocations"}
+
+def submit_system_reset(admin):
+    """Queue a full system reset, fanned out as one revoke job per allocation
+
+    The revoke jobs run in parallel across the RQ workers, the final reset
+    of the ACLs and the pool runs once all of them are done, whether they
+    succeeded or not.
+
+    Args:
+        admin: Username of the admin requesting the reset
+
+    Returns:
+        str: ID of the final job, whose status covers the whole reset
+    """
+    with MongoDBConnection() as (client, db):
+        active_allocations = list(db.gpu_allocations.find({'released_at': None}, {'_id': 1}))
+    logger.info(f"Found {len(active_allocations)} active allocations to reset")
+
+    queue = _queue()
+    comment = f"Released during system reset by admin {admin}"
+    revoke_jobs = queue.enqueue_many([
+        Queue.prepare_data(revoke_allocation_job, (str(allocation['_id']), comment),
+                           meta={'requested_by': admin, 'description': f"Reset of allocation {allocation['_id']}"})
+        for allocation in active_allocations
+    ]) if active_allocations else []
+    finish_job = queue.enqueue(
+        finish_system_reset_job, admin,
+        depends_on=Dependency(jobs=revoke_jobs, allow_failure=True) if revoke_jobs else None,
+        meta={'requested_by': admin, 'description': "System reset", 'revoke_jobs': [job.id for job in revoke_jobs]}
+    )
+    logger.info(f"Admin user {admin} queued system reset as job {finish_job.id} after {len(revoke_jobs)} revoke jobs")
+    return finish_job.id
+
+def get_job_status(job_id):
+    """Get the status of a background job
+
+    Returns:
+        dict: {'job_id', 'status', 'requested_by', 'description', 'result', 'error'}, or None if the job doesn't exist
+    """
+    try:
+        job = Job.fetch(job_id, connection=REDIS_BINARY)
+    except NoSuchJobError:
+        return None
+    status = job.get_status()
+    result = job.latest_result()
+    return {
+        'job_id': job_id,
+        'status': status.value if hasattr(status, 'value') else status,
+        'requested_by': job.meta.get('requested_by'),
+        'description': job.meta.get('description'),
+        'result': result.return_value if result and result.type == result.Type.SUCCESSFUL else None,
+        'error': result.exc_string.strip().splitlines()[-1] if result and result.type == result.Type.FAILED and result.exc_string else None
+    }
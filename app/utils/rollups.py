@@ -0,0 +1,342 @@
+from datetime import datetime, timedelta
+import pymongo
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+from decouple import config
+from app.utils.logger import logger
+from app.utils.db import MongoDBConnection
+from app.config import REDIS_CLIENT, REDIS_KEYS
+
+# Metrics stored in raw utilization samples and aggregated by the rollups
+METRICS = ('gpu_utilization', 'memory_used', 'power_draw')
+
+# Rollup tiers from finest to coarsest: (name, source, bucket size in seconds, granularity)
+TIERS = (
+    ('1m', 'raw', 60, 'minutes'),
+    ('1h', '1m', 3600, 'hours'),
+)
+
+EPOCH = datetime(1970, 1, 1)
+
+def tier_collection(tier):
+    """Get the collection name holding a tier ('raw', '1m' or '1h')"""
+    return 'gpu_utilization' if tier == 'raw' else f'gpu_utilization_{tier}'
+
+def tier_retention_days(tier):
+    """Get the number of days a tier is kept before MongoDB expires it"""
+    if tier == 'raw':
+        return config('GPU_UTILIZATION_HISTORY_DAYS', default=7, cast=int)
+    if tier == '1m':
+        return config('GPU_UTILIZATION_1M_RETENTION_DAYS', default=30, cast=int)
+    return config('GPU_UTILIZATION_1H_RETENTION_DAYS', default=365, cast=int)
+
+def _floor(moment, seconds):
+    return moment - timedelta(seconds=(moment - EPOCH).total_seconds() % seconds)
+
+def _ceil(moment, seconds):
+    floored = _floor(moment, seconds)
+    return floored if floored == moment else floored + timedelta(seconds=seconds)
+
+def setup_utilization_collections(db):
+    """Create the raw and rollup utilization collections with their indexes
+
+    Rollup tiers are MongoDB time-series collections where the server
+    supports them (5.0+), regular collections with a TTL index otherwise.
+
+    Args:
+        db: MongoDB database connection
+    """
+    existing = db.list_collection_names()
+
+    raw_ttl = tier_retention_days('raw') * 24 * 60 * 60
+    if 'gpu_utilization' not in existing:
+        db.create_collection('gpu_utilization')
+    db.gpu_utilization.create_index('timestamp', expireAfterSeconds=raw_ttl)
+    db.gpu_utilization.create_index([('allocation_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
+
+    for tier, _, _, granularity in TIERS:
+        name = tier_collection(tier)
+        ttl = tier_retention_days(tier) * 24 * 60 * 60
+        if name not in existing:
+            try:
+                db.create_collection(name,
+                                     timeseries={'timeField': 'timestamp', 'metaField': 'meta', 'granularity': granularity},
+                                     expireAfterSeconds=ttl)
+                logger.info(f"Created time-series collection {name}")
+            except (CollectionInvalid, OperationFailure) as e:
+                logger.warning(f"Time-series collections unavailable ({str(e)}), creating {name} as a regular collection")
+                if name not in db.list_collection_names():
+                    db.create_collection(name)
+                db[name].create_index('timestamp', expireAfterSeconds=ttl)
+        try:
+            # A bucket rolled up twice is rejected. Time-series collections can't have unique indexes,
+            # _rollup_tier resumes after their newest bucket instead
+            db[name].create_index([('meta.scope', pymongo.ASCENDING), ('meta.gpu_id', pymongo.ASCENDING),
+                                   ('meta.allocation_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], unique=True)
+        except OperationFailure:
+            pass
+        db[name].create_index([('meta.allocation_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
+        db[name].create_index([('meta.gpu_id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)])
+
+def _raw_sample_stages(match, start, end):
+    """Pipeline stages yielding one document per raw sample in [start, end)
+
+    Compact storage writes runs of count samples spread evenly between
+    'timestamp' and 'end_timestamp', they are expanded back into samples
+    here. Plain samples have neither 'count' nor 'end_timestamp'.
+    """
+    # Runs never last longer than GPU_UTILIZATION_MAX_RUN_MINUTES, so look back that far for runs overlapping start
+    lookback = timedelta(minutes=config('GPU_UTILIZATION_MAX_RUN_MINUTES', default=60, cast=int))
+    count = {'$ifNull': ['$count', 1]}
+    step = {'$cond': [{'$gt': [count, 1]},
+                      {'$divide': [{'$subtract': ['$end_timestamp', '$timestamp']}, {'$subtract': [count, 1]}]},
+                      0]}
+    return [
+        {'$match': dict(match, timestamp={'$gte': start - lookback, '$lt': end})},
+        {'$addFields': {'_offset': {'$range': [0, count]}, '_step': step}},
+        {'$unwind': '$_offset'},
+        # Date minus milliseconds is a date, so this moves each sample offset * step after the run start
+        {'$addFields': {'timestamp': {'$subtract': ['$timestamp', {'$multiply': ['$_offset', {'$multiply': [-1, '$_step']}]}]}}},
+        {'$match': {'timestamp': {'$gte': start, '$lt': end}}}
+    ]
+
+def _rollup_pipeline(source, scope, start, end, bucket_seconds):
+    """Aggregation grouping a source tier into buckets of the next tier"""
+    if source == 'raw':
+        stages = _raw_sample_stages({}, start, end)
+        field = lambda name: f'${name}'
+        count = 1
+        value = lambda metric, stat: f'${metric}'
+    else:
+        stages = [{'$match': {'timestamp': {'$gte': start, '$lt': end}, 'meta.scope': scope}}]
+        field = lambda name: f'$meta.{name}'
+        count = '$count'
+        value = lambda metric, stat: f'${metric}.{stat}'
+
+    # Date minus date gives milliseconds, so this floors the timestamp to the bucket size
+    bucket = {'$subtract': ['$timestamp', {'$mod': [{'$subtract': ['$timestamp', EPOCH]}, bucket_seconds * 1000]}]}
+    group_id = {'gpu_id': field('gpu_id'), 'bucket': bucket}
+    if scope == 'allocation':
+        group_id['allocation_id'] = field('allocation_id')
+
+    group = {
+        '_id': group_id,
+        'count': {'$sum': count},
+        'gpu_type': {'$first': field('gpu_type')},
+        'username': {'$last': field('username')}
+    }
+    if scope == 'allocation':
+        group['energy_share'] = {'$first': field('energy_share')}
+    for metric in METRICS:
+        group[f'{metric}_min'] = {'$min': value(metric, 'min')}
+        group[f'{metric}_max'] = {'$max': value(metric, 'max')}
+        group[f'{metric}_sum'] = {'$sum': value(metric, 'sum')}
+        group[f'{metric}_last'] = {'$last': value(metric, 'last')}
+
+    return stages + [{'$sort': {'timestamp': 1}}, {'$group': group}]
+
+def _rollup_document(scope, row):
+    meta = {
+        'scope': scope,
+        'gpu_id': row['_id']['gpu_id'],
+        'gpu_type': row['gpu_type'],
+        'username': row['username']
+    }
+    if scope == 'allocation':
+        meta['allocation_id'] = row['_id']['allocation_id']
+        # Share of the GPU's power draw a MIG instance or time slice is charged
+        if row.get('energy_share') is not None:
+            meta['energy_share'] = row['energy_share']
+    document = {'timestamp': row['_id']['bucket'], 'meta': meta, 'count': row['count']}
+    for metric in METRICS:
+        document[metric] = {
+            'min': row[f'{metric}_min'],
+            'max': row[f'{metric}_max'],
+            'sum': row[f'{metric}_sum'],
+            'mean': row[f'{metric}_sum'] / row['count'] if row['count'] else 0,
+            'last': row[f'{metric}_last']
+        }
+    return document
+
+def get_rollup_watermark(tier):
+    """Get the start of the first bucket of a tier that has not been rolled up yet
+
+    Returns:
+        datetime: The watermark or None if the tier was never rolled up
+    """
+    watermark = REDIS_CLIENT.get(f"{REDIS_KEYS['rollup_watermark']}:{tier}")
+    return datetime.fromisoformat(watermark) if watermark else None
+
+def _rollup_tier(db, tier, source, bucket_seconds, now, lag_seconds):
+    watermark_key = f"{REDIS_KEYS['rollup_watermark']}:{tier}"
+    end = _floor(now - timedelta(seconds=lag_seconds), bucket_seconds)
+    start = get_rollup_watermark(tier)
+    # A run that stopped between its insert and the watermark update, or a
+    # lost Redis key, would roll the same buckets up again: resume after
+    # the newest bucket of the tier instead
+    newest = db[tier_collection(tier)].find_one({}, sort=[('timestamp', pymongo.DESCENDING)])
+    if newest:
+        resume = newest['timestamp'] + timedelta(seconds=bucket_seconds)
+        start = resume if start is None else max(start, resume)
+    if start is None:
+        oldest = db[tier_collection(source)].find_one({}, sort=[('timestamp', pymongo.ASCENDING)])
+        if not oldest:
+            return 0
+        start = _floor(oldest['timestamp'], bucket_seconds)
+    # Never read past what the source tier has rolled up itself
+    if source != 'raw':
+        source_watermark = get_rollup_watermark(source)
+        if source_watermark is None:
+            return 0
+        end = min(end, _floor(source_watermark, bucket_seconds))
+    # Bound the work of a single run, the next runs catch up
+    end = min(end, start + timedelta(days=1))
+    if start >= end:
+        return 0
+
+    documents = []
+    for scope in ('allocation', 'gpu'):
+        for row in db[tier_collection(source)].aggregate(_rollup_pipeline(source, scope, start, end, bucket_seconds)):
+            documents.append(_rollup_document(scope, row))
+    if documents:
+        try:
+            db[tier_collection(tier)].insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate buckets are already rolled up, anything else is a real failure
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            logger.warning(f"Skipped {len(e.details['writeErrors'])} {tier} utilization buckets that were already rolled up")
+    REDIS_CLIENT.set(watermark_key, end.isoformat())
+    return len(documents)
+
+def rollup_gpu_utilization():
+    """Aggregate closed buckets of raw samples into minute buckets and minute buckets into hour buckets"""
+    try:
+        now = datetime.now()
+        raw_lag_seconds = 30 + config('GPU_UTILIZATION_FLUSH_SECONDS', default=10, cast=float)
+        if config('GPU_UTILIZATION_COMPACT_STORAGE', default=False, cast=bool):
+            # A run is written with the record closing it, which comes up to a check
+            # interval plus the scheduler's 30 s tick after the run's last sample
+            raw_lag_seconds += (config('GPU_UTILIZATION_MAX_RUN_MINUTES', default=60, cast=int) * 60
+                                + config('GPU_ACTIVITY_CHECK_MINUTES', default=5, cast=int) * 60 + 30)
+        with MongoDBConnection() as (client, db):
+            for tier, source, bucket_seconds, _ in TIERS:
+                # Wait after a bucket closes for buffered, late and still open runs of samples to arrive
+                lag_seconds = raw_lag_seconds if source == 'raw' else 0
+                created = _rollup_tier(db, tier, source, bucket_seconds, now, lag_seconds)
+                if created:
+                    logger.debug(f"Rolled up {created} {tier} utilization buckets")
+    except Exception as e:
+        logger.error(f"Error rolling up GPU utilization: {str(e)}")
+
+def _plan_segments(start, end, tiers):
+    """Split [start, end) into the coarsest tier segments that cover it
+
+    Args:
+        tiers: (name, bucket size in seconds, watermark) tuples, coarsest first
+
+    Returns:
+        list: (tier, start, end) segments, raw samples fill the edges
+    """
+    if start >= end:
+        return []
+    if not tiers:
+        return [('raw', start, end)]
+    tier, bucket_seconds, watermark = tiers[0]
+    covered_start = _ceil(start, bucket_seconds)
+    covered_end = _floor(end, bucket_seconds)
+    if watermark is not None:
+        covered_end = min(covered_end, watermark)
+    if watermark is None or covered_start >= covered_end:
+        return _plan_segments(start, end, tiers[1:])
+    return (_plan_segments(start, covered_start, tiers[1:])
+            + [(tier, covered_start, covered_end)]
+            + _plan_segments(covered_end, end, tiers[1:]))
+
+def _summarize_segment(db, tier, match, start, end):
+    if tier == 'raw':
+        stages = _raw_sample_stages(match, start, end)
+        value = lambda metric, stat: f'${metric}'
+        count = 1
+    else:
+        stages = [{'$match': dict(match, timestamp={'$gte': start, '$lt': end})}]
+        value = lambda metric, stat: f'${metric}.{stat}'
+        count = '$count'
+    group = {'_id': None, 'count': {'$sum': count}}
+    for metric in METRICS:
+        group[f'{metric}_min'] = {'$min': value(metric, 'min')}
+        group[f'{metric}_max'] = {'$max': value(metric, 'max')}
+        group[f'{metric}_sum'] = {'$sum': value(metric, 'sum')}
+    rows = list(db[tier_collection(tier)].aggregate(stages + [{'$group': group}]))
+    return rows[0] if rows else None
+
+def summarize_utilization(db, start, end, allocation_id=None, gpu_id=None):
+    """Summarize the utilization of an allocation or a GPU over a time range
+
+    The range is answered from the coarsest rollup tiers that cover it,
+    only the partial buckets at its edges are read from finer tiers.
+
+    Args:
+        db: MongoDB database connection
+        start: Start of the range
+        end: End of the range
+        allocation_id: Allocation to summarize (exclusive with gpu_id)
+        gpu_id: GPU to summarize
+
+    Returns:
+        dict: {'count', 'gpu_utilization': {'min', 'max', 'mean'}, 'memory_used': {...}}
+    """
+    tiers = [(tier, bucket_seconds, get_rollup_watermark(tier)) for tier, _, bucket_seconds, _ in reversed(TIERS)]
+    totals = {'count': 0}
+    for metric in METRICS:
+        totals[metric] = {'min': None, 'max': None, 'sum': 0}
+
+    for tier, segment_start, segment_end in _plan_segments(start, end, tiers):
+        if tier == 'raw':
+            match = {'allocation_id': str(allocation_id)} if allocation_id is not None else {'gpu_id': gpu_id}
+        elif allocation_id is not None:
+            match = {'meta.scope': 'allocation', 'meta.allocation_id': str(allocation_id)}
+        else:
+            match = {'meta.scope': 'gpu', 'meta.gpu_id': gpu_id}
+
+        row = _summarize_segment(db, tier, match, segment_start, segment_end)
+        if not row or not row['count']:
+            continue
+        totals['count'] += row['count']
+        for metric in METRICS:
+            stats = totals[metric]
+            # Samples older than a metric (e.g. power draw) have no value for it
+            if row[f'{metric}_min'] is not None:
+                stats['min'] = row[f'{metric}_min'] if stats['min'] is None else min(stats['min'], row[f'{metric}_min'])
+                stats['max'] = row[f'{metric}_max'] if stats['max'] is None else max(stats['max'], row[f'{metric}_max'])
+            stats['sum'] += row[f'{metric}_sum'] or 0
+
+    for metric in METRICS:
+        stats = totals[metric]
+        stats['mean'] = stats.pop('sum') / totals['count'] if totals['count'] else None
+    return totals
+
+def get_utilization_series(db, start, end, allocation_id=None, gpu_id=None):
+    """Get a utilization time series for charts from the coarsest fitting tier
+
+    Ranges up to GPU_UTILIZATION_SERIES_MINUTE_HOURS hours are served with
+    minute buckets, longer ones with hour buckets.
+
+    Returns:
+        list: {'timestamp', 'gpu_utilization': {...}, 'memory_used': {...}} points
+    """
+    minute_hours = config('GPU_UTILIZATION_SERIES_MINUTE_HOURS', default=6, cast=int)
+    tier = '1m' if end - start <= timedelta(hours=minute_hours) else '1h'
+    query = {'timestamp': {'$gte': start, '$lt': end}}
+    if allocation_id is not None:
+        query.update({'meta.scope': 'allocation', 'meta.allocation_id': str(allocation_id)})
+    else:
+        query.update({'meta.scope': 'gpu', 'meta.gpu_id': gpu_id})
+
+    series = []
+    for document in db[tier_collection(tier)].find(query).sort('timestamp', pymongo.ASCENDING):
+        point = {'timestamp': document['timestamp'].isoformat()}
+        for metric in METRICS:
+            if metric in document:
+                point[metric] = {stat: document[metric][stat] for stat in ('min', 'max', 'mean', 'last')}
+        series.append(point)
+    return series
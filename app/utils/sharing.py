@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta
+from decouple import config, Csv
+from app.utils.logger import logger
+from app.utils.redis_utils import (GPULease, get_gpu_config, get_available_gpus, get_mig_config, get_available_mig_instances,
+                                   claim_mig_instance, return_mig_instance, claim_gpu_share, return_gpu_share, get_shared_gpus)
+from app.utils.gpu_monitoring import allocate_gpus, get_gpu_status
+from app.utils.telemetry import read_gpu_window_stats
+from app.utils.health import get_unhealthy_gpus
+from app.utils.bookings import booked_gpus
+from app.utils.topology import get_gpu_topology, place_gpus
+
+# A shared allocation holds one unit of a GPU instead of the whole card:
+# on types partitioned into MIG instances an instance, isolated by the
+# hardware, on the types in SHARED_GPU_TYPES a time slice of a GPU whose
+# device is granted to up to SHARED_GPU_MAX_TENANTS users, each within the
+# memory it reserved. The unit's share of the GPU's energy is the share of
+# the GPU's memory it holds.
+
+def get_sharing_modes():
+    """Get how each shareable GPU type is shared
+
+    Returns:
+        dict: {gpu_type: 'mig' or 'shared'}
+    """
+    gpu_config = get_gpu_config()
+    modes = {gpu_type: 'shared' for gpu_type in config('SHARED_GPU_TYPES', default='', cast=Csv()) if gpu_type in gpu_config}
+    modes.update({gpu_type: 'mig' for gpu_type, instances in get_mig_config().items() if instances})
+    return modes
+
+def _mean_utilization(gpu_id):
+    """Mean utilization of a GPU over the last check window, 0 if unknown"""
+    window = read_gpu_window_stats(gpu_id)
+    return window['utilization_mean'] if window else 0
+
+def _energy_share(memory, memory_total):
+    """Share of a GPU's energy a unit holding memory of memory_total is charged, all of it when unknown"""
+    if not memory or not memory_total:
+        return 1.0
+    return min(1.0, memory / memory_total)
+
+def _claim_mig_unit(gpu_type, memory, excluded):
+    """Claim the smallest free MIG instance with enough memory, on the least busy GPU"""
+    instances = {(instance['gpu_id'], instance['instance_id']): instance for instance in get_mig_config().get(gpu_type, [])}
+    candidates = [instances[key] for key in get_available_mig_instances(gpu_type)
+                  if key in instances and key[0] not in excluded and (instances[key]['memory_total'] or 0) >= memory]
+    utilization = {gpu_id: _mean_utilization(gpu_id) for gpu_id in {instance['gpu_id'] for instance in candidates}}
+    for instance in sorted(candidates, key=lambda instance: (instance['memory_total'] or 0, utilization[instance['gpu_id']],
+                                                             instance['gpu_id'], instance['instance_id'])):
+        if claim_mig_instance(gpu_type, instance['gpu_id'], instance['instance_id']):
+            partitioned = sum(other['memory_total'] or 0 for other in instances.values() if other['gpu_id'] == instance['gpu_id'])
+            return instance['gpu_id'], {'unit': 'mig', 'mig_instance': instance['instance_id'],
+                                        'mig_profile': instance['profile'], 'memory_budget': instance['memory_total'],
+                                        'energy_share': _energy_share(instance['memory_total'], partitioned)}
+    return None, None
+
+def _claim_time_slice(gpu_type, memory, excluded, take_free):
+    """Claim a time slice, on the least busy GPU already shared or else on a free GPU"""
+    gpu_status = get_gpu_status()
+    gpu_ids = [gpu_id for gpu_id in get_gpu_config().get(gpu_type, []) if gpu_id not in excluded and gpu_id in gpu_status]
+    max_utilization = config('SHARED_GPU_MAX_UTILIZATION', default=50, cast=float)
+    # GPUs already shared go first so free GPUs stay whole, busy ones are skipped
+    shared = []
+    for gpu_id in get_shared_gpus(gpu_ids):
+        utilization = _mean_utilization(gpu_id)
+        if utilization <= max_utilization:
+            shared.append((utilization, gpu_id))
+    candidates = [gpu_id for _, gpu_id in sorted(shared)]
+    free_gpus = [gpu_id for gpu_id in get_available_gpus().get(gpu_type, []) if gpu_id in gpu_ids] if take_free else []
+    placed = place_gpus(free_gpus, 1, get_gpu_topology()) or []
+    candidates += placed + [gpu_id for gpu_id in free_gpus if gpu_id not in placed]
+    gpu_id = claim_gpu_share(gpu_type, [(gpu_id, gpu_status[gpu_id].get('memory_total') or 0) for gpu_id in candidates],
+                             memory, config('SHARED_GPU_MAX_TENANTS', default=4, cast=int))
+    if gpu_id is None:
+        return None, None
+    return gpu_id, {'unit': 'shared', 'memory_budget': memory, 'energy_share': _energy_share(memory, gpu_status[gpu_id].get('memory_total'))}
+
+def allocate_shared_gpu(db, username, gpu_type, memory_gb, days, take_free=True):
+    """Allocate a MIG instance or a time slice of a GPU to a user
+
+    Args:
+        db: MongoDB database connection
+        username: User the unit is allocated to
+        gpu_type: Type of GPU, must be shareable
+        memory_gb: GPU memory needed in GiB
+        days: Number of days for allocation
+        take_free: Whether a time slice may be started on a free GPU, or only on GPUs already shared
+
+    Returns:
+        tuple: (success, (gpu_id, unit) or error_message)
+    """
+    mode = get_sharing_modes().get(gpu_type)
+    if mode is None:
+        return False, f"{gpu_type} GPUs can't be shared"
+    if days <= 0 or days > 7:
+        return False, "Number of days must be between 1 and 7"
+    if memory_gb <= 0:
+        return False, "Memory must be a positive number of GiB"
+    memory = memory_gb * 1024
+
+    # A user gets at most one unit of a GPU, the ACL of the device is per user
+    now = datetime.now()
+    excluded = {allocation['gpu_id'] for allocation in db.gpu_allocations.find({'username': username, 'released_at': None}, {'gpu_id': 1})}
+    excluded |= get_unhealthy_gpus()
+    excluded |= booked_gpus(get_gpu_config().get(gpu_type, []), now, now + timedelta(days=days))
+
+    if mode == 'mig':
+        gpu_id, unit = _claim_mig_unit(gpu_type, memory, excluded)
+    else:
+        gpu_id, unit = _claim_time_slice(gpu_type, memory, excluded, take_free)
+    if gpu_id is None:
+        return False, f"No {gpu_type} GPU has {memory_gb:g} GiB to share"
+
+    try:
+        with GPULease(gpu_id) as lease:
+            success, result = allocate_gpus(username, [(gpu_type, gpu_id, days, unit)], leases={gpu_id: lease})
+        if not success:
+            raise Exception(result)
+    except Exception as e:
+        logger.error(f"Failed to allocate a share of GPU {gpu_id} to {username}: {str(e)}")
+        if mode == 'mig':
+            return_mig_instance(gpu_type, gpu_id, unit['mig_instance'])
+        else:
+            return_gpu_share(gpu_type, gpu_id, memory)
+        return False, f"Failed to allocate a shared GPU: {str(e)}"
+    logger.info(f"Allocated {unit['unit']} unit {unit} of {gpu_type} GPU {gpu_id} to {username}")
+    return True, (gpu_id, unit)
+
+def format_unit(allocation):
+    """Label of the GPU of an allocation, e.g. '4 (MIG 3g.20gb)' or '3 (shared, 8 GiB)'"""
+    if allocation.get('unit') == 'mig':
+        return f"{allocation['gpu_id']} (MIG {allocation['mig_profile']})"
+    if allocation.get('unit') == 'shared':
+        return f"{allocation['gpu_id']} (shared, {allocation['memory_budget'] / 1024:g} GiB)"
+    return str(allocation['gpu_id'])
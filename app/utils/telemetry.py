@@ -0,0 +1,389 @@
+import json
+import pwd
+import time
+from collections import deque
+from datetime import datetime
+from decouple import config
+from app.utils.logger import logger
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.redis_utils import get_gpu_config
+from app.utils.gpu_backend import get_gpu_backend,HEALTH_FIELDS
+from app.utils.ingest import get_user_memory_buffer
+from app.utils.health import update_gpu_health,record_gpu_health
+from app.utils.energy import GPUEnergyMeter,publish_gpu_energy
+
+def build_gpu_status(gpus):
+    """Build the status dictionary of the configured GPUs from a backend sample
+
+    Args:
+        gpus: List of GPU dicts as returned by GPUBackend.query_gpus()
+
+    Returns:
+        dict: Dictionary with GPU IDs as keys and status information as values
+    """
+    gpu_status = {}
+    gpu_dict = get_gpu_config()
+    for gpu in gpus:
+        gpu_id = gpu['index']
+
+        # Find which GPU type this ID belongs to, skipping unmanaged GPUs
+        gpu_type = next((type_name for type_name, ids in gpu_dict.items() if gpu_id in ids), None)
+        if gpu_type is None:
+            continue
+        memory_used = gpu['memory_used']
+        memory_total = gpu['memory_total']
+        gpu_status[gpu_id] = {
+            'gpu_type': gpu_type,
+            'utilization': gpu['utilization'],
+            'memory_used': memory_used,
+            'memory_total': memory_total,
+            'memory_percent': (memory_used / memory_total) * 100 if memory_total > 0 else 0,
+            'power_draw': gpu.get('power_draw')
+        }
+        gpu_status[gpu_id].update({field: gpu.get(field) for field in HEALTH_FIELDS})
+    return gpu_status
+
+def sample_gpu_status():
+    """Sample every configured GPU once with a single backend query
+
+    Returns:
+        dict: Dictionary with GPU IDs as keys and status information as values
+    """
+    try:
+        return build_gpu_status(get_gpu_backend().query_gpus())
+    except Exception as e:
+        logger.error(f"Error sampling GPU status: {str(e)}")
+        return {}
+
+class GPUWindowStats:
+    """Sliding-window max/mean of utilization and memory usage, and mean power draw, per GPU
+
+    Samples older than the window are evicted as new ones arrive. Sums are
+    kept incrementally and maxima with monotonic deques, so adding a sample
+    and reading the statistics are both amortized O(1).
+    """
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self._windows = {}
+
+    def add(self, gpu_id, timestamp, utilization, memory_used, power_draw=None):
+        window = self._windows.get(gpu_id)
+        if window is None:
+            window = self._windows[gpu_id] = {
+                'samples': deque(),
+                'utilization_sum': 0.0,
+                'memory_sum': 0.0,
+                'power_sum': 0.0,
+                'power_count': 0,
+                'utilization_max': deque(),
+                'memory_max': deque()
+            }
+        window['samples'].append((timestamp, utilization, memory_used, power_draw))
+        window['utilization_sum'] += utilization
+        window['memory_sum'] += memory_used
+        if power_draw is not None:
+            window['power_sum'] += power_draw
+            window['power_count'] += 1
+        for key, value in (('utilization_max', utilization), ('memory_max', memory_used)):
+            maxima = window[key]
+            while maxima and maxima[-1][1] <= value:
+                maxima.pop()
+            maxima.append((timestamp, value))
+        self._evict(window, timestamp - self.window_seconds)
+
+    def _evict(self, window, window_start):
+        samples = window['samples']
+        while samples and samples[0][0] < window_start:
+            _, utilization, memory_used, power_draw = samples.popleft()
+            window['utilization_sum'] -= utilization
+            window['memory_sum'] -= memory_used
+            if power_draw is not None:
+                window['power_sum'] -= power_draw
+                window['power_count'] -= 1
+        for key in ('utilization_max', 'memory_max'):
+            while window[key] and window[key][0][0] < window_start:
+                window[key].popleft()
+
+    def stats(self, gpu_id):
+        """Get the statistics of the current window of a GPU
+
+        Returns:
+            dict: Max/mean utilization and memory usage and mean power draw, or None without samples
+        """
+        window = self._windows.get(gpu_id)
+        if not window or not window['samples']:
+            return None
+        count = len(window['samples'])
+        return {
+            'utilization_max': window['utilization_max'][0][1],
+            'utilization_mean': window['utilization_sum'] / count,
+            'memory_max': window['memory_max'][0][1],
+            'memory_mean': window['memory_sum'] / count,
+            'power_mean': window['power_sum'] / window['power_count'] if window['power_count'] else None,
+            'samples': count,
+            'window_start': window['samples'][0][0],
+            'window_end': window['samples'][-1][0]
+        }
+
+def get_process_owner_uid(pid):
+    """Get the real UID owning a process from /proc/<pid>/status
+
+    Returns:
+        int: UID of the process owner or None if the process is gone
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Uid:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def get_gpu_process_usage(gpu_ids=None):
+    """Attribute the compute processes of the GPUs and their memory to users in one pass
+
+    Compute apps of all GPUs are queried at once and owners are resolved
+    from /proc, so callers should build this once per tick and reuse it.
+
+    Args:
+        gpu_ids: Optional list of GPU IDs to restrict the query to
+
+    Returns:
+        dict: {gpu_id: {username: {'pids': [pid, ...], 'memory_used': MiB}}}
+    """
+    process_usage = {}
+    usernames = {}
+    for process in get_gpu_backend().query_compute_apps(gpu_ids):
+        uid = get_process_owner_uid(process['pid'])
+        if uid is None:
+            continue
+        if uid not in usernames:
+            try:
+                usernames[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                usernames[uid] = str(uid)
+        users = process_usage.setdefault(process['gpu_id'], {})
+        usage = users.setdefault(usernames[uid], {'pids': [], 'memory_used': 0.0})
+        usage['pids'].append(process['pid'])
+        usage['memory_used'] += process['used_memory']
+    return process_usage
+
+def get_gpu_process_map(gpu_ids=None):
+    """Build the GPU -> user -> PIDs map of compute processes in one pass
+
+    Args:
+        gpu_ids: Optional list of GPU IDs to restrict the query to
+
+    Returns:
+        dict: {gpu_id: {username: [pid, ...]}}
+    """
+    return {gpu_id: {username: usage['pids'] for username, usage in users.items()}
+            for gpu_id, users in get_gpu_process_usage(gpu_ids).items()}
+
+def publish_gpu_snapshot(gpu_status):
+    """Publish a GPU status snapshot to Redis
+
+    The latest snapshot is stored in a hash together with a monotonically
+    increasing version, and appended to a short ring buffer of recent snapshots.
+
+    Args:
+        gpu_status: Dictionary with GPU IDs as keys and status information as values
+
+    Returns:
+        int: Version of the published snapshot
+    """
+    history_size = config('GPU_TELEMETRY_HISTORY_SIZE', default=60, cast=int)
+    timestamp = time.time()
+    gpus = json.dumps(gpu_status)
+
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.hincrby(REDIS_KEYS['gpu_status'], 'version', 1)
+    pipe.hset(REDIS_KEYS['gpu_status'], mapping={'timestamp': timestamp, 'gpus': gpus})
+    results = pipe.execute()
+    version = results[0]
+
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.lpush(REDIS_KEYS['gpu_status_history'], json.dumps({'version': version, 'timestamp': timestamp, 'gpus': gpu_status}))
+    pipe.ltrim(REDIS_KEYS['gpu_status_history'], 0, history_size - 1)
+    pipe.execute()
+    return version
+
+def _decode_gpus(gpus):
+    # JSON turns the integer GPU IDs into strings, convert them back
+    return {int(gpu_id): status for gpu_id, status in gpus.items()}
+
+def read_gpu_snapshot():
+    """Read the latest GPU status snapshot from Redis
+
+    Returns:
+        dict: {'version', 'timestamp', 'age', 'gpus'} or None if no snapshot was published
+    """
+    snapshot = REDIS_CLIENT.hgetall(REDIS_KEYS['gpu_status'])
+    if not snapshot or 'gpus' not in snapshot:
+        return None
+    timestamp = float(snapshot['timestamp'])
+    return {
+        'version': int(snapshot['version']),
+        'timestamp': timestamp,
+        'age': time.time() - timestamp,
+        'gpus': _decode_gpus(json.loads(snapshot['gpus']))
+    }
+
+def get_gpu_status_history(count=None):
+    """Get the most recent GPU status snapshots, newest first
+
+    Args:
+        count: Maximum number of snapshots to return (default: whole ring buffer)
+
+    Returns:
+        list: Snapshots as {'version', 'timestamp', 'gpus'} dictionaries
+    """
+    history = REDIS_CLIENT.lrange(REDIS_KEYS['gpu_status_history'], 0, -1 if count is None else count - 1)
+    snapshots = []
+    for entry in history:
+        snapshot = json.loads(entry)
+        snapshot['gpus'] = _decode_gpus(snapshot['gpus'])
+        snapshots.append(snapshot)
+    return snapshots
+
+def publish_gpu_window_stats(window_stats):
+    """Publish the sliding-window statistics of every GPU to Redis
+
+    Args:
+        window_stats: Dictionary with GPU IDs as keys and GPUWindowStats.stats() as values
+    """
+    updated_at = time.time()
+    mapping = {}
+    for gpu_id, stats in window_stats.items():
+        if stats:
+            mapping[gpu_id] = json.dumps(dict(stats, updated_at=updated_at))
+    if mapping:
+        REDIS_CLIENT.hset(REDIS_KEYS['gpu_window_stats'], mapping=mapping)
+
+def read_gpu_window_stats(gpu_id):
+    """Read the current sliding-window statistics of a GPU
+
+    Returns:
+        dict: Statistics as published by the collector, with their 'age', or None
+    """
+    stats = REDIS_CLIENT.hget(REDIS_KEYS['gpu_window_stats'], gpu_id)
+    if not stats:
+        return None
+    stats = json.loads(stats)
+    stats['age'] = time.time() - stats['updated_at']
+    return stats
+
+def publish_user_gpu_memory(process_usage):
+    """Publish the GPU memory used by each user's processes to Redis
+
+    The whole hash is replaced at once, so users whose processes are gone
+    disappear from it.
+
+    Args:
+        process_usage: Result of get_gpu_process_usage()
+    """
+    by_user = {}
+    for gpu_id, users in process_usage.items():
+        for username, usage in users.items():
+            by_user.setdefault(username, {})[gpu_id] = usage['memory_used']
+    mapping = {username: json.dumps(memory) for username, memory in by_user.items()}
+    mapping['timestamp'] = time.time()
+
+    pipe = REDIS_CLIENT.pipeline()
+    pipe.delete(REDIS_KEYS['gpu_user_memory'])
+    pipe.hset(REDIS_KEYS['gpu_user_memory'], mapping=mapping)
+    pipe.execute()
+
+def read_user_gpu_memory(username):
+    """Get the GPU memory used by a user's processes, as last published by the collector
+
+    Returns:
+        dict: {gpu_id: MiB} for every GPU the user has processes on, empty if unknown or stale
+    """
+    pipe = REDIS_CLIENT.pipeline(transaction=False)
+    pipe.hget(REDIS_KEYS['gpu_user_memory'], 'timestamp')
+    pipe.hget(REDIS_KEYS['gpu_user_memory'], username)
+    timestamp, memory = pipe.execute()
+    max_age = 3 * config('GPU_PROCESS_TELEMETRY_INTERVAL_SECONDS', default=30, cast=float)
+    if not timestamp or not memory or time.time() - float(timestamp) > max_age:
+        return {}
+    return _decode_gpus(json.loads(memory))
+
+def record_user_gpu_memory(process_usage, timestamp=None):
+    """Publish per-user GPU memory and append it to the gpu_user_memory time series
+
+    Args:
+        process_usage: Result of get_gpu_process_usage()
+        timestamp: Datetime of the sample (default: now)
+    """
+    publish_user_gpu_memory(process_usage)
+    timestamp = datetime.now() if timestamp is None else timestamp
+    buffer = get_user_memory_buffer()
+    for gpu_id, users in process_usage.items():
+        for username, usage in users.items():
+            buffer.add({
+                'timestamp': timestamp,
+                'username': username,
+                'gpu_id': gpu_id,
+                'memory_used': usage['memory_used'],
+                'processes': len(usage['pids'])
+            })
+
+def run_telemetry_collector():
+    """Stream samples of all GPUs and publish snapshots, window statistics, health, energy and per-user memory
+
+    A single long-lived sampler reads every GPU continuously, keeps the
+    per-GPU sliding-window statistics and power integrals in memory and
+    publishes the latest snapshot, health state and energy once per tick.
+    Compute processes are attributed to users every
+    GPU_PROCESS_TELEMETRY_INTERVAL_SECONDS. Runs forever, it is meant to be
+    started once per host in a daemon thread.
+    """
+    interval = config('GPU_TELEMETRY_INTERVAL_SECONDS', default=2, cast=float)
+    stream_interval = config('GPU_STREAM_INTERVAL_MS', default=500, cast=int) / 1000
+    window_seconds = config('GPU_ACTIVITY_CHECK_MINUTES', default=5, cast=int) * 60
+    process_interval = config('GPU_PROCESS_TELEMETRY_INTERVAL_SECONDS', default=30, cast=float)
+    health_interval = config('GPU_HEALTH_HISTORY_INTERVAL_SECONDS', default=60, cast=float)
+    windows = GPUWindowStats(window_seconds)
+    energy = GPUEnergyMeter()
+    logger.info(f"Starting GPU telemetry collector with a {interval}s interval and {stream_interval}s sampling")
+
+    # Older versions cached the status as a plain string under the same key
+    if REDIS_CLIENT.type(REDIS_KEYS['gpu_status']) not in ('hash', 'none'):
+        REDIS_CLIENT.delete(REDIS_KEYS['gpu_status'])
+
+    while True:
+        try:
+            last_published = 0
+            last_processes = 0
+            last_health_recorded = 0
+            for gpus in get_gpu_backend().stream_gpus(stream_interval):
+                now = time.time()
+                for gpu in gpus:
+                    # A GPU in MIG mode has no utilization, it gets no window statistics
+                    if gpu['utilization'] is not None:
+                        windows.add(gpu['index'], now, gpu['utilization'], gpu['memory_used'], gpu.get('power_draw'))
+                    energy.add(gpu['index'], now, gpu.get('power_draw'))
+
+                if time.monotonic() - last_published < interval:
+                    continue
+                last_published = time.monotonic()
+                gpu_status = build_gpu_status(gpus)
+                if gpu_status:
+                    publish_gpu_snapshot(gpu_status)
+                    publish_gpu_window_stats({gpu_id: windows.stats(gpu_id) for gpu_id in gpu_status})
+                    publish_gpu_energy(energy.drain())
+                    managed_gpus = [gpu for gpu in gpus if gpu['index'] in gpu_status]
+                    update_gpu_health(managed_gpus)
+                    if time.monotonic() - last_health_recorded >= health_interval:
+                        last_health_recorded = time.monotonic()
+                        record_gpu_health(managed_gpus)
+
+                if time.monotonic() - last_processes >= process_interval:
+                    last_processes = time.monotonic()
+                    record_user_gpu_memory(get_gpu_process_usage())
+            logger.warning("GPU sample stream ended, restarting it")
+        except Exception as e:
+            logger.error(f"Error in telemetry collector: {str(e)}")
+        time.sleep(interval)
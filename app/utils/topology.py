@@ -0,0 +1,102 @@
+import json
+from itertools import combinations
+from math import comb
+from app.utils.logger import logger
+from app.config import REDIS_CLIENT, REDIS_KEYS
+from app.utils.gpu_backend import get_gpu_backend
+
+# Cost of a link between two GPUs, lower is faster. NVLink gets cheaper
+# with every bonded link, PCIe paths get dearer the more bridges they cross
+_PCIE_COSTS = {'X': 0, 'PIX': 12, 'PXB': 14, 'PHB': 20, 'NODE': 30, 'SYS': 40, 'SOC': 40}
+_MAX_COST = 40
+
+# Above this many candidate subsets placement grows subsets greedily instead of trying them all
+_MAX_EXHAUSTIVE_SUBSETS = 5000
+
+def link_cost(link):
+    """Cost of a link as printed by `nvidia-smi topo -m`, unknown links cost as much as SYS"""
+    if link.startswith('NV') and link[2:].isdigit():
+        return max(1, 10 - int(link[2:]))
+    return _PCIE_COSTS.get(link, _MAX_COST)
+
+def initialize_gpu_topology():
+    """Query the GPU topology once and store its link costs in Redis
+
+    Placement falls back to the lowest free GPU IDs when this fails.
+
+    Returns:
+        bool: True if the topology was stored
+    """
+    try:
+        topology = get_gpu_backend().query_topology()
+        costs = {str(gpu_id): {str(peer): link_cost(link) for peer, link in links.items()}
+                 for gpu_id, links in topology.items()}
+        REDIS_CLIENT.set(REDIS_KEYS['gpu_topology'], json.dumps(costs))
+        logger.info(f"Initialized GPU topology in Redis: {topology}")
+        return True
+    except Exception as e:
+        REDIS_CLIENT.delete(REDIS_KEYS['gpu_topology'])
+        logger.warning(f"Failed to query the GPU topology, GPUs are placed by ID: {str(e)}")
+        return False
+
+def get_gpu_topology():
+    """Get the link costs stored by initialize_gpu_topology
+
+    Returns:
+        dict: {gpu_id: {gpu_id: cost}}, or an empty dict if the topology is unknown
+    """
+    try:
+        costs = REDIS_CLIENT.get(REDIS_KEYS['gpu_topology'])
+        if not costs:
+            return {}
+        return {int(gpu_id): {int(peer): cost for peer, cost in links.items()}
+                for gpu_id, links in json.loads(costs).items()}
+    except Exception as e:
+        logger.error(f"Error getting GPU topology from Redis: {str(e)}")
+        return {}
+
+def _cost(topology, a, b):
+    return topology.get(a, {}).get(b, _MAX_COST)
+
+def _score(topology, subset, free_gpus):
+    """Rank a subset: slowest link, then total link cost, then how much it fragments the rest
+
+    Fragmentation is the connectivity between the subset and the GPUs left
+    free, so a small request takes GPUs poorly linked to the others and
+    keeps well-connected groups whole for larger requests.
+    """
+    pairs = [_cost(topology, a, b) for a, b in combinations(subset, 2)]
+    rest = [gpu_id for gpu_id in free_gpus if gpu_id not in subset]
+    fragmentation = sum(_MAX_COST - _cost(topology, a, b) for a in subset for b in rest)
+    return max(pairs, default=0), sum(pairs), fragmentation, tuple(subset)
+
+def _grow(topology, seed, free_gpus, count):
+    """Greedily grow a subset from a seed GPU, adding the GPU with the cheapest links to it"""
+    subset = [seed]
+    while len(subset) < count:
+        subset.append(min((gpu_id for gpu_id in free_gpus if gpu_id not in subset),
+                          key=lambda gpu_id: (max(_cost(topology, gpu_id, member) for member in subset),
+                                              sum(_cost(topology, gpu_id, member) for member in subset), gpu_id)))
+    return sorted(subset)
+
+def place_gpus(free_gpus, count, topology):
+    """Pick the best-connected subset of free GPUs for a request
+
+    Args:
+        free_gpus: IDs of the GPUs that can be picked
+        count: Number of GPUs wanted
+        topology: Link costs from get_gpu_topology(), empty to pick the lowest IDs
+
+    Returns:
+        list: Sorted IDs of the picked GPUs, or None if there aren't enough free GPUs
+    """
+    free_gpus = sorted(free_gpus)
+    if count > len(free_gpus):
+        return None
+    if not topology or count == 0 or count == len(free_gpus):
+        return free_gpus[:count]
+    if comb(len(free_gpus), count) <= _MAX_EXHAUSTIVE_SUBSETS:
+        candidates = combinations(free_gpus, count)
+    else:
+        candidates = (_grow(topology, seed, free_gpus, count) for seed in free_gpus)
+    return list(min(_score(topology, list(subset), free_gpus) for subset in candidates)[3])
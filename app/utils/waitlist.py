@@ -0,0 +1,199 @@
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+import pymongo
+from pymongo import ReturnDocument
+from bson import ObjectId
+from decouple import config
+from app.utils.logger import logger
+from app.utils import notification
+from app.utils.db import MongoDBConnection
+from app.config import REDIS_KEYS
+from app.utils.redis_utils import DistributedLock, GPULease, claim_gpus, return_gpus, get_gpu_config
+from app.utils.health import get_unhealthy_gpus
+from app.utils.gpu_monitoring import allocate_gpus, on_gpus_freed
+from app.utils.bookings import booked_gpus
+from app.utils.quotas import check_quota, get_priority, quota_lock
+
+def join_waitlist(db, username, gpu_type, count, days):
+    """Queue a request for GPUs that is granted as soon as enough of them are free
+
+    A user has at most one waiting request per GPU type. Joining again
+    updates the count and days but keeps the place in the queue.
+
+    Args:
+        db: MongoDB database connection
+        username: User requesting the GPUs
+        gpu_type: Type of GPU requested
+        count: Number of GPUs requested
+        days: Number of days for the allocation once granted
+
+    Returns:
+        tuple: (success, request_id or error_message)
+    """
+    gpu_config = get_gpu_config()
+    if gpu_type not in gpu_config:
+        return False, f"Invalid GPU type: {gpu_type}"
+    if count <= 0 or count > len(gpu_config[gpu_type]):
+        return False, f"Number of {gpu_type} GPUs must be between 1 and {len(gpu_config[gpu_type])}"
+    if days <= 0 or days > 7:
+        return False, "Number of days must be between 1 and 7"
+    request = db.gpu_requests.find_one_and_update(
+        {'username': username, 'gpu_type': gpu_type, 'status': 'waiting'},
+        {'$set': {'count': count, 'days': days}, '$setOnInsert': {'requested_at': datetime.now()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    logger.info(f"User {username} is waiting for {count} {gpu_type} GPUs for {days} days")
+    return True, request['_id']
+
+def leave_waitlist(db, request_id, username=None):
+    """Cancel a waiting request
+
+    Args:
+        db: MongoDB database connection
+        request_id: ID of the request
+        username: Only cancel the request if it belongs to this user (None for admins)
+
+    Returns:
+        bool: True if a waiting request was cancelled
+    """
+    query = {'_id': ObjectId(request_id), 'status': 'waiting'}
+    if username is not None:
+        query['username'] = username
+    result = db.gpu_requests.update_one(query, {'$set': {'status': 'cancelled', 'cancelled_at': datetime.now()}})
+    return result.modified_count > 0
+
+def get_waitlist(db):
+    """Get the waiting requests in the order they are granted
+
+    With WAITLIST_ORDER=fifo requests are served by arrival. With fair,
+    users with a higher fair-share priority go first, ties are served by arrival.
+
+    Returns:
+        list: Waiting request documents, next to be granted first
+    """
+    requests = list(db.gpu_requests.find({'status': 'waiting'}).sort('requested_at', pymongo.ASCENDING))
+    if config('WAITLIST_ORDER', default='fifo') == 'fair':
+        priorities = {username: get_priority(username) for username in {request['username'] for request in requests}}
+        # Stable sort, so arrival order is kept among users with the same priority
+        requests.sort(key=lambda request: -priorities[request['username']])
+    return requests
+
+def reserved_for_waitlist(db, gpu_type, username):
+    """Count the GPUs of a type that waiting users with a higher priority than a user are owed
+
+    An immediate allocation may only take free GPUs beyond these, so it
+    doesn't jump ahead of users with a better fair-share score.
+
+    Returns:
+        int: Number of GPUs requested by the waiting requests of higher priority users
+    """
+    waiting = list(db.gpu_requests.find({'gpu_type': gpu_type, 'status': 'waiting', 'username': {'$ne': username}},
+                                        {'username': 1, 'count': 1, 'days': 1}))
+    if not waiting:
+        return 0
+    priority = get_priority(username)
+    priorities = {other: get_priority(other) for other in {request['username'] for request in waiting}}
+    # Requests over quota can't be granted, so nothing is held for them
+    return sum(request['count'] for request in waiting if priorities[request['username']] > priority
+               and check_quota(request['username'], request['count'], request['count'] * request['days'] * 24)[0])
+
+def _grant_request(db, request, gpu_ids):
+    """Allocate claimed GPUs to a waiting request, returning them to the pool on failure"""
+    # Take the request so a concurrent cancel can't leave an allocation nobody asked for
+    if not db.gpu_requests.find_one_and_update({'_id': request['_id'], 'status': 'waiting'}, {'$set': {'status': 'granting'}}):
+        return_gpus([(request['gpu_type'], gpu_id) for gpu_id in gpu_ids])
+        return False
+    try:
+        with ExitStack() as stack:
+            leases = {gpu_id: stack.enter_context(GPULease(gpu_id)) for gpu_id in gpu_ids}
+            success, result = allocate_gpus(request['username'], [(request['gpu_type'], gpu_id, request['days']) for gpu_id in gpu_ids], leases=leases)
+        if not success:
+            raise Exception(result)
+    except Exception as e:
+        logger.error(f"Failed to grant request {request['_id']} of user {request['username']}: {str(e)}")
+        return_gpus([(request['gpu_type'], gpu_id) for gpu_id in gpu_ids])
+        db.gpu_requests.update_one({'_id': request['_id']}, {'$set': {'status': 'waiting'}})
+        return False
+
+    db.gpu_requests.update_one({'_id': request['_id']}, {'$set': {
+        'status': 'granted',
+        'granted_at': datetime.now(),
+        'gpu_ids': gpu_ids,
+        'allocation_ids': result
+    }})
+    logger.info(f"Granted {request['gpu_type']} GPUs {gpu_ids} to waiting user {request['username']}")
+    notification.send_notification(request['username'],
+                                   f"Your request for {request['count']} {request['gpu_type']} GPU(s) was granted: GPU {', '.join(str(gpu_id) for gpu_id in gpu_ids)} for {request['days']} days.")
+    return True
+
+@on_gpus_freed
+def dispatch_waitlist():
+    """Grant free GPUs to waiting requests in queue order
+
+    A request that can't be satisfied yet blocks the requests of the same
+    GPU type behind it, so large requests aren't starved by small ones.
+    Only the users whose requests are granted are notified.
+
+    Returns:
+        int: Number of requests granted
+    """
+    try:
+        with DistributedLock(REDIS_KEYS['waitlist_lock']):
+            with MongoDBConnection() as (client, db):
+                requests = get_waitlist(db)
+                if not requests:
+                    return 0
+                unhealthy_gpus = get_unhealthy_gpus()
+                gpu_config = get_gpu_config()
+                blocked_types = set()
+                granted = 0
+                for request in requests:
+                    if request['gpu_type'] in blocked_types:
+                        continue
+                    with quota_lock(request['username']):
+                        # Over-quota requests wait for their usage to drop without holding back the others
+                        allowed, _ = check_quota(request['username'], request['count'], request['count'] * request['days'] * 24)
+                        if not allowed:
+                            continue
+                        # GPUs booked before the allocation would end can't be granted
+                        now = datetime.now()
+                        booked = booked_gpus(gpu_config.get(request['gpu_type'], []), now, now + timedelta(days=request['days']))
+                        claimed, _ = claim_gpus({request['gpu_type']: request['count']}, exclude=unhealthy_gpus | booked)
+                        if claimed is None:
+                            blocked_types.add(request['gpu_type'])
+                            continue
+                        if _grant_request(db, request, claimed[request['gpu_type']]):
+                            granted += 1
+                return granted
+    except Exception as e:
+        logger.error(f"Failed to dispatch GPU waitlist: {str(e)}")
+        return 0
+
+def migrate_notify_list():
+    """Tell the users still registered on the old "notify me" list to join the waitlist
+
+    The list only held usernames, so there is no GPU type, count or days
+    to turn the registrations into waitlist requests. Each user is notified
+    once and the gpu_notif_list collection is dropped.
+
+    Returns:
+        int: Number of users notified
+    """
+    try:
+        with MongoDBConnection() as (client, db):
+            if 'gpu_notif_list' not in db.list_collection_names():
+                return 0
+            notified = 0
+            # Deleting each entry as it is handled keeps a restart from notifying anyone twice
+            while (entry := db.gpu_notif_list.find_one_and_delete({})) is not None:
+                notification.send_notification(entry['username'],
+                                               "GPU availability notifications were replaced by the waitlist. "
+                                               "Join the waitlist from the dashboard to be allocated GPUs as soon as they are free.")
+                notified += 1
+            db.drop_collection('gpu_notif_list')
+            logger.info(f"Migrated the notify list, notified {notified} users about the waitlist")
+            return notified
+    except Exception as e:
+        logger.error(f"Error migrating the notify list: {str(e)}")
+        return 0
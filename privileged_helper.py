@@ -0,0 +1,314 @@
+"""Root helper doing the privileged work of GPULocker over a Unix socket
+
+Changing device ACLs, listing the processes of other users on the GPUs,
+signalling them, measuring home directories and listing MIG instances
+need root. Instead of
+forking `sudo setfacl` and friends for every change, GPULocker sends
+batches of commands to this daemon, which runs as root and only accepts:
+
+    set_acl       {"username", "devices", "permission": "rw" | "none" | null}
+    get_acl       {"devices"}
+    gpu_processes {"gpu_ids": [...] | null}
+    kill          {"username", "pids", "signal": "KILL" | "TERM"}
+    disk_usage    {"username"}
+    mig_instances {}, the GPU instance table printed by `nvidia-smi mig -lgi`
+
+Devices must be GPU or MIG capability device nodes, access is only granted
+to and processes only signalled for regular users (UID >= --min-uid), and
+only root and the --user account GPULocker runs as may connect. ACLs are
+written directly as the system.posix_acl_access extended attribute.
+
+Requests and responses are JSON lines:
+    {"commands": [{"op": "set_acl", "username": "amin", "devices": ["/dev/nvidia0"], "permission": "rw"}]}
+    {"results": [{"ok": true, "result": null}]}
+
+Usage:
+    sudo python privileged_helper.py --user gpulocker
+"""
+import argparse
+import errno
+import json
+import logging
+import os
+import pwd
+import re
+import signal
+import socket
+import socketserver
+import stat
+import struct
+import subprocess
+import threading
+
+from decouple import config
+
+logger = logging.getLogger('privileged_helper')
+
+DEVICE_PATTERN = re.compile(r'^/dev/(nvidia\d+|nvidia-caps/nvidia-cap\d+)$')
+SIGNALS = {'KILL': signal.SIGKILL, 'TERM': signal.SIGTERM}
+MAX_REQUEST_BYTES = 1 << 20
+
+# Layout of the system.posix_acl_access attribute, see linux/posix_acl_xattr.h
+ACL_XATTR = 'system.posix_acl_access'
+ACL_VERSION = 2
+ACL_USER_OBJ, ACL_USER, ACL_GROUP_OBJ, ACL_GROUP, ACL_MASK, ACL_OTHER = 0x01, 0x02, 0x04, 0x08, 0x10, 0x20
+ACL_UNDEFINED_ID = 0xffffffff
+_ACL_HEADER = struct.Struct('<I')
+_ACL_ENTRY = struct.Struct('<HHI')
+PERMISSIONS = {'rw': 6, 'none': 0}
+
+def read_acl(path):
+    """Read the access ACL of a file
+
+    Returns:
+        dict: {(tag, id): permission bits}, the entries derived from the mode if the file has no ACL
+    """
+    try:
+        data = os.getxattr(path, ACL_XATTR, follow_symlinks=False)
+    except OSError as e:
+        if e.errno != errno.ENODATA:
+            raise
+        mode = os.lstat(path).st_mode
+        return {(ACL_USER_OBJ, ACL_UNDEFINED_ID): (mode >> 6) & 7,
+                (ACL_GROUP_OBJ, ACL_UNDEFINED_ID): (mode >> 3) & 7,
+                (ACL_OTHER, ACL_UNDEFINED_ID): mode & 7}
+    (version,) = _ACL_HEADER.unpack_from(data)
+    if version != ACL_VERSION:
+        raise ValueError(f"Unsupported ACL version {version} on {path}")
+    return {(tag, entry_id): permission for tag, permission, entry_id in _ACL_ENTRY.iter_unpack(data[_ACL_HEADER.size:])}
+
+def write_acl(path, entries):
+    """Write the access ACL of a file, recomputing the mask like setfacl does
+
+    Args:
+        path: File to change
+        entries: {(tag, id): permission bits} as returned by read_acl()
+    """
+    entries = {key: permission for key, permission in entries.items() if key[0] != ACL_MASK}
+    if not any(tag in (ACL_USER, ACL_GROUP) for tag, _ in entries):
+        # Only the base entries are left, they live in the mode
+        try:
+            os.removexattr(path, ACL_XATTR, follow_symlinks=False)
+        except OSError as e:
+            if e.errno != errno.ENODATA:
+                raise
+        mode = stat.S_IMODE(os.lstat(path).st_mode) & ~0o777
+        os.chmod(path, mode | entries[(ACL_USER_OBJ, ACL_UNDEFINED_ID)] << 6
+                 | entries[(ACL_GROUP_OBJ, ACL_UNDEFINED_ID)] << 3 | entries[(ACL_OTHER, ACL_UNDEFINED_ID)])
+        return
+    mask = 0
+    for (tag, _), permission in entries.items():
+        if tag in (ACL_USER, ACL_GROUP_OBJ, ACL_GROUP):
+            mask |= permission
+    entries[(ACL_MASK, ACL_UNDEFINED_ID)] = mask
+    # The kernel wants the entries ordered by tag, then by ID
+    data = _ACL_HEADER.pack(ACL_VERSION) + b''.join(_ACL_ENTRY.pack(tag, permission, entry_id)
+                                                     for (tag, entry_id), permission in sorted(entries.items()))
+    os.setxattr(path, ACL_XATTR, data, follow_symlinks=False)
+
+def process_owner(pid):
+    """Real UID owning a process, None if it is gone"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('Uid:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def directory_size(path):
+    """Apparent size of a directory tree in bytes, like `du -sb`, counting hard links once"""
+    total = os.lstat(path).st_size
+    seen = set()
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    info = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if info.st_nlink > 1 and not stat.S_ISDIR(info.st_mode):
+                    if (info.st_dev, info.st_ino) in seen:
+                        continue
+                    seen.add((info.st_dev, info.st_ino))
+                total += info.st_size
+                if stat.S_ISDIR(info.st_mode):
+                    stack.append(entry.path)
+    return total
+
+class PrivilegedCommands:
+    """The validated commands of the helper
+
+    Args:
+        min_uid: Lowest UID of a regular user
+    """
+    def __init__(self, min_uid):
+        self.min_uid = min_uid
+        # setfacl isn't atomic either, serialize the read-modify-write of the ACLs
+        self._acl_lock = threading.Lock()
+
+    def _user(self, username, regular=True):
+        try:
+            user = pwd.getpwnam(str(username))
+        except KeyError:
+            raise ValueError(f"Unknown user {username}")
+        if regular and user.pw_uid < self.min_uid:
+            raise ValueError(f"{username} is not a regular user")
+        return user
+
+    @staticmethod
+    def _devices(devices):
+        if not isinstance(devices, list) or not devices:
+            raise ValueError("devices must be a non-empty list")
+        for device in devices:
+            if not isinstance(device, str) or not DEVICE_PATTERN.match(device) or os.path.realpath(device) != device:
+                raise ValueError(f"Not a GPU device: {device}")
+            if not stat.S_ISCHR(os.lstat(device).st_mode):
+                raise ValueError(f"Not a character device: {device}")
+        return devices
+
+    def set_acl(self, username, devices, permission):
+        if permission not in (None, *PERMISSIONS):
+            raise ValueError(f"Invalid permission {permission}")
+        # Denying and removing entries is allowed for every user, setup_gpus.sh denies root too
+        user = self._user(username, regular=permission == 'rw')
+        with self._acl_lock:
+            for device in self._devices(devices):
+                entries = read_acl(device)
+                if permission is None:
+                    entries.pop((ACL_USER, user.pw_uid), None)
+                else:
+                    entries[(ACL_USER, user.pw_uid)] = PERMISSIONS[permission]
+                write_acl(device, entries)
+
+    def get_acl(self, devices):
+        acls = {}
+        for device in self._devices(devices):
+            users = acls[device] = {}
+            for (tag, uid), permission in read_acl(device).items():
+                if tag == ACL_USER:
+                    try:
+                        name = pwd.getpwuid(uid).pw_name
+                    except KeyError:
+                        name = str(uid)
+                    users[name] = ''.join(flag if permission & bit else '-' for flag, bit in (('r', 4), ('w', 2), ('x', 1)))
+        return acls
+
+    def gpu_processes(self, gpu_ids=None):
+        args = ['nvidia-smi', '--query-compute-apps=gpu_uuid,pid,used_memory', '--format=csv,noheader,nounits']
+        if gpu_ids is not None:
+            args.insert(1, '--id=' + ','.join(str(int(gpu_id)) for gpu_id in gpu_ids))
+        output = subprocess.run(args, capture_output=True, text=True, check=True, timeout=30).stdout
+        processes = []
+        for line in output.strip().split('\n'):
+            parts = [part.strip() for part in line.split(',')]
+            if len(parts) >= 3 and parts[1].isdigit():
+                processes.append({'gpu_uuid': parts[0], 'pid': int(parts[1]),
+                                  'used_memory': float(parts[2]) if parts[2].replace('.', '', 1).isdigit() else 0.0})
+        return processes
+
+    def kill(self, username, pids, signal='KILL'):
+        if signal not in SIGNALS:
+            raise ValueError(f"Invalid signal {signal}")
+        uid = self._user(username).pw_uid
+        signalled, skipped = [], []
+        for pid in pids:
+            pid = int(pid)
+            # Only the user's own processes, checked right before signalling them
+            if pid <= 1 or process_owner(pid) != uid:
+                skipped.append(pid)
+                continue
+            try:
+                os.kill(pid, SIGNALS[signal])
+                signalled.append(pid)
+            except ProcessLookupError:
+                skipped.append(pid)
+        return {'signalled': signalled, 'skipped': skipped}
+
+    def disk_usage(self, username):
+        return directory_size(self._user(username).pw_dir)
+
+    def mig_instances(self):
+        # Fails on hosts where no GPU supports MIG, which simply have no instances
+        return subprocess.run(['nvidia-smi', 'mig', '-lgi'], capture_output=True, text=True, check=False, timeout=30).stdout
+
+    def run(self, command):
+        """Run one command
+
+        Returns:
+            dict: {'ok': True, 'result': ...} or {'ok': False, 'error': message}
+        """
+        try:
+            if not isinstance(command, dict):
+                raise ValueError("A command must be an object")
+            args = dict(command)
+            op = args.pop('op', None)
+            if op not in ('set_acl', 'get_acl', 'gpu_processes', 'kill', 'disk_usage', 'mig_instances'):
+                raise ValueError(f"Unknown command {op}")
+            return {'ok': True, 'result': getattr(self, op)(**args)}
+        except (ValueError, TypeError, OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Command {command} failed: {str(e)}")
+            return {'ok': False, 'error': str(e)}
+
+class HelperRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        pid, uid, gid = struct.unpack('3i', self.request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+        if uid not in self.server.allowed_uids:
+            logger.warning(f"Refused connection from UID {uid} (PID {pid})")
+            return
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_BYTES + 1)
+            if not line:
+                return
+            try:
+                if len(line) > MAX_REQUEST_BYTES:
+                    raise ValueError("Request too large")
+                commands = json.loads(line)['commands']
+                if not isinstance(commands, list):
+                    raise ValueError("commands must be a list")
+                response = {'results': [self.server.commands.run(command) for command in commands]}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'error': f"Malformed request: {str(e)}"}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            if 'error' in response:
+                return
+
+class HelperServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main():
+    parser = argparse.ArgumentParser(description="Root helper doing the privileged work of GPULocker")
+    parser.add_argument('--socket', default=config('PRIVILEGED_HELPER_SOCKET', default='/run/gpulocker/helper.sock'),
+                        help="Path of the Unix socket (default: PRIVILEGED_HELPER_SOCKET or /run/gpulocker/helper.sock)")
+    parser.add_argument('--user', required=True, help="Account GPULocker runs as, the only one besides root allowed to connect")
+    parser.add_argument('--min-uid', type=int, default=1000, help="Lowest UID of a regular user (default: 1000)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s :: %(message)s')
+
+    if os.geteuid() != 0:
+        parser.error("The helper must run as root")
+    client = pwd.getpwnam(args.user)
+    os.makedirs(os.path.dirname(args.socket), mode=0o755, exist_ok=True)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = HelperServer(args.socket, HelperRequestHandler)
+    # Only the GPULocker account can connect, and the peer credentials are checked again per connection
+    os.chown(args.socket, client.pw_uid, client.pw_gid)
+    os.chmod(args.socket, 0o600)
+    server.allowed_uids = {0, client.pw_uid}
+    server.commands = PrivilegedCommands(args.min_uid)
+    logger.info(f"Listening on {args.socket} for {args.user}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+"""Discrete-event simulator of the GPU allocation policies
+
+Replays historical allocations or a trace of jobs through the real
+/lock_gpu and /join_waitlist routes, waitlist, expiry and idle revocation
+code on a virtual clock, so the effect of a policy change (max days,
+lockout hours, idle thresholds, quotas, ...) on wait times and
+utilization can be predicted offline. Redis and MongoDB are replaced by
+in-memory fakes (fakeredis and mongomock need to be installed), the GPUs
+by the fake backend and the privileged commands (ACL changes, process
+kills) by the mock helper.
+
+Usage:
+    python simulate.py --synthetic 300 --span-days 14 --set USER_LOCKOUT_HOURS=0
+    python simulate.py --trace jobs.json --max-days 3
+    python simulate.py --history --since 2025-03-01 --until 2025-04-01 --set REVOKE_IDLE_GPU_AFTER_HOURS=4
+
+A trace is a JSON list of jobs, every field but submit has a default:
+    [{"username": "amin", "gpu_type": "4090", "count": 2, "days": 3,
+      "submit": "2025-03-01T09:00:00", "duration_hours": 20,
+      "utilization": 85, "memory_gb": 18, "release": true}]
+
+A job asks for count GPUs for days when it is submitted, joining the
+waitlist if they can't be allocated. Once it has them it works for
+duration_hours at the given utilization, then releases them if release is
+set or leaves them idle until they are revoked otherwise.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+from collections import deque
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+JOB_DEFAULTS = {'count': 1, 'days': 1, 'duration_hours': 24.0, 'utilization': 80.0, 'memory_gb': 8.0, 'release': True}
+
+def load_trace(path):
+    """Load the jobs of a JSON trace"""
+    with open(path) as f:
+        jobs = json.load(f)
+    return sorted((dict(JOB_DEFAULTS, **dict(job, submit=datetime.fromisoformat(job['submit']))) for job in jobs),
+                  key=lambda job: job['submit'])
+
+def generate_jobs(gpu_config, count, span_days, users, seed, start):
+    """Synthetic trace: arrivals spread uniformly over the span, log-normal run
+    times, and a share of light jobs (notebooks, debugging) barely using their GPU"""
+    rng = random.Random(seed)
+    jobs = []
+    for _ in range(count):
+        gpu_type = rng.choice(sorted(gpu_config))
+        light = rng.random() < 0.3
+        jobs.append({
+            'username': f"user{rng.randrange(users)}",
+            'gpu_type': gpu_type,
+            'count': 1 if light else min(len(gpu_config[gpu_type]), rng.choice([1, 1, 1, 2, 2, 4])),
+            'days': rng.randint(1, 7),
+            'submit': start + timedelta(seconds=rng.uniform(0, span_days * 86400)),
+            'duration_hours': rng.lognormvariate(math.log(4 if light else 30), 0.8),
+            'utilization': rng.uniform(1, 8) if light else rng.uniform(50, 100),
+            'memory_gb': rng.uniform(0.5, 4) if light else rng.uniform(8, 20),
+            'release': rng.random() < 0.5
+        })
+    return sorted(jobs, key=lambda job: job['submit'])
+
+def load_history(since, until, min_utilization):
+    """Turn the allocations made between since and until into jobs
+
+    The GPUs of one request share their allocation time and form a job.
+    It is submitted when its waitlist request was made, or when it was
+    allocated, and works until its last utilization sample at or above
+    min_utilization.
+    """
+    from pymongo import MongoClient
+    db = MongoClient('mongodb://localhost:27017/').gpulocker
+    requested_at = {}
+    for request in db.gpu_requests.find({'status': 'granted', 'granted_at': {'$gte': since, '$lt': until}}):
+        for allocation_id in request.get('allocation_ids', []):
+            requested_at[allocation_id] = request['requested_at']
+    jobs = {}
+    for allocation in db.gpu_allocations.find({'allocated_at': {'$gte': since, '$lt': until}}):
+        job = jobs.setdefault((allocation['username'], allocation['gpu_type'], allocation['allocated_at']), {
+            'username': allocation['username'],
+            'gpu_type': allocation['gpu_type'],
+            'count': 0,
+            'days': min(7, max(1, round((allocation['expiration_time'] - allocation['allocated_at']).total_seconds() / 86400))),
+            'submit': requested_at.get(allocation['_id'], allocation['allocated_at']),
+            'allocated_at': allocation['allocated_at'],
+            'release': (allocation.get('comment') or '').startswith('Manually released'),
+            'allocation_ids': []
+        })
+        job['count'] += 1
+        job['allocation_ids'].append(str(allocation['_id']))
+    for job in jobs.values():
+        active_until, utilization, samples, memory = job['allocated_at'], 0.0, 0, 0.0
+        for sample in db.gpu_utilization.find({'allocation_id': {'$in': job.pop('allocation_ids')}}):
+            if sample['gpu_utilization'] < min_utilization:
+                continue
+            # Compact storage keeps runs of samples as one document
+            active_until = max(active_until, sample.get('end_timestamp') or sample['timestamp'])
+            utilization += sample['gpu_utilization'] * sample.get('count', 1)
+            samples += sample.get('count', 1)
+            memory = max(memory, sample['memory_used'])
+        job['duration_hours'] = (active_until - job.pop('allocated_at')).total_seconds() / 3600
+        job['utilization'] = utilization / samples if samples else 0.0
+        job['memory_gb'] = memory / 1024
+    return sorted(jobs.values(), key=lambda job: job['submit'])
+
+def install_fake_backends():
+    """Replace Redis and MongoDB by in-memory fakes, before the app creates its clients"""
+    try:
+        import fakeredis
+        import mongomock
+    except ImportError:
+        sys.exit("The simulator needs fakeredis and mongomock: pip install 'fakeredis[lua]' mongomock")
+    import redis
+    import pymongo
+    server = fakeredis.FakeServer()
+
+    class SimulatedRedis(fakeredis.FakeRedis):
+        def __init__(self, host=None, port=None, db=0, **kwargs):
+            super().__init__(server=server, **kwargs)
+
+    redis.Redis = SimulatedRedis
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+class VirtualClock:
+    """Simulated time, only moved forward by the event loop"""
+    def __init__(self, start):
+        self.now = start
+
+    def advance(self, moment):
+        self.now = max(self.now, moment)
+
+def install_virtual_clock(clock):
+    """Make datetime.now() and time.time() of the app modules read the virtual clock"""
+    import datetime as datetime_module
+    import time as time_module
+
+    class VirtualDatetime(datetime_module.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now
+
+    class VirtualTime:
+        def __getattr__(self, name):
+            return getattr(time_module, name)
+
+        def time(self):
+            return clock.now.timestamp()
+
+    virtual_time = VirtualTime()
+    for name, module in list(sys.modules.items()):
+        if name == 'app' or name.startswith('app.'):
+            if getattr(module, 'datetime', None) is datetime_module.datetime:
+                module.datetime = VirtualDatetime
+            if getattr(module, 'time', None) is time_module:
+                module.time = virtual_time
+
+def percentile(values, q):
+    """Nearest-rank percentile, None for no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+class Simulation:
+    """Event loop driving the engine with jobs on a virtual clock
+
+    Args:
+        jobs: Jobs to submit, see the module docstring
+        clock: VirtualClock installed in the app modules
+        end: Time the simulation stops at
+        max_days: Cap on the days a job asks for, None to keep them
+    """
+    def __init__(self, jobs, clock, end, max_days=None):
+        from app import create_app
+        from app.config import REDIS_CLIENT
+        from app.utils import gpu_monitoring, release_jobs, notification, gpu_backend, expiry, idle_detector, waitlist
+        from app.routes import dashboard
+        from app.utils.db import MongoDBConnection
+        from app.utils.privileged import MockHelper, set_privileged_helper
+        from app.utils.redis_utils import initialize_gpu_config, get_gpu_config
+        from app.utils.topology import initialize_gpu_topology
+        self.gpu_monitoring = gpu_monitoring
+        self.release_jobs = release_jobs
+        self.expiry = expiry
+        self.idle_detector = idle_detector
+        self.waitlist = waitlist
+        self.clock = clock
+        self.end = end
+        self.jobs = [dict(job, id=index, days=min(job['days'], max_days) if max_days else job['days'])
+                     for index, job in enumerate(jobs)]
+        self.events = []
+        self.sequence = itertools.count()
+        self.waiting = {}  # gpu_requests _id -> job
+        self.backlog = {}  # (username, gpu_type) -> jobs waiting for the user's request of that type
+        self.working = {}  # job id -> job whose work is running
+        self.owned = set()  # allocation ids already matched to a job
+
+        # Fake GPUs, privileged commands and notifications
+        REDIS_CLIENT.flushall()
+        initialize_gpu_config()
+        gpu_config = get_gpu_config()
+        self.gpu_config = gpu_config
+        gpu_backend.set_gpu_backend(gpu_backend.FakeGPUBackend(trace={'gpus': {str(gpu_id): {'memory_total': 81920}
+                                                                               for gpu_ids in gpu_config.values() for gpu_id in gpu_ids}}))
+        initialize_gpu_topology()
+        gpu_monitoring.initialize_gpu_tracking()
+        set_privileged_helper(MockHelper())
+        gpu_monitoring.get_gpu_process_map = self._process_map
+        gpu_monitoring.schedule_allocations_monitoring = lambda allocations: None
+        gpu_monitoring.cancel_allocation_monitoring = lambda allocation_id: None
+        notification.send_notification = lambda username, message: None
+        # Jobs queued on the RQ worker run at once
+        dashboard.enqueue_job = lambda function, *args, **kwargs: function(*args, **kwargs)
+
+        self.app = create_app()
+        self.client = self.app.test_client()
+        with MongoDBConnection() as (client, db):
+            self.db = db
+
+    def _process_map(self, gpu_ids=None):
+        processes = {}
+        for job in self.working.values():
+            for gpu_id in job['gpu_ids']:
+                if gpu_ids is None or gpu_id in gpu_ids:
+                    processes.setdefault(gpu_id, {})[job['username']] = [100000 + job['id']]
+        return processes
+
+    def _schedule(self, moment, kind, job=None):
+        heapq.heappush(self.events, (moment, next(self.sequence), kind, job))
+
+    def _post(self, username, path, form):
+        with self.client.session_transaction() as session:
+            session['username'] = username
+            session.pop('_flashes', None)
+        self.client.post(path, data=form)
+
+    def _submit(self, job):
+        """Lock the GPUs of a job like a user would, joining the waitlist when that fails"""
+        key = (job['username'], job['gpu_type'])
+        if key in self.backlog:
+            # The user already waits for this type, the waitlist keeps one request per user and type
+            self.backlog[key].append(job)
+            return
+        form = {}
+        for gpu_type in self.gpu_config:
+            form[f'quantity_{gpu_type}'] = str(job['count'] if gpu_type == job['gpu_type'] else 0)
+            form[f'days_{gpu_type}'] = str(job['days'])
+        self._post(job['username'], '/lock_gpu', form)
+        allocations = list(self.db.gpu_allocations.find({'username': job['username'], 'allocated_at': self.clock.now}))
+        allocations = [allocation for allocation in allocations if str(allocation['_id']) not in self.owned]
+        if allocations:
+            self._start(job, allocations)
+            return
+        self.backlog[key] = deque()
+        self._post(job['username'], '/join_waitlist', {'gpu_type': job['gpu_type'], 'count': job['count'], 'days': job['days']})
+        request = self.db.gpu_requests.find_one({'username': job['username'], 'gpu_type': job['gpu_type'], 'status': {'$in': ['waiting', 'granted']}},
+                                                sort=[('requested_at', -1)])
+        if request is None:
+            logging.getLogger(__name__).warning(f"Job {job['id']} could not join the waitlist")
+            self.backlog.pop(key)
+            job['rejected'] = True
+            return
+        self.waiting[request['_id']] = job
+
+    def _start(self, job, allocations):
+        for allocation in allocations:
+            self.owned.add(str(allocation['_id']))
+        job['start'] = self.clock.now
+        job['allocation_ids'] = [allocation['_id'] for allocation in allocations]
+        job['gpu_ids'] = [allocation['gpu_id'] for allocation in allocations]
+        self.working[job['id']] = job
+        self._sample_job(job)
+        self._schedule(self.clock.now + timedelta(hours=job['duration_hours']), 'finish', job)
+
+    def _collect_grants(self):
+        """Start the jobs whose waitlist request was granted"""
+        if not self.waiting:
+            return
+        for request in self.db.gpu_requests.find({'_id': {'$in': list(self.waiting)}, 'status': 'granted'}):
+            job = self.waiting.pop(request['_id'])
+            self._start(job, list(self.db.gpu_allocations.find({'_id': {'$in': request['allocation_ids']}})))
+            backlog = self.backlog.pop((job['username'], job['gpu_type']))
+            for queued in backlog:
+                self._submit(queued)
+
+    def _collect_revocations(self):
+        """Stop the work of jobs that lost a GPU to expiry or idle revocation"""
+        if not self.working:
+            return
+        allocation_ids = [allocation_id for job in self.working.values() for allocation_id in job['allocation_ids']]
+        for allocation in self.db.gpu_allocations.find({'_id': {'$in': allocation_ids}, 'released_at': {'$ne': None}}):
+            for job in list(self.working.values()):
+                if allocation['_id'] in job['allocation_ids']:
+                    job['interrupted_at'] = allocation['released_at']
+                    job['interrupted_by'] = allocation.get('comment')
+                    del self.working[job['id']]
+
+    def _finish(self, job):
+        if self.working.pop(job['id'], None) is None:
+            return
+        job['finished_at'] = self.clock.now
+        if job['release']:
+            for allocation_id in job['allocation_ids']:
+                self.release_jobs.release_allocation_job(str(allocation_id), f"Manually released by {job['username']}")
+
+    def _sample_job(self, job):
+        working = job['id'] in self.working
+        for allocation_id in job['allocation_ids']:
+            self.idle_detector.update_idle_state(str(allocation_id), job['utilization'] if working else 0,
+                                                 job['memory_gb'] * 1024 if working else 0, timestamp=self.clock.now.timestamp())
+
+    def _sample(self):
+        """Feed the idle detector one sample of every active allocation"""
+        active = {allocation['_id'] for allocation in self.db.gpu_allocations.find({'released_at': None}, {'_id': 1})}
+        for job in self.jobs:
+            if 'start' in job and any(allocation_id in active for allocation_id in job['allocation_ids']):
+                self._sample_job(job)
+
+    def _run_due_expirations(self, until):
+        """Release expired allocations the moment they come due, like the expiry loop"""
+        while True:
+            seconds = self.expiry.seconds_until_next_expiration(self.clock.now)
+            if seconds is None or self.clock.now + timedelta(seconds=seconds) > until:
+                return
+            self.clock.advance(self.clock.now + timedelta(seconds=seconds))
+            self.gpu_monitoring.check_expired_reservations()
+            self._collect_revocations()
+            self._collect_grants()
+
+    def run(self):
+        """Run until the end time
+
+        Returns:
+            dict: Report of the run, see report()
+        """
+        from decouple import config
+        start = self.clock.now
+        for job in self.jobs:
+            self._schedule(job['submit'], 'submit', job)
+        sample_minutes = config('GPU_ACTIVITY_CHECK_MINUTES', default=5, cast=int)
+        idle_minutes = config('IDLE_CHECK_MINUTES', default=5, cast=int)
+        self._schedule(start + timedelta(minutes=sample_minutes), 'sample')
+        self._schedule(start + timedelta(minutes=idle_minutes), 'idle_check')
+
+        while self.events and self.events[0][0] <= self.end:
+            moment, _, kind, job = heapq.heappop(self.events)
+            self._run_due_expirations(moment)
+            self.clock.advance(moment)
+            if kind == 'submit':
+                self._submit(job)
+            elif kind == 'finish':
+                self._finish(job)
+            elif kind == 'sample':
+                self._sample()
+                self._schedule(moment + timedelta(minutes=sample_minutes), 'sample')
+            elif kind == 'idle_check':
+                self.gpu_monitoring.check_idle_allocations()
+                self._schedule(moment + timedelta(minutes=idle_minutes), 'idle_check')
+            self._collect_revocations()
+            self._collect_grants()
+        self._run_due_expirations(self.end)
+        self.clock.advance(self.end)
+        return self.report(start)
+
+    def report(self, start):
+        """Summarize the run
+
+        Returns:
+            dict: Job counts, wait percentiles in hours, throughput per day and GPU-hours
+        """
+        end = self.clock.now
+        hours = lambda a, b: max(0.0, (b - a).total_seconds() / 3600)
+        started = [job for job in self.jobs if 'start' in job]
+        waits = [hours(job['submit'], job['start']) for job in started]
+        busy_hours = 0.0
+        for job in started:
+            work_end = min(job['start'] + timedelta(hours=job['duration_hours']), job.get('interrupted_at') or end, end)
+            busy_hours += hours(job['start'], work_end) * job['count']
+        allocated_hours = 0.0
+        revocations = {}
+        for allocation in self.db.gpu_allocations.find():
+            allocated_hours += hours(max(allocation['allocated_at'], start), min(allocation['released_at'] or end, end))
+            if allocation['released_at'] is not None:
+                reason = (allocation.get('comment') or 'released').split(' by ')[0]
+                revocations[reason] = revocations.get(reason, 0) + 1
+        capacity_hours = hours(start, end) * sum(len(gpu_ids) for gpu_ids in self.gpu_config.values())
+        completed = [job for job in started if 'finished_at' in job]
+        days = max(hours(start, end) / 24, 1e-9)
+        return {
+            'start': start.isoformat(timespec='minutes'),
+            'end': end.isoformat(timespec='minutes'),
+            'jobs': {
+                'submitted': len([job for job in self.jobs if job['submit'] <= end]),
+                'started': len(started),
+                'completed': len(completed),
+                'interrupted': len([job for job in started if 'interrupted_at' in job]),
+                'never_started': len([job for job in self.jobs if job['submit'] <= end and 'start' not in job])
+            },
+            'wait_hours': {'p50': percentile(waits, 50), 'p90': percentile(waits, 90), 'p99': percentile(waits, 99),
+                           'max': max(waits, default=None), 'mean': sum(waits) / len(waits) if waits else None},
+            'throughput_jobs_per_day': len(completed) / days,
+            'gpu_hours': {
+                'capacity': capacity_hours,
+                'allocated': allocated_hours,
+                'busy': busy_hours,
+                'idle_allocated': max(0.0, allocated_hours - busy_hours),
+                'utilization': busy_hours / capacity_hours if capacity_hours else 0.0
+            },
+            'releases': revocations
+        }
+
+def format_report(report):
+    """Render a report as text"""
+    value = lambda number: '-' if number is None else f"{number:.1f}"
+    lines = [
+        f"Simulated {report['start']} to {report['end']}",
+        "Jobs: " + ', '.join(f"{count} {name.replace('_', ' ')}" for name, count in report['jobs'].items()),
+        "Wait (hours): " + ', '.join(f"{name} {value(hours)}" for name, hours in report['wait_hours'].items()),
+        f"Throughput: {report['throughput_jobs_per_day']:.2f} jobs completed per day",
+        (f"GPU-hours: {report['gpu_hours']['capacity']:.0f} capacity, {report['gpu_hours']['allocated']:.0f} allocated, "
+         f"{report['gpu_hours']['busy']:.0f} busy, {report['gpu_hours']['idle_allocated']:.0f} allocated but idle "
+         f"({report['gpu_hours']['utilization']:.1%} utilization)"),
+        "Releases: " + (', '.join(f"{count} {reason.lower()}" for reason, count in sorted(report['releases'].items())) or 'none')
+    ]
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay GPU requests through the allocation engine under a policy")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--trace', help="JSON file of jobs")
+    source.add_argument('--synthetic', type=int, metavar='JOBS', help="Generate this many synthetic jobs")
+    source.add_argument('--history', action='store_true', help="Replay the allocations stored in MongoDB")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Start of the replayed history")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="End of the replayed history (default: now)")
+    parser.add_argument('--span-days', type=float, default=14, help="Days the synthetic jobs arrive over (default: 14)")
+    parser.add_argument('--users', type=int, default=10, help="Number of synthetic users (default: 10)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the synthetic trace (default: 0)")
+    parser.add_argument('--drain-days', type=float, default=8,
+                        help="Days simulated after the last submission (default: 8)")
+    parser.add_argument('--max-days', type=int, help="Cap on the days a job asks for")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="Override a setting from .env, e.g. USER_LOCKOUT_HOURS=0, can be repeated")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        os.environ[name] = value
+    # The web routes need these, the simulator doesn't use Telegram accounts
+    os.environ.setdefault('SECRET_KEY', 'simulation')
+    os.environ['TG_ACCOUNT_REQUIRED'] = 'False'
+
+    from decouple import config
+    if args.history:
+        if not args.since:
+            parser.error("--history needs --since")
+        jobs = load_history(args.since, args.until or datetime.now(), config('MIN_GPU_UTILIZATION_PERCENT', default=5.0, cast=float))
+    elif args.trace:
+        jobs = load_trace(args.trace)
+    else:
+        jobs = generate_jobs(eval(config('GPU_CONFIG')), args.synthetic, args.span_days, args.users, args.seed,
+                             datetime.now().replace(minute=0, second=0, microsecond=0))
+    if not jobs:
+        sys.exit("No jobs to simulate")
+
+    install_fake_backends()
+    from app.utils.logger import logger
+    logger.setLevel(logging.ERROR)
+    clock = VirtualClock(jobs[0]['submit'])
+    install_virtual_clock(clock)
+    simulation = Simulation(jobs, clock, jobs[-1]['submit'] + timedelta(days=args.drain_days), max_days=args.max_days)
+    report = simulation.run()
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+
+# The app creates its Redis and MongoDB clients on import, so the in-memory
+# fakes of the simulator are installed before anything from app is imported
+pytest.importorskip('fakeredis')
+pytest.importorskip('mongomock')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('GPU_CONFIG', "{'4090': [0, 1, 2, 3], 'a100': [4, 5]}")
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'test')
+os.environ.setdefault('PRIVILEGED_USERS', 'admin')
+os.environ['TG_ACCOUNT_REQUIRED'] = 'False'
+import simulate
+simulate.install_fake_backends()
+
+@pytest.fixture
+def db():
+    """Empty in-memory Redis and MongoDB, yielding the MongoDB database"""
+    from app.config import REDIS_CLIENT
+    from app.utils.db import MongoDBConnection
+    from app.utils.redis_utils import initialize_gpu_config
+    REDIS_CLIENT.flushall()
+    initialize_gpu_config()
+    with MongoDBConnection() as (client, db):
+        for name in db.list_collection_names():
+            db.drop_collection(name)
+        yield db
+
+@pytest.fixture
+def helper():
+    """MockHelper installed as the process-wide privileged helper"""
+    from app.utils.privileged import MockHelper, set_privileged_helper
+    helper = MockHelper()
+    set_privileged_helper(helper)
+    yield helper
+    set_privileged_helper(None)
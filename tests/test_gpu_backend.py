@@ -0,0 +1,54 @@
+import json
+from app.utils.gpu_backend import FakeGPUBackend
+
+TRACE = {
+    'gpus': {'0': {'memory_total': 24564}, '1': {'memory_total': 24564}},
+    'frames': [
+        {'gpus': {'0': {'utilization': 10, 'memory_used': 100}},
+         'processes': [{'gpu_id': 0, 'pid': 1000, 'used_memory': 100}]},
+        {'gpus': {'0': {'utilization': 90, 'memory_used': 2000}, '1': {'utilization': 50, 'memory_used': 500}},
+         'processes': [{'gpu_id': 0, 'pid': 1000, 'used_memory': 2000}, {'gpu_id': 1, 'pid': 2000, 'used_memory': 500}]}
+    ],
+    'mig': [{'gpu_id': 1, 'instance_id': 1, 'profile': '3g.20gb', 'memory_total': 20096}]
+}
+
+def test_query_gpus_replays_the_frames_in_a_loop():
+    backend = FakeGPUBackend(trace=TRACE)
+    utilization = [[gpu['utilization'] for gpu in backend.query_gpus()] for _ in range(3)]
+    assert utilization == [[10.0, 0.0], [90.0, 50.0], [10.0, 0.0]]
+
+def test_query_gpus_reports_the_trace_memory_total():
+    gpus = FakeGPUBackend(trace=TRACE).query_gpus()
+    assert [gpu['index'] for gpu in gpus] == [0, 1]
+    assert all(gpu['memory_total'] == 24564.0 for gpu in gpus)
+
+def test_query_compute_apps_reports_the_first_frame_before_any_query():
+    backend = FakeGPUBackend(trace=TRACE)
+    assert [process['pid'] for process in backend.query_compute_apps()] == [1000]
+
+def test_query_compute_apps_follows_the_last_queried_frame():
+    backend = FakeGPUBackend(trace=TRACE)
+    backend.query_gpus()
+    backend.query_gpus()
+    assert [process['pid'] for process in backend.query_compute_apps()] == [1000, 2000]
+    assert [process['pid'] for process in backend.query_compute_apps(gpu_ids=[1])] == [2000]
+
+def test_advance_skips_a_frame():
+    backend = FakeGPUBackend(trace=TRACE)
+    backend.advance()
+    assert backend.query_gpus()[0]['utilization'] == 90.0
+
+def test_topology_defaults_to_sys_links():
+    assert FakeGPUBackend(trace=TRACE).query_topology() == {0: {0: 'X', 1: 'SYS'}, 1: {0: 'SYS', 1: 'X'}}
+
+def test_mig_instances_come_from_the_trace():
+    backend = FakeGPUBackend(trace=TRACE)
+    instances = backend.query_mig_instances()
+    instances[0]['memory_total'] = 0
+    assert backend.query_mig_instances() == TRACE['mig']
+
+def test_trace_is_loaded_from_a_file(tmp_path):
+    trace_file = tmp_path / 'trace.json'
+    trace_file.write_text(json.dumps(TRACE))
+    backend = FakeGPUBackend(trace_file=str(trace_file))
+    assert backend.query_gpus()[0]['memory_used'] == 100.0
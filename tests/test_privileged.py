@@ -0,0 +1,50 @@
+import os
+import pwd
+from app.utils import privileged
+from app.utils.privileged import HelperError, MockHelper, SudoHelper
+import pytest
+
+def test_mock_helper_sets_and_removes_acl_entries():
+    helper = MockHelper()
+    helper.set_device_acl('alice', ['/dev/nvidia0', '/dev/nvidia1'], 'rw')
+    helper.set_device_acl('bob', ['/dev/nvidia1'], 'none')
+    assert helper.get_device_acls(['/dev/nvidia0', '/dev/nvidia1']) == {
+        '/dev/nvidia0': {'alice': 'rw-'},
+        '/dev/nvidia1': {'alice': 'rw-', 'bob': '---'}
+    }
+    helper.set_device_acl('alice', ['/dev/nvidia1'], None)
+    assert helper.get_device_acls(['/dev/nvidia1']) == {'/dev/nvidia1': {'bob': '---'}}
+
+def test_mock_helper_only_kills_the_users_processes():
+    helper = MockHelper(processes=[{'gpu_uuid': 'GPU-0', 'pid': 100, 'used_memory': 10, 'username': 'alice'},
+                                   {'gpu_uuid': 'GPU-0', 'pid': 200, 'used_memory': 10, 'username': 'bob'}])
+    assert helper.kill_processes('alice', [100, 200]) == {'signalled': [100], 'skipped': [200]}
+    assert [process['pid'] for process in helper.gpu_processes()] == [200]
+
+def test_mock_helper_records_the_commands():
+    helper = MockHelper(disk_usage={'alice': 1024})
+    assert helper.disk_usage('alice') == 1024
+    assert helper.commands == [{'op': 'disk_usage', 'username': 'alice'}]
+
+def test_mock_helper_rejects_unknown_commands():
+    helper = MockHelper()
+    with pytest.raises(HelperError):
+        helper._call('reboot')
+
+def test_sudo_helper_only_kills_the_users_processes(monkeypatch):
+    calls = []
+    monkeypatch.setattr(privileged.subprocess, 'run', lambda args, **kwargs: calls.append(args))
+    username = pwd.getpwuid(os.getuid()).pw_name
+    # PID 1 and a PID that doesn't exist are never signalled
+    missing = max(int(pid) for pid in os.listdir('/proc') if pid.isdigit()) + 1000
+    result = SudoHelper().kill_processes(username, [os.getpid(), 1, missing])
+    assert result == {'signalled': [os.getpid()], 'skipped': [1, missing]}
+    assert calls == [['sudo', 'kill', '-KILL', str(os.getpid())]]
+
+def test_sudo_helper_skips_other_users_processes(monkeypatch):
+    calls = []
+    monkeypatch.setattr(privileged.subprocess, 'run', lambda args, **kwargs: calls.append(args))
+    monkeypatch.setattr(privileged, '_process_owner', lambda pid: os.getuid() + 1)
+    username = pwd.getpwuid(os.getuid()).pw_name
+    assert SudoHelper().kill_processes(username, [os.getpid()]) == {'signalled': [], 'skipped': [os.getpid()]}
+    assert calls == []
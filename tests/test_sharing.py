@@ -0,0 +1,100 @@
+import pytest
+from app.utils import gpu_backend, gpu_monitoring, notification, sharing
+from app.utils.redis_utils import get_available_gpus, get_available_mig_instances, get_shared_gpus
+from app.utils.topology import initialize_gpu_topology
+
+MIG = [{'gpu_id': 5, 'instance_id': 1, 'profile': '3g.40gb', 'memory_total': 40192},
+       {'gpu_id': 5, 'instance_id': 2, 'profile': '2g.20gb', 'memory_total': 19968},
+       {'gpu_id': 5, 'instance_id': 3, 'profile': '2g.20gb', 'memory_total': 19968}]
+
+@pytest.fixture
+def gpus(db, helper, monkeypatch, tmp_path):
+    """4090 GPUs 0-3 time-sliced and a100 GPU 5 partitioned into MIG instances, on the fake backend"""
+    monkeypatch.setenv('SHARED_GPU_TYPES', '4090')
+    monkeypatch.setenv('SHARED_GPU_MAX_TENANTS', '2')
+    mig_minors = tmp_path / 'mig-minors'
+    mig_minors.write_text('\n'.join(f"gpu5/gi{instance['instance_id']}/access {10 + instance['instance_id']}" for instance in MIG))
+    monkeypatch.setattr(gpu_monitoring, 'MIG_MINORS_FILE', str(mig_minors))
+    monkeypatch.setattr(gpu_monitoring, 'schedule_allocations_monitoring', lambda allocations: None)
+    monkeypatch.setattr(gpu_monitoring, 'cancel_allocation_monitoring', lambda allocation_id: None)
+    monkeypatch.setattr(notification, 'send_notification', lambda username, message: None)
+    memory = {gpu_id: 24564 for gpu_id in range(4)}
+    memory.update({4: 81920, 5: 81920})
+    gpu_backend.set_gpu_backend(gpu_backend.FakeGPUBackend(trace={
+        'gpus': {str(gpu_id): {'memory_total': memory_total} for gpu_id, memory_total in memory.items()},
+        'mig': MIG
+    }))
+    initialize_gpu_topology()
+    gpu_monitoring.initialize_gpu_tracking()
+    yield
+    gpu_backend.set_gpu_backend(None)
+
+def _acl(helper, gpu_id):
+    return helper.get_device_acls([f'/dev/nvidia{gpu_id}'])[f'/dev/nvidia{gpu_id}']
+
+def _release(db, gpu_id, unit):
+    allocation = db.gpu_allocations.find_one({'gpu_id': gpu_id, 'released_at': None, **unit})
+    return gpu_monitoring.unallocate_gpu(allocation['username'], gpu_id, allocation['gpu_type'], allocation['_id'], db)
+
+def test_mig_gpus_are_left_out_of_the_whole_gpu_pool(gpus):
+    assert get_available_gpus() == {'4090': [0, 1, 2, 3], 'a100': [4]}
+    assert get_available_mig_instances('a100') == [(5, 1), (5, 2), (5, 3)]
+
+def test_time_slices_share_a_gpu_until_it_is_full(db, helper, gpus):
+    success, (first_gpu, unit) = sharing.allocate_shared_gpu(db, 'alice', '4090', 8, 1)
+    assert success
+    assert unit == {'unit': 'shared', 'memory_budget': 8192, 'energy_share': 8192 / 24564}
+    success, (second_gpu, _) = sharing.allocate_shared_gpu(db, 'bob', '4090', 8, 1)
+    assert success and second_gpu == first_gpu
+    assert get_shared_gpus([first_gpu]) == {first_gpu: {'tenants': 2, 'memory_reserved': 16384.0}}
+    assert first_gpu not in get_available_gpus()['4090']
+    # SHARED_GPU_MAX_TENANTS is 2, a third tenant starts sharing another GPU
+    success, (third_gpu, _) = sharing.allocate_shared_gpu(db, 'carol', '4090', 8, 1)
+    assert success and third_gpu != first_gpu
+    assert _acl(helper, first_gpu) == {'alice': 'rw-', 'bob': 'rw-'}
+
+def test_time_slice_needs_enough_unreserved_memory(db, gpus):
+    _, (first_gpu, _) = sharing.allocate_shared_gpu(db, 'alice', '4090', 16, 1)
+    _, (second_gpu, _) = sharing.allocate_shared_gpu(db, 'bob', '4090', 16, 1)
+    assert second_gpu != first_gpu
+
+def test_time_slice_can_be_kept_to_gpus_already_shared(db, gpus):
+    success, message = sharing.allocate_shared_gpu(db, 'alice', '4090', 8, 1, take_free=False)
+    assert not success and message == "No 4090 GPU has 8 GiB to share"
+    assert get_available_gpus()['4090'] == [0, 1, 2, 3]
+
+def test_gpu_returns_to_the_pool_with_its_last_tenant(db, helper, gpus):
+    _, (gpu_id, _) = sharing.allocate_shared_gpu(db, 'alice', '4090', 8, 1)
+    sharing.allocate_shared_gpu(db, 'bob', '4090', 4, 1)
+    assert _release(db, gpu_id, {'username': 'alice'})
+    assert get_shared_gpus([gpu_id]) == {gpu_id: {'tenants': 1, 'memory_reserved': 4096.0}}
+    assert gpu_id not in get_available_gpus()['4090']
+    assert _release(db, gpu_id, {'username': 'bob'})
+    assert get_shared_gpus([gpu_id]) == {}
+    assert get_available_gpus()['4090'] == [0, 1, 2, 3]
+    assert _acl(helper, gpu_id) == {'alice': '---', 'bob': '---'}
+
+def test_mig_claims_the_smallest_instance_with_enough_memory(db, gpus):
+    success, (gpu_id, unit) = sharing.allocate_shared_gpu(db, 'alice', 'a100', 16, 1)
+    assert success and gpu_id == 5
+    assert unit['mig_instance'] in (2, 3) and unit['mig_profile'] == '2g.20gb'
+    assert unit['energy_share'] == 19968 / (40192 + 19968 * 2)
+    success, (_, unit) = sharing.allocate_shared_gpu(db, 'bob', 'a100', 30, 1)
+    assert success and unit['mig_instance'] == 1
+    assert len(get_available_mig_instances('a100')) == 1
+
+def test_mig_instance_returns_to_its_pool(db, gpus):
+    _, (gpu_id, unit) = sharing.allocate_shared_gpu(db, 'alice', 'a100', 30, 1)
+    assert (5, 1) not in get_available_mig_instances('a100')
+    assert _release(db, gpu_id, {'mig_instance': unit['mig_instance']})
+    assert get_available_mig_instances('a100') == [(5, 1), (5, 2), (5, 3)]
+
+def test_mig_request_larger_than_every_instance_fails(db, gpus):
+    success, _ = sharing.allocate_shared_gpu(db, 'alice', 'a100', 60, 1)
+    assert not success
+    assert get_available_mig_instances('a100') == [(5, 1), (5, 2), (5, 3)]
+
+def test_unknown_memory_is_charged_the_whole_gpu():
+    assert sharing._energy_share(8192, None) == 1.0
+    assert sharing._energy_share(8192, 0) == 1.0
+    assert sharing._energy_share(8192, 16384) == 0.5